@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import threading
+import time
+from wizzat.asynckvtable import *
+from wizzat.kvtable import *
+from wizzat.testutil import *
+
+class AsyncKVTableTest(TestCase):
+    def setUp(self):
+        super(AsyncKVTableTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        super(AsyncKVTableTest, self).tearDown()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_async(self, *coros):
+        return self.loop.run_until_complete(asyncio.gather(*coros))
+
+    def new_subclass(self, memoize_cls = False):
+        class C(DictKVTable):
+            table_name = 'tbl'
+            memoize    = memoize_cls
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1', 'data1' ]
+            kv_store   = {}
+
+        return C
+
+    def new_native_subclass(self, reads):
+        release = asyncio.Event()
+
+        class C(DictKVTable):
+            table_name = 'tbl'
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1', 'data1' ]
+            kv_store   = {}
+
+            @classmethod
+            async def _async_find_by_key(cls, kv_key):
+                reads.append(kv_key)
+                await release.wait()
+                return cls._find_by_key(kv_key)
+
+            async def _async_insert(self, force = False):
+                return self._insert(force)
+
+            async def _async_update(self, force = False):
+                return self._update(force)
+
+            async def _async_delete(self, force = False):
+                return self._delete(force)
+
+        return C, release
+
+    def test_thread_pool_fallback(self):
+        cls = self.new_subclass()
+        table = AsyncKVTable(cls)
+        main_thread = threading.current_thread()
+        threads = []
+
+        find_by_key = cls._find_by_key.__func__
+        def _find_by_key(cls, kv_key):
+            threads.append(threading.current_thread())
+            return find_by_key(cls, kv_key)
+        cls._find_by_key = classmethod(_find_by_key)
+
+        obj, = self.run_async(table.create(1, data1 = 'abc'))
+        found, missing = self.run_async(table.find_by_key(1), table.find_by_key(2))
+        self.assertEqual(found.data1, 'abc')
+        self.assertEqual(missing, None)
+        self.assertTrue(threads and main_thread not in threads)
+
+        found.data1 = 'def'
+        self.run_async(table.update(found))
+        self.assertEqual(cls.find_by_key(1).data1, 'def')
+
+        self.run_async(table.delete(found))
+        self.assertEqual(cls.find_by_key(1), None)
+
+    def test_find_by_keys(self):
+        cls = self.new_subclass()
+        table = AsyncKVTable(cls)
+        for key1 in range(5):
+            cls.create(key1, data1 = key1)
+
+        objs, = self.run_async(table.find_by_keys([ (3,), (9,), (1,), (3,) ]))
+        self.assertEqual([ obj.data1 for obj in objs ], [ 3, 1, 3 ])
+        self.assertEqual(table.stats['requests'], 1)
+
+    def test_concurrent_lookups_are_coalesced(self):
+        reads = []
+        cls, release = self.new_native_subclass(reads)
+        table = AsyncKVTable(cls)
+        cls.create(1, data1 = 'abc')
+        cls.create(2, data1 = 'def')
+
+        async def release_later():
+            await asyncio.sleep(0.01)
+            release.set()
+
+        obj1, obj2, objs, _ = self.run_async(
+            table.find_by_key(1),
+            table.find_by_key(1),
+            table.find_by_keys([ (1,), (2,) ]),
+            release_later(),
+        )
+
+        # Key 1 is read once, key 2 by the only lookup which needed it
+        self.assertEqual(reads, [ 'tbl/1', 'tbl/2' ])
+        self.assertTrue(obj1 is obj2)
+        self.assertEqual([ obj.data1 for obj in objs ], [ 'abc', 'def' ])
+        self.assertEqual(table.stats['coalesced'], 2)
+        self.assertEqual(table.inflight, {})
+
+    def test_lookups_are_coalesced_across_wrappers(self):
+        reads = []
+        cls, release = self.new_native_subclass(reads)
+        table1, table2 = AsyncKVTable(cls), AsyncKVTable(cls)
+        cls.create(1, data1 = 'abc')
+
+        async def release_later():
+            await asyncio.sleep(0.01)
+            release.set()
+
+        obj1, obj2, _ = self.run_async(table1.find_by_key(1), table2.find_by_key(1), release_later())
+        self.assertEqual(reads, [ 'tbl/1' ])
+        self.assertTrue(obj1 is obj2)
+        self.assertEqual(table2.stats['coalesced'], 1)
+
+    def test_native_writes(self):
+        reads = []
+        cls, release = self.new_native_subclass(reads)
+        table = AsyncKVTable(cls)
+        release.set()
+
+        obj, = self.run_async(table.create(1, data1 = 'abc'))
+        obj.data1 = 'def'
+        self.run_async(table.update(obj))
+        self.assertEqual(cls.kv_store['tbl/1'], { 'key1' : 1, 'data1' : 'def' })
+
+        self.run_async(table.delete(obj))
+        self.assertEqual(self.run_async(table.find_by_key(1)), [ None ])
+
+    def test_native_delta_updates(self):
+        reads = []
+        cls, release = self.new_native_subclass(reads)
+        table = AsyncKVTable(cls)
+        release.set()
+        written = []
+
+        async def _async_update_fields(self, fields, force = False):
+            written.append(fields)
+            return self._update_fields(fields, force)
+
+        cls.delta_updates = True
+        cls._async_update_fields = _async_update_fields
+
+        obj, = self.run_async(table.create(1, data1 = 'abc'))
+        obj.data1 = 'def'
+        self.run_async(table.update(obj))
+        self.assertEqual(written, [ frozenset([ 'data1' ]) ])
+        self.assertEqual(cls.kv_store['tbl/1'], { 'key1' : 1, 'data1' : 'def' })
+        self.assertEqual(obj.changed_fields(), frozenset())
+
+    def test_memoized_objects_skip_the_backend(self):
+        cls = self.new_subclass(memoize_cls = True)
+        table = AsyncKVTable(cls)
+        obj = cls.create(1, data1 = 'abc')
+
+        self.assertTrue(self.run_async(table.find_by_key(1))[0] is obj)
+        self.assertEqual(table.stats['cache_hits'], 1)
+        self.assertEqual(table.stats['requests'], 0)
+
+    def test_revalidation_runs_in_the_pool(self):
+        cls = self.new_subclass(memoize_cls = True)
+        cls.memoize_max_stale = 0.01
+        cls.memoize_revalidate = True
+        obj = cls.create(1, data1 = 'abc')
+        threads = []
+        time.sleep(0.05)
+
+        @classmethod
+        def _find_cas_by_key(cls, kv_key):
+            threads.append(threading.current_thread())
+            return cls._kv_cas(obj._kv_data)
+
+        cls.cas_versions = True
+        cls._kv_cas = classmethod(lambda cls, kv_data: 'cas')
+        cls._find_cas_by_key = _find_cas_by_key
+
+        table = AsyncKVTable(cls)
+        self.assertTrue(self.run_async(table.find_by_key(1))[0] is obj)
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0] is threading.current_thread())
+
+    def test_update_with(self):
+        cls = self.new_subclass()
+        table = AsyncKVTable(cls)
+        ContentionResults.clear()
+        conflicts = [ 1 ]
+
+        def incr(obj):
+            obj.data1 = (obj.data1 or 0) + 1
+            if conflicts[0]:
+                conflicts[0] -= 1
+                raise KVTableCASError()
+
+        obj, = self.run_async(table.update_with(1, incr, backoff = 0))
+        self.assertEqual(obj.data1, 1)
+        self.assertEqual(cls.find_by_key(1).data1, 1)
+        self.assertEqual(ContentionResults.stats['tbl']['calls'], 1)
+        self.assertEqual(ContentionResults.stats['tbl']['conflicts'], 1)
+
+    def test_update_with__declined_creates_are_not_cached(self):
+        cls = self.new_subclass(memoize_cls = True)
+        table = AsyncKVTable(cls)
+
+        obj, = self.run_async(table.update_with(1, lambda obj: False))
+        self.assertEqual(obj.key1, 1)
+        self.assertEqual(cls.find_by_key(1), None)
+        self.assertEqual(list(cls.key_cache.keys()), [])
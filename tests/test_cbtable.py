@@ -4,6 +4,7 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import couchbase
+import time
 from wizzat.cbtable import *
 from wizzat.testutil import *
 from wizzat.util import *
@@ -145,3 +146,40 @@ class CBTableTest(DBTestCase):
         )
 
         self.assertTrue(obj1 is not obj3)
+
+    def test_durability_session(self):
+        cls = self.new_subclass()
+        cls.persist_to = 1
+        for key2 in range(10):
+            self.conn.delete('tbl/1/{}'.format(key2), quiet=True)
+
+        with cls.durability_session() as session:
+            objs = [ cls.create(1, key2, data1 = 'abc') for key2 in range(10) ]
+            with cls.durability_session() as inner_session:
+                self.assertTrue(inner_session is session)
+            objs[0].delete()
+
+        self.assertEqual(len(session.keys), 11)
+        self.assertEqual(session.failures, {})
+        self.assertTrue(session.ok)
+        self.assertEqual(cls.find_by_key(1, 1).data1, 'abc')
+
+    def test_codec(self):
+        import wizzat.kvcodec
+
+        cls = self.new_subclass()
+        cls.codec = wizzat.kvcodec.BinaryCodec()
+        cls._codec = cls.codec.bind(cls)
+
+        cls.create(1, 2, data1 = 'abc')
+        self.assertEqual(cls.find_by_key(1, 2).data1, 'abc')
+
+    def test_ttl(self):
+        cls = self.new_subclass()
+        cls.ttl = 1
+
+        cls.create(1, 2, data1 = 'abc')
+        self.assertEqual(cls.find_by_key(1, 2).data1, 'abc')
+
+        time.sleep(2.5)
+        self.assertEqual(cls.find_by_key(1, 2), None)
@@ -3,6 +3,11 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import datetime
+import psycopg2, psycopg2.extras
+import threading
+import time
+from wizzat.decorators import skip_performance
 from wizzat.pghelper import *
 from wizzat.dbtable import *
 from wizzat.testutil import *
@@ -204,3 +209,675 @@ class DBTableTest(DBTestCase):
 
         with self.assertRaises(PgOperationalError):
             execute(self.db_mgr.getconn("conn2"), "select * from bar for update nowait")
+
+    def test_insert_many(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER NOT NULL, b TEXT DEFAULT 'default', c INTEGER[])")
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            memoize    = True
+            conn       = FooTable.conn
+            fields     = ( 'id', 'a', 'b', 'c' )
+            batches    = []
+
+            @classmethod
+            def on_insert_many(cls, objs):
+                cls.batches.append(len(objs))
+
+        objs = BazTable.insert_many([
+            { 'a' : 1, 'b' : 'tab\there' },
+            BazTable(a = 2),
+            { 'a' : 3, 'b' : 'back\\slash\nnewline', 'c' : [ 1, None, 3 ] },
+            { 'a' : 4, 'b' : 'x' },
+        ], batch_size = 1)
+        BazTable.conn.commit()
+
+        self.assertEqual(BazTable.batches, [ 4 ])
+        self.assertEqual([ obj.a for obj in objs ], [ 1, 2, 3, 4 ])
+        self.assertEqual([ obj.b for obj in objs ], [ 'tab\there', 'default', 'back\\slash\nnewline', 'x' ])
+        self.assertEqual(objs[2].c, [ 1, None, 3 ])
+        self.assertEqual(len(set(obj.id for obj in objs)), 4)
+        self.assertTrue(BazTable.find_by_id(objs[1].id) is objs[1])
+        self.assertFalse(objs[1].should_update())
+
+        self.assertSqlResults(self.conn(), """
+            SELECT id, a, b
+            FROM baz
+            ORDER BY a
+        """,
+            [ 'id',       'a', 'b',                     ],
+            [ objs[0].id, 1,   'tab\there',             ],
+            [ objs[1].id, 2,   'default',               ],
+            [ objs[2].id, 3,   'back\\slash\nnewline',  ],
+            [ objs[3].id, 4,   'x',                     ],
+        )
+
+    def test_insert_many__autocommit(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS blobs")
+        execute(self.conn(), "CREATE TABLE blobs (id SERIAL PRIMARY KEY, data BYTEA, n INTEGER DEFAULT 7, d DATE, i INTERVAL)")
+
+        class BlobTable(DBTable):
+            table_name = 'blobs'
+            id_field   = 'id'
+            conn       = self.conn()
+            fields     = ( 'id', 'data', 'n', 'd', 'i' )
+
+        self.assertTrue(BlobTable.conn.autocommit)
+        objs = BlobTable.insert_many([
+            { 'data' : b'\x00\xff\\\t' },
+            {},
+            { 'data' : bytearray(b'abc'), 'd' : datetime.date(2020, 1, 2) },
+            {},
+            { 'data' : b'\x00\xff\\\t', 'i' : datetime.timedelta(days = 1, seconds = 5) },
+            { 'n' : 1 },
+        ])
+
+        self.assertEqual([ obj.data and bytes(obj.data) for obj in objs ], [ b'\x00\xff\\\t', None, b'abc', None, b'\x00\xff\\\t', None ])
+        self.assertEqual([ obj.n for obj in objs ], [ 7, 7, 7, 7, 7, 1 ])
+        self.assertEqual(objs[2].d, datetime.date(2020, 1, 2))
+        self.assertEqual(objs[4].i, datetime.timedelta(days = 1, seconds = 5))
+        self.assertEqual(len(set(obj.id for obj in objs)), 6)
+
+        for obj in objs:
+            self.assertEqual(BlobTable.find_one(id = obj.id).n, obj.n)
+
+    def test_insert_many__ignores_permanent_tables_named_like_its_temp_table(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS wizzat_insert_many")
+        execute(self.conn(), "CREATE TABLE wizzat_insert_many (id INTEGER)")
+        execute(self.conn(), "INSERT INTO wizzat_insert_many VALUES (1)")
+
+        objs = FooTable.insert_many([ { 'a' : 1, 'b' : 2 } ])
+        FooTable.conn.commit()
+        self.assertEqual((objs[0].a, objs[0].b), (1, 2))
+
+        self.assertSqlResults(self.conn(), "SELECT id FROM public.wizzat_insert_many",
+            [ 'id' ],
+            [ 1    ],
+        )
+        execute(self.conn(), "DROP TABLE wizzat_insert_many")
+
+    @skip_performance
+    def test_insert_many_performance(self):
+        rows = [ { 'a' : x, 'b' : x } for x in range(10000) ]
+
+        start_time = time.time()
+        for row in rows:
+            FooTable(**row).update()
+        print("update(): {:.3f}s for 10k rows".format(time.time() - start_time))
+
+        start_time = time.time()
+        FooTable.insert_many(rows)
+        print("insert_many(): {:.3f}s for 10k rows".format(time.time() - start_time))
+        FooTable.conn.rollback()
+
+    def test_find_by_ids(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER, b TEXT)")
+        execute(self.conn(), "INSERT INTO baz (a, b) SELECT x, 'b' || x FROM generate_series(1, 10) x")
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            key_fields = [ 'a', 'b' ]
+            memoize    = True
+            conn       = FooTable.conn
+            fields     = ( 'id', 'a', 'b' )
+
+        queries = []
+        find_by_sql = BazTable.find_by_sql
+        BazTable.find_by_sql = classmethod(lambda cls, sql, **kwargs: queries.append(sql) or find_by_sql(sql, **kwargs))
+
+        cached = BazTable.find_by_id(2)
+        objs = BazTable.find_by_ids([ 5, 2, 99, 3, 5, 1 ], chunk_size = 2)
+        self.assertEqual([ obj.id for obj in objs ], [ 5, 2, 3, 5, 1 ])
+        self.assertTrue(objs[1] is cached)
+        self.assertEqual(len(queries), 3)
+
+        del queries[:]
+        objs = BazTable.find_by_keys([ (7, 'b7'), (5, 'b5'), (8, 'nope'), [ 6, 'b6' ] ])
+        self.assertEqual([ obj.a for obj in objs ], [ 7, 5, 6 ])
+        self.assertTrue(objs[1] is BazTable.find_by_id(5))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(BazTable.find_by_keys([]), [])
+
+        del queries[:]
+        objs = BazTable.find_by_ids(id for id in [ 4, 9, 4 ])
+        self.assertEqual([ obj.id for obj in objs ], [ 4, 9, 4 ])
+        objs = BazTable.find_by_keys(keys for keys in [ (4, 'b4'), (9, 'b9') ])
+        self.assertEqual([ obj.a for obj in objs ], [ 4, 9 ])
+
+        with self.assertRaises(DBTableConfigError):
+            FooTable.find_by_ids([ 1 ])
+        with self.assertRaises(DBTableConfigError):
+            FooTable.find_by_keys([ (1,) ])
+
+    def test_upsert(self):
+        events = []
+
+        class UpsertTable(BarTable):
+            table_name = 'bar'
+            key_fields = BarTable.key_fields
+            fields     = BarTable.fields
+
+            def on_insert(self):
+                events.append(('on_insert', self.a))
+
+            def on_update(self):
+                events.append(('on_update', self.a))
+
+            def after_insert(self):
+                events.append(('insert', self.a))
+
+            def after_update(self):
+                events.append(('update', self.a))
+
+        obj = UpsertTable.upsert(1, b = 2, c = 3)
+        self.assertEqual(obj.to_dict(), { 'a' : 1, 'b' : 2, 'c' : 3 })
+        self.assertFalse(obj.should_update())
+
+        obj = UpsertTable.upsert(1, b = 4)
+        self.assertEqual(obj.to_dict(), { 'a' : 1, 'b' : 4, 'c' : 3 })
+        UpsertTable.upsert(2)
+        # Whether the row exists isn't known until it's written, so only the after hooks run
+        self.assertEqual(events, [ ('insert', 1), ('update', 1), ('insert', 2) ])
+
+        del events[:]
+        objs = UpsertTable.upsert_many([
+            { 'a' : 2, 'b' : 5 },
+            { 'a' : 3, 'b' : 6 },
+            UpsertTable(a = 1, b = 7, c = 8),
+        ], batch_size = 1)
+        self.assertEqual([ obj.to_dict() for obj in objs ], [
+            { 'a' : 2, 'b' : 5, 'c' : None },
+            { 'a' : 3, 'b' : 6, 'c' : None },
+            { 'a' : 1, 'b' : 7, 'c' : 8 },
+        ])
+        self.assertEqual(events, [ ('update', 2), ('insert', 3), ('update', 1) ])
+
+        with self.assertRaises(DBTableConfigError):
+            FooTable.upsert(a = 1)
+
+    def test_upsert__defaults_do_not_overwrite_existing_rows(self):
+        class DefaultTable(BarTable):
+            table_name = 'bar'
+            key_fields = BarTable.key_fields
+            fields     = BarTable.fields
+
+            def default_c(self):
+                return 42
+
+        self.assertEqual(DefaultTable.upsert(1, b = 2).to_dict(), { 'a' : 1, 'b' : 2, 'c' : 42 })
+        execute(DefaultTable.conn, "UPDATE bar SET c = 7 WHERE a = 1")
+
+        self.assertEqual(DefaultTable.upsert(1, b = 3).to_dict(), { 'a' : 1, 'b' : 3, 'c' : 7 })
+        self.assertEqual(DefaultTable.upsert(1, c = 8).to_dict(), { 'a' : 1, 'b' : 3, 'c' : 8 })
+
+        objs = DefaultTable.upsert_many([
+            { 'a' : 1, 'b' : 4 },
+            { 'a' : 2, 'b' : 5 },
+        ])
+        self.assertEqual([ obj.to_dict() for obj in objs ], [
+            { 'a' : 1, 'b' : 4, 'c' : 8 },
+            { 'a' : 2, 'b' : 5, 'c' : 42 },
+        ])
+
+    def test_find_or_create__atomic(self):
+        obj = BarTable.find_or_create(1, atomic = True, b = 2)
+        self.assertEqual(obj.to_dict(), { 'a' : 1, 'b' : 2, 'c' : None })
+
+        obj = BarTable.find_or_create(1, atomic = True, b = 3)
+        self.assertEqual(obj.to_dict(), { 'a' : 1, 'b' : 2, 'c' : None })
+        self.assertFalse(obj.should_update())
+        BarTable.conn.commit()
+
+        self.assertSqlResults(self.conn(), """
+            SELECT *
+            FROM bar
+        """,
+            [ 'a', 'b', 'c'  ],
+            [ 1,   2,   None ],
+        )
+
+    def test_find_or_create__atomic_hooks(self):
+        events = []
+
+        class HookTable(BarTable):
+            table_name = 'bar'
+            key_fields = BarTable.key_fields
+            fields     = BarTable.fields
+
+            def on_insert(self):
+                events.append(('on_insert', self.a))
+                self.c = 9
+
+            def after_insert(self):
+                events.append(('after_insert', self.a))
+
+        obj = HookTable.find_or_create(1, atomic = True, b = 2)
+        self.assertEqual(obj.to_dict(), { 'a' : 1, 'b' : 2, 'c' : 9 })
+        self.assertEqual(events, [ ('on_insert', 1), ('after_insert', 1) ])
+
+        del events[:]
+        HookTable.find_or_create(1, atomic = True, b = 3)
+        self.assertEqual(events, [ ('on_insert', 1) ])
+
+    def test_sql_cache(self):
+        class PreparedTable(DBTable):
+            table_name        = 'bar'
+            key_fields        = [ 'a' ]
+            fields            = BarTable.fields
+            conn              = FooTable.conn
+            prepare_threshold = 2
+
+        for a in range(3):
+            PreparedTable(a = a, b = a).update()
+
+        obj = PreparedTable.find_one(a = 1)
+        obj.b = 5
+        obj.update()
+        obj.b = 6
+        obj.update()
+        PreparedTable.find_one(a = 2).delete()
+
+        self.assertEqual(sorted(x.a for x in PreparedTable.find_by(a = ( 0, 1 ))), [ 0, 1 ])
+        self.assertEqual(sorted(x.a for x in PreparedTable.find_by(a = ())), [])
+        self.assertEqual(sorted(x.b for x in PreparedTable.find_by()), [ 0, 6 ])
+
+        self.assertEqual({ shape[0] for shape in PreparedTable.sql_cache }, { 'insert', 'find_by', 'update', 'delete' })
+        self.assertEqual(PreparedTable.sql_cache[('insert', ('a', 'b'))]['uses'], 3)
+        self.assertTrue(PreparedTable.sql_cache[('insert', ('a', 'b'))]['statement'])
+        self.assertEqual(PreparedTable.sql_cache[('delete',)]['statement'], None)
+
+        prepared = fetch_results(self.db_mgr.getconn('conn'), "SELECT name FROM pg_prepared_statements")
+        self.assertEqual({ row['name'] for row in prepared }, prepared_statements(PreparedTable.conn))
+        self.assertEqual(len(prepared), 3)
+
+    def test_lazy_fields(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER, doc TEXT, tags TEXT[])")
+        execute(self.conn(), "INSERT INTO baz (a, doc, tags) SELECT x, repeat('x', x), ARRAY[x::text] FROM generate_series(1, 3) x")
+
+        class BazTable(DBTable):
+            table_name  = 'baz'
+            id_field    = 'id'
+            conn        = FooTable.conn
+            fields      = ( 'id', 'a', 'doc', 'tags' )
+            lazy_fields = ( 'doc', 'tags' )
+
+        queries = []
+        set_sql_log_func(lambda cur, sql, bind_params: queries.append(sql))
+        self.addCleanup(set_sql_log_func, None)
+
+        obj = BazTable.find_one(a = 2)
+        self.assertTrue('limit 2' in queries[0])
+        self.assertEqual(sorted(obj.db_fields.keys()), [ 'a', 'id' ])
+        self.assertEqual(obj.doc, 'xx')
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(obj.doc, 'xx')
+        self.assertEqual(obj.tags, [ '2' ]) # Loaded with doc
+        self.assertEqual(len(queries), 2)
+
+        obj.tags.append('y')
+        self.assertEqual(obj.changed_fields(), { 'tags' })
+        obj.update()
+        self.assertFalse('doc' in queries[2])
+        self.assertEqual((obj.doc, obj.tags), ('xx', [ '2', 'y' ]))
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(BazTable.find_one(a = 2).load_fields().tags, [ '2', 'y' ])
+
+        del queries[:]
+        self.assertEqual(BazTable.find_one(a = 3).to_dict(), { 'id' : 3, 'a' : 3, 'doc' : 'xxx', 'tags' : [ '3' ] })
+        self.assertEqual(len(queries), 2)
+
+        obj = BazTable(a = 4, doc = 'new').update()
+        self.assertEqual(sorted(obj.db_fields.keys()), [ 'a', 'doc', 'id' ])
+        self.assertEqual(obj.tags, None)
+
+        objs = BazTable.find_by(columns = [ 'doc' ], a = (1, 3))
+        self.assertEqual(sorted((obj.id, obj.doc) for obj in objs), [ (1, 'x'), (3, 'xxx') ])
+
+        with self.assertRaises(AssertionError):
+            BazTable.find_one(a = (1, 2, 3))
+
+        with self.assertRaises(DBTableConfigError):
+            class BadTable(DBTable):
+                table_name  = 'baz'
+                fields      = ( 'a', 'doc' )
+                lazy_fields = ( 'doc', )
+
+    def test_lazy_fields__defaults_do_not_replace_unloaded_values(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER, doc TEXT, tags TEXT[])")
+        execute(self.conn(), "INSERT INTO baz (a, doc, tags) VALUES (1, 'stored', ARRAY['x'])")
+
+        class BazTable(DBTable):
+            table_name  = 'baz'
+            id_field    = 'id'
+            conn        = FooTable.conn
+            fields      = ( 'id', 'a', 'doc', 'tags' )
+            lazy_fields = ( 'doc', )
+
+            def default_doc(self):
+                return 'default'
+
+            def default_tags(self):
+                return []
+
+        obj = BazTable.find_one(a = 1)
+        obj.a = 2
+        obj.update()
+
+        obj, = BazTable.find_by(columns = [ 'a' ], a = 2)
+        obj.a = 3
+        obj.update()
+        BazTable.conn.commit()
+
+        self.assertEqual(BazTable(doc = None).doc, None)
+        self.assertEqual(BazTable().doc, 'default')
+        self.assertSqlResults(self.conn(), "SELECT a, doc, tags FROM baz",
+            [ 'a', 'doc',    'tags'  ],
+            [ 3,   'stored', [ 'x' ] ],
+        )
+
+    def test_session(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER, b VARCHAR(10), c INTEGER[])")
+        execute(self.conn(), "INSERT INTO baz (a, b) SELECT x, 'b' || x FROM generate_series(1, 10) x")
+
+        events = []
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            conn       = FooTable.conn
+            fields     = ( 'id', 'a', 'b', 'c' )
+
+            def on_update(self):
+                events.append(('on_update', self.a))
+
+            def after_update(self):
+                events.append(('after_update', self.a))
+
+        queries = []
+        with BazTable.session(batch_size = 3) as session:
+            objs = list(BazTable.find_by())
+            for obj in objs:
+                if obj.a <= 4:
+                    obj.b = None
+                elif obj.a <= 8:
+                    obj.a += 10
+                    obj.c = [ obj.a ]
+
+            session.add(BazTable(a = 11, b = 'new'), BazTable(a = 12, b = 'new'))
+            session.delete(BazTable.find_one(a = 9))
+            set_sql_log_func(lambda cur, sql, bind_params: queries.append(sql))
+            self.addCleanup(set_sql_log_func, None)
+
+        # 2 updates of { b } (4 rows), 2 of { a, c } (4 rows), the column types,
+        # 4 statements for insert_many and a delete
+        self.assertEqual(len(queries), 10)
+        self.assertEqual(len(events), 16)
+        self.assertEqual(events[:2], [ ('on_update', 1), ('on_update', 2) ])
+        self.assertEqual(objs[4].to_dict(), { 'id' : objs[4].id, 'a' : 15, 'b' : 'b5', 'c' : [ 15 ] })
+        self.assertFalse(objs[4].should_update())
+        BazTable.conn.commit()
+
+        self.assertSqlResults(self.conn(), """
+            SELECT a, b, c
+            FROM baz
+            ORDER BY id
+        """,
+            [ 'a', 'b',   'c'    ],
+            [ 1,   None,  None   ],
+            [ 2,   None,  None   ],
+            [ 3,   None,  None   ],
+            [ 4,   None,  None   ],
+            [ 15,  'b5',  [ 15 ] ],
+            [ 16,  'b6',  [ 16 ] ],
+            [ 17,  'b7',  [ 17 ] ],
+            [ 18,  'b8',  [ 18 ] ],
+            [ 10,  'b10', None   ],
+            [ 11,  'new', None   ],
+            [ 12,  'new', None   ],
+        )
+
+    def test_update_many__lazy_fields(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER, doc TEXT)")
+        execute(self.conn(), "INSERT INTO baz (a, doc) SELECT x, repeat('x', x) FROM generate_series(1, 4) x")
+
+        class BazTable(DBTable):
+            table_name  = 'baz'
+            id_field    = 'id'
+            conn        = FooTable.conn
+            fields      = ( 'id', 'a', 'doc' )
+            lazy_fields = ( 'doc', )
+
+        objs = sorted(BazTable.find_by(), key = lambda obj: obj.a)
+        for obj in objs[:2]:
+            obj.a += 10
+        for obj in objs[2:]:
+            obj.doc = 'new'
+
+        queries = []
+        set_sql_log_func(lambda cur, sql, bind_params: queries.append(sql))
+        self.addCleanup(set_sql_log_func, None)
+
+        BazTable.update_many(objs)
+        self.assertFalse(any('doc' in sql.split('RETURNING')[1] for sql in queries if 'RETURNING' in sql))
+        self.assertEqual([ sorted(obj.db_fields.keys()) for obj in objs ], [
+            [ 'a', 'id' ],
+            [ 'a', 'id' ],
+            [ 'a', 'doc', 'id' ],
+            [ 'a', 'doc', 'id' ],
+        ])
+
+        del queries[:]
+        self.assertEqual([ (obj.a, obj.doc) for obj in objs ], [ (11, 'x'), (12, 'xx'), (3, 'new'), (4, 'new') ])
+        self.assertEqual(len(queries), 2) # The unloaded docs
+
+    def test_session__per_thread(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER)")
+        execute(self.conn(), "INSERT INTO baz (a) SELECT x FROM generate_series(1, 2) x")
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            conn       = FooTable.conn
+            fields     = ( 'id', 'a' )
+
+        other_thread = []
+        def read():
+            other_thread.append(DBTableSession.current(BazTable.conn))
+            BazTable.find_one(a = 2)
+
+        with BazTable.session() as outer:
+            with BazTable.session() as inner:
+                BazTable.find_one(a = 1)
+                thread = threading.Thread(target = read)
+                thread.start()
+                thread.join()
+            self.assertTrue(DBTableSession.current(BazTable.conn) is outer)
+
+        self.assertEqual(other_thread, [ None ])
+        self.assertEqual([ obj.a for obj in inner.objs.values() ], [ 1 ])
+        self.assertEqual(list(outer.objs.values()), [])
+        self.assertEqual(DBTableSession.current(BazTable.conn), None)
+
+    def new_transaction_conn(self):
+        conn_info = { k : v for k, v in self.db_info.items() if k not in ('minconn', 'maxconn') }
+        conn = psycopg2.connect(connection_factory = TransactionConnection, cursor_factory = psycopg2.extras.DictCursor, **conn_info)
+        self.addCleanup(conn.close)
+        return conn
+
+    def test_transaction_cache(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER)")
+        execute(self.conn(), "INSERT INTO baz (a) VALUES (1)")
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            memoize    = True
+            conn       = self.new_transaction_conn()
+            fields     = ( 'id', 'a' )
+
+        obj = BazTable.find_by_id(1)
+        obj.a = 2
+        obj.update()
+        self.assertEqual(BazTable.id_cache.get(1), None)
+        self.assertTrue(BazTable.find_by_id(1) is obj)
+
+        BazTable.rollback()
+        self.assertEqual(BazTable.find_by_id(1).a, 1)
+        self.assertFalse(BazTable.find_by_id(1) is obj)
+
+        obj = BazTable.find_by_id(1)
+        obj.a = 3
+        obj.update()
+        new_obj = BazTable(a = 4).update()
+        BazTable.conn.commit()
+        self.assertTrue(BazTable.id_cache.get(1) is obj)
+        self.assertTrue(BazTable.find_by_id(new_obj.id) is new_obj)
+
+        obj.delete()
+        self.assertEqual(BazTable.find_by_id(1), None)
+        BazTable.rollback()
+        self.assertEqual(BazTable.find_by_id(1).a, 3)
+
+        # Closing the connection drops its open transaction
+        BazTable(a = 5).update()
+        self.assertTrue(TransactionCache.current(BazTable.conn) is not None)
+        BazTable.conn.close()
+        self.assertEqual(TransactionCache.current(BazTable.conn), None)
+        self.assertFalse(BazTable.conn in TransactionCache.by_conn)
+
+    def test_transaction_cache__plain_connections(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, a INTEGER)")
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            memoize    = True
+            conn       = FooTable.conn
+            fields     = ( 'id', 'a' )
+
+        # Plain connections can't report commits, so writes are cached at once
+        self.assertFalse(isinstance(BazTable.conn, TransactionConnection))
+        obj = BazTable(a = 1).update()
+        BazTable.conn.commit()
+        self.assertTrue(BazTable.id_cache.get(obj.id) is obj)
+        self.assertEqual(TransactionCache.current(BazTable.conn, create = True), None)
+
+    def test_prefetch(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, name TEXT)")
+        execute(self.conn(), "INSERT INTO baz (name) SELECT 'c' || x FROM generate_series(1, 5) x")
+        execute(self.conn(), "DROP TABLE IF EXISTS qux")
+        execute(self.conn(), "CREATE TABLE qux (id SERIAL PRIMARY KEY, baz_id INTEGER)")
+        execute(self.conn(), "INSERT INTO qux (baz_id) SELECT nullif(mod(x, 6), 0) FROM generate_series(1, 30) x")
+
+        class Customer(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            conn       = FooTable.conn
+            fields     = ( 'id', 'name' )
+
+        class Order(DBTable):
+            table_name = 'qux'
+            id_field   = 'id'
+            conn       = FooTable.conn
+            fields     = ( 'id', 'baz_id' )
+            references = { 'baz_id' : Customer }
+
+        queries = []
+        set_sql_log_func(lambda cur, sql, bind_params: queries.append(sql))
+        self.addCleanup(set_sql_log_func, None)
+
+        orders = list(Order.find_by(prefetch = [ 'baz' ]))
+        self.assertEqual(len(queries), 2)
+        self.assertEqual([ order.baz and order.baz.name for order in orders[:6] ], [ 'c1', 'c2', 'c3', 'c4', 'c5', None ])
+        self.assertTrue(orders[0].baz is orders[6].baz)
+        self.assertEqual(len(queries), 2)
+
+        orders[0].baz_id = 2
+        self.assertEqual(orders[0].baz.name, 'c2')
+        self.assertEqual(len(queries), 3)
+
+        with self.assertRaises(DBTableConfigError):
+            Order.prefetch(orders, 'customer')
+
+        with self.assertRaises(DBTableConfigError):
+            class BadTable(DBTable):
+                table_name = 'qux'
+                fields     = ( 'id', 'customer' )
+                references = { 'customer' : Customer }
+
+    @skip_performance
+    def test_hydrate_performance(self):
+        class WideTable(DBTable):
+            table_name = 'wide'
+            id_field   = 'id'
+            conn       = FooTable.conn
+            fields     = ( 'id', 'name', 'tags', 'doc' ) + tuple('data{}'.format(x) for x in range(10))
+
+        row = { field : 1 for field in WideTable.fields }
+        row.update(
+            name = 'abc',
+            tags = [ 'a', 'b', 'c' ],
+            doc  = { 'a' : [ 1, 2, 3 ], 'b' : { 'c' : 'd' } },
+        )
+
+        start_time = time.time()
+        for x in range(1000000):
+            obj = WideTable(_is_in_db = True, **row)
+            obj.name
+            obj.should_update()
+        print("{:.3f}s to hydrate 1M rows".format(time.time() - start_time))
+
+    def test_dirty_tracking(self):
+        class DocTable(DBTable):
+            table_name = 'doc'
+            fields     = ( 'a', 'tags', 'doc' )
+
+        db_row = { 'a' : 1, 'tags' : [ 'x' ], 'doc' : { 'b' : [ 1 ] } }
+        obj = DocTable(_is_in_db = True, **db_row)
+        self.assertEqual(obj.changed_fields(), frozenset())
+        self.assertEqual(obj.to_dict(), db_row)
+        self.assertFalse(obj.should_update())
+
+        obj.tags.append('y')
+        obj.doc['b'].append(2)
+        self.assertEqual(obj.changed_fields(), frozenset([ 'tags', 'doc' ]))
+        self.assertEqual(db_row, { 'a' : 1, 'tags' : [ 'x' ], 'doc' : { 'b' : [ 1 ] } })
+
+        obj.a = 2
+        obj.a = 1
+        self.assertEqual(obj.changed_fields(), frozenset([ 'tags', 'doc' ]))
+
+        tags = [ 'z' ]
+        new_obj = DocTable(tags = tags)
+        tags.append('w')
+        self.assertEqual(new_obj.tags, [ 'z' ])
+
+    def test_update__in_place_changes(self):
+        execute(self.conn(), "DROP TABLE IF EXISTS baz")
+        execute(self.conn(), "CREATE TABLE baz (id SERIAL PRIMARY KEY, tags TEXT[])")
+
+        class BazTable(DBTable):
+            table_name = 'baz'
+            id_field   = 'id'
+            conn       = FooTable.conn
+            fields     = ( 'id', 'tags' )
+
+        obj = BazTable(tags = [ 'a' ]).update()
+        obj.tags.append('b')
+        obj.update()
+        BazTable.conn.commit()
+
+        self.assertEqual(BazTable.find_by_id(obj.id).tags, [ 'a', 'b' ])
+        self.assertFalse(obj.should_update())
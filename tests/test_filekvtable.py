@@ -0,0 +1,301 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from wizzat.filekvtable import *
+from wizzat.kvtable import *
+from wizzat.testutil import *
+
+class LogStoreTest(TestCase):
+    def setUp(self):
+        super(LogStoreTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.log')
+
+    def tearDown(self):
+        super(LogStoreTest, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_put_get_delete(self):
+        store = LogStore(self.path)
+        self.assertEqual(store.get('a'), (None, None))
+
+        v1 = store.put('a', b'abc')
+        v2 = store.put('b', b'def')
+        self.assertEqual(store.get('a'), (v1, b'abc'))
+        self.assertEqual(store.get('b'), (v2, b'def'))
+
+        store.delete('a')
+        self.assertEqual(store.get('a'), (None, None))
+        self.assertEqual(store.keys(), [ 'b' ])
+        store.close()
+
+    def test_cas(self):
+        store = LogStore(self.path)
+        version = store.put('a', b'abc', create = True)
+
+        with self.assertRaises(KVTableCASError):
+            store.put('a', b'abc', create = True)
+
+        new_version = store.put('a', b'def', cas = version)
+        self.assertTrue(new_version > version)
+
+        with self.assertRaises(KVTableCASError):
+            store.put('a', b'ghi', cas = version)
+        with self.assertRaises(KVTableCASError):
+            store.delete('a', cas = version)
+
+        store.delete('a', cas = new_version)
+        self.assertTrue(store.put('a', b'abc', create = True) > new_version)
+        store.close()
+
+    def test_recovery_from_hint(self):
+        store = LogStore(self.path)
+        store.put('a', b'abc')
+        store.put('b', b'def')
+        store.delete('b')
+        store.close()
+
+        self.assertTrue(os.path.exists(self.path + '.hint'))
+        store = LogStore(self.path)
+        store.put('c', b'ghi')
+        store.segment = os.close(store.segment.fd) # Simulate a crash after the hint was written
+
+        store = LogStore(self.path)
+        self.assertEqual(sorted(store.keys()), [ 'a', 'c' ])
+        self.assertEqual(store.get('c')[1], b'ghi')
+        store.close()
+
+    def test_recovery_truncates_torn_tail(self):
+        store = LogStore(self.path)
+        store.put('a', b'abc')
+        store.put('b', b'def')
+        size = store.segment.size
+        store.segment = os.close(store.segment.fd)
+
+        with open(self.path, 'ab') as fp:
+            fp.write(b'\x01\x02\x03\x04\x05\x06\x07')
+
+        store = LogStore(self.path)
+        self.assertEqual(sorted(store.keys()), [ 'a', 'b' ])
+        self.assertEqual(store.segment.size, size)
+        self.assertEqual(os.path.getsize(self.path), size)
+        store.close()
+
+    def test_only_one_process(self):
+        store = LogStore(self.path)
+        with self.assertRaises(IOError):
+            LogStore(self.path)
+        store.close()
+
+    def test_compaction(self):
+        store = LogStore(self.path, compact_ratio = 0)
+        for x in range(100):
+            store.put('key', b'x' * 1000)
+        store.put('other', b'abc')
+        size = store.segment.size
+
+        self.assertTrue(store.dead_bytes > 99 * 1000)
+        store.compact()
+
+        self.assertTrue(store.segment.size < size // 50)
+        self.assertEqual(store.get('key')[1], b'x' * 1000)
+        self.assertEqual(store.get('other')[1], b'abc')
+        self.assertEqual(os.path.getsize(self.path), store.segment.size)
+        store.close()
+
+        store = LogStore(self.path)
+        self.assertEqual(sorted(store.keys()), [ 'key', 'other' ])
+        store.close()
+
+    def test_concurrent_readers_and_writers(self):
+        store = LogStore(self.path, compact_min_bytes = 4096)
+        errors = []
+
+        def writer(prefix):
+            for x in range(500):
+                store.put('{}/{}'.format(prefix, x % 10), str(x).encode('utf8'))
+
+        def reader():
+            for x in range(2000):
+                version, value = store.get('w0/{}'.format(x % 10))
+                if value is not None and not value.isdigit():
+                    errors.append(value)
+
+        threads = [ threading.Thread(target=writer, args=('w{}'.format(x),)) for x in range(2) ]
+        threads.extend(threading.Thread(target=reader) for _ in range(4))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        store.close()
+        self.assertEqual(errors, [])
+
+        store = LogStore(self.path)
+        self.assertEqual(len(store), 20)
+        self.assertEqual(store.get('w1/9')[1], b'499')
+        store.close()
+
+class FileKVTableTest(TestCase):
+    def setUp(self):
+        super(FileKVTableTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+
+        class C(FileKVTable):
+            table_name = 'tbl'
+            path       = os.path.join(self.dir, 'tbl.log')
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1', 'data1' ]
+
+        self.cls = C
+
+    def tearDown(self):
+        super(FileKVTableTest, self).tearDown()
+        FileKVTable.close_stores()
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        obj = self.cls.create(1, data1 = 'abc')
+        self.assertEqual(self.cls.find_by_key(1)._data, { 'key1' : 1, 'data1' : 'abc' })
+
+        obj.data1 = 'def'
+        obj.update()
+        FileKVTable.close_stores()
+
+        self.assertEqual(self.cls.find_by_key(1).data1, 'def')
+        self.cls.find_by_key(1).delete()
+        self.assertEqual(self.cls.find_by_key(1), None)
+
+    def test_stale_objects_raise(self):
+        self.cls.create(1, data1 = 'abc')
+        obj1 = self.cls.find_by_key(1)
+        obj2 = self.cls.find_by_key(1)
+
+        obj1.data1 = 'def'
+        obj1.update()
+
+        obj2.data1 = 'ghi'
+        with self.assertRaises(KVTableCASError):
+            obj2.update()
+
+        with self.assertRaises(KVTableCASError):
+            self.cls.create(1)
+
+        self.assertEqual(self.cls.find_by_key(1).data1, 'def')
+
+    def test_indexes(self):
+        class C(FileKVTable):
+            table_name = 'indexed'
+            path       = self.cls.path
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1', 'email' ]
+            indexes    = [ ('email',) ]
+
+        C.create(1, email = 'a@x.com')
+        obj = C.create(2, email = 'a@x.com')
+        self.assertEqual(sorted(obj.key1 for obj in C.find_by_index('email', 'a@x.com')), [ 1, 2 ])
+
+        obj.email = 'b@x.com'
+        obj.update()
+        FileKVTable.close_stores()
+
+        self.assertEqual([ obj.key1 for obj in C.find_by_index('email', 'a@x.com') ], [ 1 ])
+        self.assertEqual([ obj.key1 for obj in C.find_by_index('email', 'b@x.com') ], [ 2 ])
+
+    def test_update_with__concurrent_increments(self):
+        self.cls.create(1, data1 = 0)
+
+        def incr(obj):
+            obj.data1 += 1
+
+        def worker():
+            for _ in range(50):
+                self.cls.update_with(1, incr, max_retries = 100, backoff = 0.0001)
+
+        threads = [ threading.Thread(target=worker) for _ in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.cls.find_by_key(1).data1, 200)
+
+    def test_ttl(self):
+        self.cls.ttl = 0.05
+        obj = self.cls.create(1, data1 = 'abc')
+        self.assertTrue(obj._kv_data[1] > 0)
+        self.assertEqual(self.cls.find_by_key(1).data1, 'abc')
+
+        FileKVTable.close_stores()
+        time.sleep(0.1)
+
+        self.assertEqual(self.cls.find_by_key(1), None)
+        self.assertEqual(self.cls.create(1, data1 = 'def').data1, 'def')
+
+class LogStoreExpiryTest(TestCase):
+    def setUp(self):
+        super(LogStoreExpiryTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.log')
+
+    def tearDown(self):
+        super(LogStoreExpiryTest, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_expired_keys_are_reclaimed(self):
+        store = LogStore(self.path, compact_ratio = 0)
+        store.expiry_wheel = TimingWheel(resolution = 0.01)
+        store.put('a', b'abc', expires_at = time.time() + 0.02)
+        store.put('b', b'def')
+        self.assertEqual(store.lookup('a')[1:], (b'abc', store.segment.index['a'][4]))
+
+        time.sleep(0.05)
+        self.assertEqual(store.get('a'), (None, None))
+        self.assertEqual(store.keys(), [ 'b' ])
+        self.assertEqual(len(store), 2)
+
+        store.put('c', b'ghi')
+        self.assertEqual(len(store), 2)
+        self.assertTrue(store.dead_bytes > 0)
+        store.close()
+
+    def test_expiry_survives_reopening_and_compaction(self):
+        store = LogStore(self.path, compact_ratio = 0)
+        store.put('a', b'abc', expires_at = time.time() + 60)
+        store.put('b', b'def', expires_at = time.time() + 0.02)
+        store.close()
+
+        store = LogStore(self.path, compact_ratio = 0)
+        self.assertEqual(len(store.expiry_wheel), 2)
+        time.sleep(0.05)
+        store.compact()
+
+        self.assertEqual(store.keys(), [ 'a' ])
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get('a')[1], b'abc')
+        store.close()
+
+    def test_upgrades_version_1_files(self):
+        store = LogStore(self.path)
+        store.put('a', b'abc')
+        store.close()
+        os.unlink(self.path + '.hint')
+
+        with open(self.path, 'r+b') as fp:
+            magic, format_version, generation = LogStore.header_struct.unpack(fp.read(LogStore.header_struct.size))
+            fp.seek(0)
+            fp.write(LogStore.header_struct.pack(magic, 1, generation))
+
+        store = LogStore(self.path)
+        self.assertEqual(store.get('a')[1], b'abc')
+        store.close()
+
+        with open(self.path, 'rb') as fp:
+            self.assertEqual(LogStore.header_struct.unpack(fp.read(LogStore.header_struct.size))[1], 2)
@@ -0,0 +1,216 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import psycopg2
+import tempfile
+import time
+from wizzat.invalidation import *
+from wizzat.kvtable import *
+from wizzat.pghelper import *
+from wizzat.testutil import *
+from wizzat.util import *
+from testcase import DBTestCase
+
+class InvalidationBusTestMixin(object):
+    def new_table(self, bus, kv_store):
+        class C(DictKVTable):
+            table_name       = 'tbl'
+            memoize          = True
+            invalidation_bus = bus
+            key_fields       = [ 'key1' ]
+            fields           = [ 'key1', 'data1' ]
+
+        C.kv_store = kv_store
+        return C
+
+    def test_writes_evict_remote_caches(self):
+        kv_store = {}
+        writer = self.new_table(self.bus1, kv_store)
+        reader = self.new_table(self.bus2, kv_store)
+
+        obj = writer.create(1, data1 = 'abc')
+        self.assertEqual(reader.find_by_key(1).data1, 'abc')
+        self.assertEqual(list(reader.key_cache.keys()), [ 'tbl/1' ])
+
+        obj.data1 = 'def'
+        obj.update()
+        self.assertEqual(self.bus2.poll(), 1)
+        self.assertEqual(list(reader.key_cache.keys()), [])
+        self.assertEqual(reader.find_by_key(1).data1, 'def')
+
+    def test_own_writes_are_ignored(self):
+        writer = self.new_table(self.bus1, {})
+        writer.create(1, data1 = 'abc')
+
+        self.assertEqual(self.bus1.poll(), 0)
+        self.assertEqual(list(writer.key_cache.keys()), [ 'tbl/1' ])
+
+    def test_bursts_are_coalesced(self):
+        self.bus1.batch_size = 1000
+        self.bus1.flush_interval = 60
+
+        for _ in range(100):
+            self.bus1.publish('tbl', 'tbl/1')
+            self.bus1.publish('tbl', 'tbl/2')
+        self.bus1.flush()
+
+        self.assertEqual(self.bus2.poll(), 2)
+
+    def test_pending_invalidations_are_flushed_by_a_timer(self):
+        self.bus1.batch_size = 1000
+        self.bus1.flush_interval = 0.05
+        self.bus1.last_flush = time.time()
+
+        self.bus1.publish('tbl', 'tbl/1')
+        self.assertEqual(self.bus2.poll(), 0)
+
+        for _ in range(100):
+            time.sleep(0.01)
+            if not self.bus1.pending:
+                break
+
+        self.assertEqual(self.bus2.poll(), 1)
+
+    def test_whole_table_invalidation(self):
+        kv_store = {}
+        writer = self.new_table(self.bus1, kv_store)
+        reader = self.new_table(self.bus2, kv_store)
+
+        writer.create(1, data1 = 'abc')
+        writer.create(2, data1 = 'abc')
+        reader.find_by_key(1)
+        reader.find_by_key(2)
+        self.bus2.poll()
+
+        self.bus1.publish('tbl', None)
+        self.bus2.poll()
+        self.assertEqual(list(reader.key_cache.keys()), [])
+
+class UnixSocketBusTest(InvalidationBusTestMixin, TestCase):
+    def setUp(self):
+        super(UnixSocketBusTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.bus1 = UnixSocketBus(self.path)
+        self.bus2 = UnixSocketBus(self.path)
+
+    def tearDown(self):
+        super(UnixSocketBusTest, self).tearDown()
+        self.bus1.close()
+        self.bus2.close()
+        os.rmdir(self.path)
+
+class MmapRingBusTest(InvalidationBusTestMixin, TestCase):
+    def setUp(self):
+        super(MmapRingBusTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.bus1 = MmapRingBus(os.path.join(self.path, 'ring'), slots = 4)
+        self.bus2 = MmapRingBus(os.path.join(self.path, 'ring'))
+
+    def tearDown(self):
+        super(MmapRingBusTest, self).tearDown()
+        self.bus1.close()
+        self.bus2.close()
+        os.unlink(os.path.join(self.path, 'ring'))
+        os.rmdir(self.path)
+
+    def test_overflow_clears_caches(self):
+        kv_store = {}
+        writer = self.new_table(self.bus1, kv_store)
+        reader = self.new_table(self.bus2, kv_store)
+
+        writer.create(1, data1 = 'abc')
+        reader.find_by_key(1)
+        self.bus2.poll()
+
+        for x in range(10):
+            self.bus1.publish('tbl', 'tbl/other/{}'.format(x))
+
+        self.bus2.poll()
+        self.assertEqual(list(reader.key_cache.keys()), [])
+
+class PgNotifyBusTest(DBTestCase):
+    def new_conn(self, autocommit = True, **kwargs):
+        # Outside of db_mgr, whose small pool is shared with the other database tests
+        conn_info = { k : v for k, v in self.db_info.items() if k not in ('minconn', 'maxconn') }
+        conn = psycopg2.connect(**dict(conn_info, **kwargs))
+        conn.autocommit = autocommit
+        self.addCleanup(conn.close)
+        return conn
+
+    def new_bus(self):
+        bus = PgNotifyBus(self.new_conn())
+        self.addCleanup(bus.close)
+        return bus
+
+    def test_notifications_are_delivered_on_commit(self):
+        publisher = self.new_bus()
+        bus = self.new_bus()
+        evicted = []
+
+        class FakeTable(object):
+            table_name = 'tbl'
+
+            @classmethod
+            def evict_cached(cls, key):
+                evicted.append(key)
+
+        bus.register(FakeTable)
+
+        write_conn = self.new_conn(autocommit = False)
+        publisher.publish('tbl', 1, conn = write_conn)
+        publisher.publish('tbl', 1, conn = write_conn)
+        bus.poll()
+        self.assertEqual(evicted, [])
+
+        write_conn.commit()
+        for _ in range(100):
+            bus.poll()
+            if evicted:
+                break
+            time.sleep(0.01) # NOTIFY is delivered asynchronously
+
+        self.assertEqual(evicted, [ 1 ])
+
+    def test_transaction_notifications_are_sent_together_before_commit(self):
+        publisher = self.new_bus()
+        listen_conn = self.new_conn()
+        execute(listen_conn, 'LISTEN wizzat_invalidation')
+
+        write_conn = self.new_conn(autocommit = False, connection_factory = TransactionConnection)
+        for key in [ 1, 2, 1, 3 ]:
+            publisher.publish('tbl', key, conn = write_conn)
+        self.assertEqual(len(publisher.transactions[write_conn]), 3)
+
+        write_conn.commit()
+        self.assertEqual(publisher.transactions, {})
+
+        for _ in range(100):
+            listen_conn.poll()
+            if listen_conn.notifies:
+                break
+            time.sleep(0.01) # NOTIFY is delivered asynchronously
+
+        self.assertEqual([ json.loads(n.payload)[1] for n in listen_conn.notifies ], [
+            [ '["tbl", 1]', '["tbl", 2]', '["tbl", 3]' ],
+        ])
+
+    def test_rolled_back_notifications_are_dropped(self):
+        publisher = self.new_bus()
+        write_conn = self.new_conn(autocommit = False, connection_factory = TransactionConnection)
+
+        publisher.publish('tbl', 1, conn = write_conn)
+        write_conn.rollback()
+        self.assertEqual(publisher.transactions, {})
+
+    def test_close_unregisters_transaction_listeners(self):
+        publisher = PgNotifyBus(self.new_conn())
+        write_conn = self.new_conn(autocommit = False, connection_factory = TransactionConnection)
+        publisher.close()
+
+        publisher.publish('tbl', 1, conn = write_conn)
+        write_conn.commit()
+        self.assertEqual(len(publisher.transactions[write_conn]), 1) # Not flushed by the commit
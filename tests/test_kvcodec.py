@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import random
+import six
+import time
+from wizzat.kvcodec import *
+from wizzat.kvtable import *
+from wizzat.testutil import *
+from wizzat.decorators import skip_performance
+
+class C(DictKVTable):
+    table_name  = 'tbl'
+    key_fields  = [ 'key1' ]
+    fields      = [ 'key1', 'count', 'ratio', 'flag', 'name', 'blob', 'ids', 'id_set', 'meta' ]
+    field_types = {
+        'key1'   : int,
+        'count'  : int,
+        'ratio'  : float,
+        'flag'   : bool,
+        'name'   : six.text_type,
+        'blob'   : six.binary_type,
+        'ids'    : [ int ],
+        'id_set' : { int },
+    }
+    codec    = BinaryCodec(compress_threshold = 256)
+    kv_store = {}
+
+class BinaryCodecTest(TestCase):
+    doc = {
+        'key1'   : 1,
+        'count'  : 2**40,
+        'ratio'  : 0.5,
+        'flag'   : True,
+        'name'   : 'abcé',
+        'blob'   : b'\x00\x01',
+        'ids'    : [ 3, 1, 2, 2 ],
+        'id_set' : { 1, 2, 3 },
+        'meta'   : { 'a' : [ 1, 2 ] },
+    }
+
+    def test_round_trip(self):
+        content = C._codec.encode(self.doc)
+        self.assertEqual(bytearray(content[:1])[0], BinaryCodec.magic)
+        self.assertEqual(C._codec.decode(content), self.doc)
+
+    def test_nulls_and_extras(self):
+        doc = { field : None for field in C.fields }
+        doc['extra'] = 'abc'
+        self.assertEqual(C._codec.decode(C._codec.encode(doc)), doc)
+
+    def test_decodes_json(self):
+        content = json.dumps({ 'key1' : 1, 'name' : 'abc' })
+        self.assertEqual(C._codec.decode(content), { 'key1' : 1, 'name' : 'abc' })
+        self.assertEqual(C._codec.decode(content.encode('utf8')), { 'key1' : 1, 'name' : 'abc' })
+
+    def test_falls_back_to_json_for_mismatched_types(self):
+        doc = dict(self.doc, count = 'many', id_set = [ 1 ], blob = None)
+        content = C._codec.encode(doc)
+        self.assertEqual(content[:1], b'{')
+        self.assertEqual(C._codec.decode(content), doc)
+
+    def test_compression(self):
+        small = C._codec.encode(self.doc)
+        large = C._codec.encode(dict(self.doc, ids = list(range(1000))))
+
+        self.assertFalse(bytearray(small)[2] & BinaryCodec.flag_zlib)
+        self.assertTrue(bytearray(large)[2] & BinaryCodec.flag_zlib)
+        self.assertEqual(C._codec.decode(large)['ids'], list(range(1000)))
+
+    def test_appended_fields(self):
+        old_codec = BinaryCodec(fields = [ 'key1', 'count' ], field_types = C.field_types)
+        content = old_codec.encode({ 'key1' : 1, 'count' : 2 })
+
+        self.assertEqual(C._codec.decode(content), dict(
+            { field : None for field in C.fields },
+            key1  = 1,
+            count = 2,
+        ))
+
+        with self.assertRaises(CodecError):
+            old_codec.decode(C._codec.encode(self.doc))
+
+    def test_iterencode(self):
+        codec = JSONCodec()
+        doc = dict(self.doc, blob = None, id_set = None)
+        chunks = list(codec.iterencode(doc))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(codec.decode(b''.join(chunks)), doc)
+        self.assertEqual(list(C._codec.iterencode(self.doc)), [ C._codec.encode(self.doc) ])
+
+    def test_dict_kv_table(self):
+        C.kv_store.clear()
+        obj = C.create(1, name = 'abc', ids = [ 1, 2 ])
+
+        self.assertTrue(isinstance(C.kv_store['tbl/1'], six.binary_type))
+        self.assertEqual(C.find_by_key(1)._data, obj._data)
+
+    @skip_performance
+    def test_binary_vs_json_performance(self):
+        doc = {
+            'key1'   : 1,
+            'count'  : 12345,
+            'ratio'  : 0.25,
+            'flag'   : False,
+            'name'   : 'some name',
+            'blob'   : None,
+            'ids'    : [ random.randint(0, 2**32) for _ in range(500) ],
+            'id_set' : set(random.randint(0, 2**20) for _ in range(500)),
+            'meta'   : { 'a' : 'b' },
+        }
+        json_doc = dict(doc, id_set = sorted(doc['id_set']))
+
+        for name, codec, value in [ ('json', JSONCodec(), json_doc), ('binary', C._codec, doc) ]:
+            content = codec.encode(value)
+
+            start_time = time.time()
+            for _ in range(10000):
+                codec.decode(content)
+            duration = time.time() - start_time
+
+            print("{}: {} bytes, {:.3f}s for 10k decodes".format(name, len(content), duration))
@@ -3,16 +3,21 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import six
+import threading
+import time
 from wizzat.kvtable import *
 from wizzat.testutil import *
+from wizzat.decorators import skip_performance
 from wizzat.util import *
 from testcase import DBTestCase
 
 class KVTableTest(DBTestCase):
-    def new_subclass(self, keys = None, data_fields = None, memoize_cls = False, tbl_name = 'tbl'):
+    def new_subclass(self, keys = None, data_fields = None, memoize_cls = False, tbl_name = 'tbl', slots_cls = False):
         class C(DictKVTable):
             table_name = tbl_name
             memoize    = memoize_cls
+            slots      = slots_cls
             key_fields = keys or [
                 'key1',
                 'key2',
@@ -32,6 +37,20 @@ class KVTableTest(DBTestCase):
 
         return C
 
+    def new_subclass_of(self, base, **kwargs):
+        class C(base):
+            table_name = base.table_name
+            key_fields = base.key_fields
+            fields     = base.fields
+            kv_store   = {}
+            memoize    = kwargs.get('memoize', False)
+
+            memoize_ttl        = kwargs.get('memoize_ttl', 0)
+            memoize_max_stale  = kwargs.get('memoize_max_stale', 0)
+            memoize_revalidate = kwargs.get('memoize_revalidate', False)
+
+        return C
+
     def test_key_func(self):
         cls = self.new_subclass()
         self.assertEqual(cls.key_func([ 1, 2 ]), 'tbl/1/2')
@@ -40,6 +59,52 @@ class KVTableTest(DBTestCase):
         with self.assertRaises(ValueError):
             cls.key_func([ 1, ])
 
+    def test_key_func__field_types(self):
+        cls = self.new_subclass()
+        cls.field_types = { 'key1' : int }
+        cls = self.new_subclass_of(cls)
+
+        self.assertEqual(cls.key_func([ 1, 'abc' ]), 'tbl/1/abc')
+        self.assertEqual(cls.key_func([ 5.7, 'abc' ]), 'tbl/5.7/abc')
+        self.assertEqual(cls.key_func([ '5', 'abc' ]), 'tbl/5/abc')
+
+    def test_key_func__inherited(self):
+        class A(DictKVTable):
+            table_name = 'a'
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1' ]
+            kv_store   = {}
+
+            @classmethod
+            def key_func(cls, args):
+                return 'custom/{}'.format(args[0])
+
+        class B(A):
+            table_name = 'b'
+            fields     = A.fields
+
+        class C(DictKVTable):
+            table_name = 'c'
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1' ]
+
+        class D(C):
+            table_name = 'd'
+            fields     = C.fields
+
+        self.assertEqual(B.key_func([ 1 ]), 'custom/1')
+        self.assertEqual(D.key_func([ 1 ]), 'd/1')
+
+    def test_key_func__interning(self):
+        cls = self.new_subclass()
+        cls.key_intern_size = 2
+        cls = self.new_subclass_of(cls)
+
+        self.assertTrue(cls.key_func([ 1, 2 ]) is cls.key_func([ 1, 2 ]))
+        cls.key_func([ 1, 3 ])
+        cls.key_func([ 1, 4 ])
+        self.assertEqual(list(cls.interned_keys.keys()), [ 'tbl/1/4' ])
+
     def test_keys_must_be_fields(self):
         with self.assertRaises(KVTableConfigError):
             cls = self.new_subclass([ 'key', ], [ 'data' ])
@@ -149,3 +214,365 @@ class KVTableTest(DBTestCase):
         )
 
         self.assertTrue(obj1 is not obj3)
+
+    def test_changed_fields(self):
+        cls = self.new_subclass()
+        obj = cls.find_or_create(1,2, data1 = 'abc')
+        self.assertEqual(obj.changed_fields(), frozenset())
+
+        obj.data1 = 'abc'
+        self.assertEqual(obj.changed_fields(), frozenset())
+
+        obj.data1 = 'def'
+        obj.data2 = 5
+        self.assertEqual(obj.changed_fields(), frozenset([ 'data1', 'data2' ]))
+
+        obj.update()
+        self.assertEqual(obj.changed_fields(), frozenset())
+
+    def test_delta_updates(self):
+        cls = self.new_subclass()
+        cls.delta_updates = True
+
+        obj = cls.find_or_create(1,2, data1 = 'abc')
+        cls.kv_store['tbl/1/2'] = dict(cls.kv_store['tbl/1/2'], data2 = 'concurrent')
+
+        obj.data1 = 'def'
+        obj.update()
+
+        self.assertEqual(cls.kv_store['tbl/1/2'], {
+            'key1'  : 1,
+            'key2'  : 2,
+            'data1' : 'def',
+            'data2' : 'concurrent',
+        })
+
+    def test_delta_updates__read_modify_write(self):
+        cls = self.new_subclass()
+        cls.delta_updates = True
+        cls._update_fields = KVTable._update_fields
+
+        obj = cls.find_or_create(1,2, data1 = 'abc')
+        cls.kv_store['tbl/1/2'] = dict(cls.kv_store['tbl/1/2'], data2 = 'concurrent')
+
+        obj.data1 = 'def'
+        obj.update()
+
+        self.assertEqual(obj.data2, 'concurrent')
+        self.assertEqual(cls.kv_store['tbl/1/2'], {
+            'key1'  : 1,
+            'key2'  : 2,
+            'data1' : 'def',
+            'data2' : 'concurrent',
+        })
+
+    def test_slots(self):
+        cls = self.new_subclass(slots_cls = True)
+        obj = cls.find_or_create(1,2, data1 = 'abc')
+
+        self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertEqual(obj.data1, 'abc')
+        self.assertEqual(obj.data2, 3)
+        self.assertEqual(obj._data, {
+            'key1'  : 1,
+            'key2'  : 2,
+            'data1' : 'abc',
+            'data2' : 3,
+        })
+
+        obj.data1 = 'def'
+        self.assertEqual(obj.changed_fields(), frozenset([ 'data1' ]))
+        with self.assertRaises(KVTableImmutableFieldError):
+            obj.key1 = 2
+
+        obj.update()
+        self.assertEqual(cls.kv_store['tbl/1/2']['data1'], 'def')
+        self.assertEqual(cls.find_by_key(1, 2).data1, 'def')
+
+    @skip_performance
+    def test_construction_performance(self):
+        fields = [ 'key' ] + [ 'data{}'.format(x) for x in range(50) ]
+        data = { field : 1 for field in fields }
+
+        for slots_cls in (False, True):
+            cls = self.new_subclass([ 'key' ], fields, slots_cls = slots_cls)
+
+            start_time = time.time()
+            for _ in range(100000):
+                obj = cls(key = 'tbl/1', data = dict(data))
+                obj.data49
+            duration = time.time() - start_time
+
+            print("slots={}: {:.3f}s for 100k objects".format(slots_cls, duration))
+
+    @skip_performance
+    def test_key_func_performance(self):
+        cls = self.new_subclass()
+        legacy_key_func = lambda args: '{table_name}/{key}'.format(
+            table_name = cls.table_name,
+            key = '/'.join(six.text_type(x) for x in args[:len(cls.key_fields)])
+        )
+
+        cls.key_intern_size = 1000
+        interned_cls = self.new_subclass_of(cls)
+
+        for name, func in [ ('legacy', legacy_key_func), ('compiled', cls.key_func), ('interned', interned_cls.key_func) ]:
+            start_time = time.time()
+            for x in range(1000000):
+                func((x % 1000, 2))
+            duration = time.time() - start_time
+
+            print("{}: {:.3f}s for 1M keys".format(name, duration))
+
+    def test_memoize__ttl(self):
+        cls = self.new_subclass_of(self.new_subclass(), memoize = True, memoize_ttl = 0.05)
+        obj1 = cls.find_or_create(1,2)
+        self.assertTrue(cls.find_by_key(1,2) is obj1)
+
+        time.sleep(0.1)
+        obj2 = cls.find_by_key(1,2)
+        self.assertTrue(obj2 is not obj1)
+        self.assertTrue(cls.find_by_key(1,2) is obj2)
+
+    def test_memoize__max_stale(self):
+        cls = self.new_subclass_of(self.new_subclass(), memoize = True, memoize_max_stale = 0.05)
+        obj1 = cls.find_or_create(1,2)
+        self.assertTrue(cls.find_by_key(1,2) is obj1)
+
+        time.sleep(0.1)
+        self.assertTrue(cls.find_by_key(1,2) is not obj1)
+
+    def test_memoize__revalidate(self):
+        cls = self.new_subclass_of(self.new_subclass(), memoize = True, memoize_max_stale = 0.05, memoize_revalidate = True)
+        cls.cas_versions = True
+        cls._kv_cas = classmethod(lambda cls, kv_data: 'cas')
+        cls._find_cas_by_key = classmethod(lambda cls, kv_key: 'cas')
+        obj1 = cls.find_or_create(1,2)
+
+        time.sleep(0.1)
+        self.assertTrue(cls.find_by_key(1,2) is obj1)
+
+        cls._find_cas_by_key = classmethod(lambda cls, kv_key: 'new cas')
+        time.sleep(0.1)
+        self.assertTrue(cls.find_by_key(1,2) is not obj1)
+
+    def test_memoize__revalidate_without_cas(self):
+        cls = self.new_subclass_of(self.new_subclass(), memoize = True, memoize_max_stale = 0.05, memoize_revalidate = True)
+        obj1 = cls.find_or_create(1, 2, data1 = 1)
+        cls.kv_store['tbl/1/2'] = dict(cls.kv_store['tbl/1/2'], data1 = 99)
+
+        time.sleep(0.1)
+        self.assertEqual(cls.find_by_key(1,2).data1, 99)
+
+    def test_memoize__delete_uncaches(self):
+        cls = self.new_subclass(memoize_cls = True)
+        obj = cls.find_or_create(1,2)
+        obj.delete()
+
+        self.assertEqual(list(cls.key_cache.keys()), [])
+        self.assertEqual(cls.find_by_key(1,2), None)
+
+    def test_memoize__failed_update_uncaches(self):
+        cls = self.new_subclass(memoize_cls = True)
+        obj = cls.find_or_create(1,2)
+
+        def fail(self, force = False):
+            raise KVTableError()
+        cls._update = fail
+
+        obj.data1 = 'abc'
+        with self.assertRaises(KVTableError):
+            obj.update()
+
+        self.assertEqual(list(cls.key_cache.keys()), [])
+
+    def new_indexed_subclass(self):
+        class C(DictKVTable):
+            table_name = 'tbl'
+            key_fields = [ 'key1' ]
+            fields     = [ 'key1', 'email', 'first', 'last' ]
+            indexes    = [ ('email',), ('first', 'last') ]
+            kv_store   = {}
+
+        return C
+
+    def test_indexes(self):
+        cls = self.new_indexed_subclass()
+        obj1 = cls.create(1, email = 'a@x.com', first = 'a', last = 'b')
+        obj2 = cls.create(2, email = 'a@x.com', first = 'c', last = 'b')
+        cls.create(3)
+
+        self.assertEqual(sorted(obj.key1 for obj in cls.find_by_index('email', 'a@x.com')), [ 1, 2 ])
+        self.assertEqual([ obj.key1 for obj in cls.find_by_index('first,last', ('c', 'b')) ], [ 2 ])
+        self.assertEqual(cls.kv_store['tbl.idx.email/a@x.com'], { 'email' : 'a@x.com', 'keys' : [ 'tbl/1', 'tbl/2' ] })
+
+        obj2 = cls.find_by_key(2)
+        obj2.email = 'b@x.com'
+        obj2.update()
+
+        self.assertEqual([ obj.key1 for obj in cls.find_by_index('email', 'a@x.com') ], [ 1 ])
+        self.assertEqual([ obj.key1 for obj in cls.find_by_index('email', 'b@x.com') ], [ 2 ])
+
+        obj1.delete()
+        self.assertEqual(cls.find_by_index('email', 'a@x.com'), [])
+        self.assertFalse('tbl.idx.email/a@x.com' in cls.kv_store)
+        self.assertFalse('tbl.idx.first.last/a/b' in cls.kv_store)
+
+        with self.assertRaises(KVTableError):
+            cls.find_by_index('nope', 1)
+
+    def test_indexes__stale_entries_are_filtered(self):
+        cls = self.new_indexed_subclass()
+        cls.create(1, email = 'a@x.com')
+        cls.kv_store['tbl/1']['email'] = 'b@x.com'
+
+        self.assertEqual(cls.find_by_index('email', 'a@x.com'), [])
+
+    def test_indexes__must_be_fields(self):
+        with self.assertRaises(KVTableConfigError):
+            class C(DictKVTable):
+                table_name = 'tbl'
+                key_fields = [ 'key1' ]
+                fields     = [ 'key1' ]
+                indexes    = [ ('email',) ]
+
+    def test_indexes__cas_conflicts_are_retried(self):
+        cls = self.new_indexed_subclass()
+        index_cls = cls.index_classes['email']
+        conflicts = [ 2 ]
+
+        def find_by_key(*keys):
+            if conflicts[0]:
+                conflicts[0] -= 1
+                raise KVTableCASError()
+            return DictKVTable.find_by_key.__func__(index_cls, *keys)
+        index_cls.find_by_key = staticmethod(find_by_key)
+
+        cls.create(1, email = 'a@x.com')
+        self.assertEqual([ obj.key1 for obj in cls.find_by_index('email', 'a@x.com') ], [ 1 ])
+
+        conflicts[0] = cls.index_cas_retries + 1
+        with self.assertRaises(KVTableCASError):
+            cls.create(2, email = 'a@x.com')
+
+    def test_find_by_kv_keys(self):
+        cls = self.new_subclass(memoize_cls = True)
+        obj1 = cls.create(1, 2)
+        cls.create(1, 3)
+        cls.clear_cache()
+        cls.find_by_key(1, 2)
+
+        objs = cls.find_by_kv_keys([ 'tbl/1/3', 'tbl/1/4', 'tbl/1/2' ])
+        self.assertEqual([ obj._key for obj in objs ], [ 'tbl/1/3', 'tbl/1/2' ])
+        self.assertTrue(objs[1] is cls.find_by_key(1, 2))
+
+    def test_update_with(self):
+        cls = self.new_subclass()
+        ContentionResults.clear()
+
+        def incr(obj):
+            obj.data1 = (obj.data1 or 0) + 1
+
+        self.assertEqual(cls.update_with([ 1, 2 ], incr).data1, 1)
+        self.assertEqual(cls.update_with([ 1, 2 ], incr).data1, 2)
+        self.assertEqual(cls.find_by_key(1, 2).data1, 2)
+        self.assertEqual(cls.update_with([ 1, 3 ], incr, create = False), None)
+        self.assertEqual(cls.find_by_key(1, 3), None)
+
+        cls.update_with([ 1, 2 ], lambda obj: False)
+        self.assertEqual(ContentionResults.stats['tbl']['calls'], 4)
+
+    def test_update_with__conflicts_are_retried(self):
+        cls = self.new_subclass()
+        ContentionResults.clear()
+        conflicts = [ 2 ]
+
+        def incr(obj):
+            obj.data1 = (obj.data1 or 0) + 1
+            if conflicts[0]:
+                conflicts[0] -= 1
+                raise KVTableCASError()
+
+        self.assertEqual(cls.update_with([ 1, 2 ], incr, backoff = 0).data1, 1)
+        self.assertEqual(ContentionResults.stats['tbl']['conflicts'], 2)
+        self.assertEqual(ContentionResults.hot_keys('tbl'), [ ('tbl/1/2', 2) ])
+
+        conflicts[0] = 4
+        with self.assertRaises(KVTableContentionError):
+            cls.update_with([ 1, 2 ], incr, max_retries = 3, backoff = 0)
+
+        self.assertEqual(ContentionResults.stats['tbl']['failures'], 1)
+        self.assertTrue('tbl/1/2' in ContentionResults.format_stats())
+
+    def test_update_with__declined_creates_are_not_cached(self):
+        cls = self.new_subclass(memoize_cls = True)
+
+        self.assertEqual(cls.update_with([ 1, 2 ], lambda obj: False).data1, None)
+        self.assertEqual(cls.find_by_key(1, 2), None)
+
+        def fail(obj):
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            cls.update_with([ 1, 3 ], fail)
+        self.assertEqual(cls.find_by_key(1, 3), None)
+
+    def test_update_with__stats_are_thread_safe(self):
+        cls = self.new_subclass()
+        ContentionResults.clear()
+
+        def worker(key2):
+            for _ in range(200):
+                cls.update_with([ 1, key2 ], lambda obj: False)
+
+        threads = [ threading.Thread(target = worker, args = (key2,)) for key2 in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(ContentionResults.stats['tbl']['calls'], 1600)
+
+    def test_ttl(self):
+        cls = self.new_subclass_of(self.new_subclass(), memoize = True)
+        cls.ttl = 0.05
+        obj = cls.create(1, 2)
+        cls.create(1, 3).set_ttl(0).update(force = True)
+
+        self.assertTrue(isinstance(cls.kv_store['tbl/1/2'], ExpiringValue))
+        self.assertTrue(cls.find_by_key(1, 2) is obj)
+
+        time.sleep(0.1)
+        self.assertEqual(cls.find_by_key(1, 2), None)
+        self.assertEqual(cls.find_by_key(1, 3).key2, 3)
+        self.assertFalse('tbl/1/2' in cls.kv_store)
+
+    def test_ttl__reclaimed_by_timing_wheel(self):
+        cls = self.new_subclass()
+        cls.kv_store = kv_store = {}
+        cls.expiry_wheel = TimingWheel(resolution = 0.01)
+
+        for key2 in range(10):
+            cls.create(1, key2).set_ttl(0.02).update(force = True)
+        self.assertEqual(len(kv_store), 10)
+
+        time.sleep(0.05)
+        cls.create(2, 2)
+        self.assertEqual(list(kv_store), [ 'tbl/2/2' ])
+        self.assertEqual(len(cls.expiry_wheel), 0)
+
+    def test_timing_wheel(self):
+        wheel = TimingWheel(resolution = 1, slots = 4)
+        now = wheel.tick
+
+        wheel.add('a', now + 0.5)
+        wheel.add('b', now + 2.5)
+        wheel.add('c', now + 6.5)   # One turn of the wheel later
+        wheel.add('d', now - 10)    # Already expired
+
+        self.assertEqual(wheel.expired(now + 0.9), [])
+        self.assertEqual(sorted(wheel.expired(now + 1)), [ 'a', 'd' ])
+        self.assertEqual(wheel.expired(now + 3), [ 'b' ])
+        self.assertEqual(wheel.expired(now + 5), [])
+        self.assertEqual(wheel.expired(now + 100), [ 'c' ])
+        self.assertEqual(len(wheel), 0)
@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 
 from wizzat.testutil import *
 from wizzat import pghelper
+import datetime
 import psycopg2, psycopg2.extras
 
 class PgHelperTest(TestCase):
@@ -127,3 +128,43 @@ class PgHelperTest(TestCase):
         )
 
         self.assertEqual(clause, 'true = false')
+
+    def test_copy_from_rows(self):
+        self.assertEqual(pghelper.copy_value(None), '\\N')
+        self.assertEqual(pghelper.copy_value(True), 't')
+        self.assertEqual(pghelper.copy_value('a\tb\\c\nd'), 'a\\tb\\\\c\\nd')
+        self.assertEqual(pghelper.copy_value([ 1, None, 'x"y' ]), '{"1",NULL,"x\\\\"y"}')
+        self.assertEqual(pghelper.copy_value(b'\x00\xff'), '\\\\x00ff')
+        self.assertEqual(pghelper.copy_value(bytearray(b'ab')), '\\\\x6162')
+        self.assertEqual(pghelper.copy_value(datetime.timedelta(seconds = 5)), '0 days 5.000000 seconds')
+        self.assertEqual(pghelper.copy_value(float('nan')), 'NaN')
+
+        with psycopg2.connect(**self.db_info) as conn:
+            pghelper.execute(conn, "CREATE TEMPORARY TABLE copytest (a INTEGER, b TEXT, c TEXT[])")
+            pghelper.copy_from_rows(conn, 'copytest', [ 'a', 'b', 'c' ], [
+                [ 1, 'tab\there', [ 'x"y', None ] ],
+                [ 2, None, None ],
+            ])
+
+            self.assertEqual([ list(row) for row in pghelper.fetch_results(conn, "SELECT * FROM copytest ORDER BY a") ], [
+                [ 1, 'tab\there', [ 'x"y', None ] ],
+                [ 2, None, None ],
+            ])
+
+    def test_prepared_statement(self):
+        stmt = pghelper.PreparedStatement("SELECT %(a)s::integer + %(b)s::integer + %(a)s::integer AS total")
+        self.assertEqual(stmt.param_names, [ 'a', 'b' ])
+        self.assertTrue(stmt.prepare_sql.endswith('AS SELECT $1::integer + $2::integer + $1::integer AS total'))
+
+        with psycopg2.connect(**self.db_info) as conn:
+            sql = stmt.sql_for(conn)
+            self.assertEqual(sql, 'EXECUTE {} (%(a)s, %(b)s)'.format(stmt.name))
+            self.assertEqual(pghelper.fetch_one(conn, sql, a = 1, b = 2)['total'], 4)
+            self.assertEqual(pghelper.prepared_statements(conn), { stmt.name })
+
+            # Statements outlive transactions, but not the backend
+            conn.rollback()
+            self.assertEqual(pghelper.fetch_one(conn, stmt.sql_for(conn), a = 2, b = 2)['total'], 6)
+            pghelper.reset_conn(conn)
+            self.assertEqual(pghelper.prepared_statements(conn), set())
+            self.assertEqual(pghelper.fetch_one(conn, stmt.sql_for(conn), a = 3, b = 2)['total'], 8)
@@ -3,27 +3,74 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import boto, boto.exception, boto.s3, boto.s3.key, json, time
+import boto, boto.exception, boto.s3, boto.s3.connection, boto.s3.key, gc, json, threading, time, weakref
 from wizzat.s3table import *
 from wizzat.testutil import *
 from wizzat.util import *
 from wizzat.decorators import *
 from testcase import DBTestCase
 
+class S3ConnPoolTest(TestCase):
+    def test_connections_are_reused(self):
+        pool = S3ConnPool(object, size = 2)
+
+        with pool.checkout('get') as conn1:
+            with pool.checkout('get') as conn2:
+                self.assertTrue(conn1 is not conn2)
+
+        with pool.checkout('put') as conn3:
+            self.assertTrue(conn3 is conn2 or conn3 is conn1)
+
+        self.assertEqual(pool.created, 2)
+        self.assertEqual(pool.stats['get']['calls'], 2)
+        self.assertEqual(pool.stats['put']['calls'], 1)
+        self.assertTrue('S3 Connection Pool (2 of 2 connections)' in pool.format_stats())
+
+    def test_checkout_blocks_when_exhausted(self):
+        pool = S3ConnPool(object, size = 1)
+        checked_out = []
+
+        def worker():
+            with pool.checkout() as conn:
+                checked_out.append(conn)
+
+        with pool.checkout() as conn:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join(0.1)
+            self.assertEqual(checked_out, [])
+
+        thread.join()
+        self.assertEqual(checked_out, [ conn ])
+        self.assertEqual(pool.created, 1)
+
 class S3TableTest(DBTestCase):
     @skip_unless_env('TEST_S3')
     def setUp(self):
         data = load_paths(json.loads, '~/.test_s3.cfg')
-        self.s3_conn = boto.connect_s3(
-            data['s3_access_key'],
-            data['s3_secret_key'],
-        )
+        if data.get('s3_host'):
+            # A local S3 compatible server, ie: {"s3_host": "localhost", "s3_port": 9000, "s3_is_secure": false}
+            self.connect_s3 = lambda: boto.connect_s3(
+                data['s3_access_key'],
+                data['s3_secret_key'],
+                host             = data['s3_host'],
+                port             = data.get('s3_port'),
+                is_secure        = data.get('s3_is_secure', False),
+                calling_format   = boto.s3.connection.OrdinaryCallingFormat(),
+            )
+        else:
+            self.connect_s3 = lambda: boto.connect_s3(
+                data['s3_access_key'],
+                data['s3_secret_key'],
+            )
 
+        self.s3_conn = self.connect_s3()
         self.bucket_name = data['s3.default_bucket']
         self.s3_bucket = self.s3_conn.get_bucket(self.bucket_name)
         self.purge_key('tbl/1/2')
         self.purge_key('tbl/1/3')
         self.purge_key('tbl/1/4')
+        self.purge_key('tbl/1/5')
 
     def purge_key(self, key):
         try:
@@ -70,6 +117,92 @@ class S3TableTest(DBTestCase):
 
         self.assertEqual(cls.find_by_key(1, 2)._data, expected_data)
 
+    def test_bucket_handles_are_cached(self):
+        cls = self.new_subclass()
+        cls._remote_bucket()
+        cls._remote_bucket()
+        self.assertEqual(cls.bucket_handles[self.s3_conn], { self.bucket_name })
+
+        pool = S3ConnPool(lambda: self.s3_conn, size = 1)
+        cls.conn = pool
+        cls.find_by_key(1, 2)
+        cls.find_by_key(1, 2)
+
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(pool.stats['get']['calls'], 2)
+
+    def test_bucket_handles_do_not_outlive_their_connection(self):
+        cls = self.new_subclass()
+        conn = self.connect_s3()
+        cls._remote_bucket(conn)
+        self.assertTrue(conn in cls.bucket_handles)
+
+        conn_ref = weakref.ref(conn)
+        del conn
+        gc.collect()
+        self.assertEqual(conn_ref(), None)
+
+    def test_multipart_upload(self):
+        cls = self.new_subclass()
+        cls.part_size = 5 * 1024 * 1024
+        data1 = 'x' * (12 * 1024 * 1024)
+
+        obj = cls.create(1, 5, data1 = data1)
+        self.assertEqual([ len(part) for part in obj.iterparts() ], [ cls.part_size, cls.part_size, len(obj.encode_data()) - 2 * cls.part_size ])
+        self.assertTrue(obj._kv_data.endswith('-3"'))
+
+        self.assertEqual(cls.find_by_key(1, 5).data1, data1)
+        self.assertEqual(b''.join(cls.stream_by_key(1, 5, chunk_size = 1024 * 1024)), obj.encode_data().encode('utf8'))
+        self.assertEqual(cls.read_range(0, 9, 1, 5), obj.encode_data().encode('utf8')[:10])
+
+    def test_scan_and_bulk_delete(self):
+        cls = self.new_subclass(tbl_name = 'scantbl')
+        cls.bulk_delete(remote_key.name for remote_key in self.s3_bucket.list(prefix = 'scantbl/'))
+
+        for key2 in range(25):
+            cls.create(1, key2, data1 = key2)
+
+        objs = list(cls.scan(workers = 4))
+        self.assertEqual(sorted(obj.data1 for obj in objs), list(range(25)))
+        self.assertEqual(len(list(cls.scan(prefix = 'scantbl/1/1', workers = 2))), 11) # 1, 10-19
+
+        self.assertEqual(cls.bulk_delete(obj._key for obj in objs), [])
+        self.assertEqual(list(cls.scan()), [])
+
+    def test_bulk_delete__indexes(self):
+        class cls(S3Table):
+            table_name = 'bulkidx'
+            conn       = self.s3_conn
+            bucket     = self.bucket_name
+            key_fields = [ 'key1', 'key2' ]
+            fields     = [ 'key1', 'key2', 'data1' ]
+            indexes    = [ ('data1',) ]
+
+        objs = [ cls.create(1, key2, data1 = 'abc') for key2 in range(3) ]
+        self.assertEqual(len(cls.find_by_index('data1', 'abc')), 3)
+
+        self.assertEqual(cls.bulk_delete(obj._key for obj in objs[:2]), [])
+        self.assertEqual(cls.find_by_index('data1', 'abc'), [ objs[2] ])
+
+    def test_stream_by_key(self):
+        cls = self.new_subclass()
+        obj = cls.create(1, 5, data1 = 'abc')
+
+        self.assertEqual(b''.join(cls.stream_by_key(1, 5, chunk_size = 4)), obj.encode_data().encode('utf8'))
+        self.assertEqual(cls.read_range(0, 3, 1, 5), obj.encode_data().encode('utf8')[:4])
+
+    def test_stream_by_key_does_not_hold_a_connection_between_chunks(self):
+        cls = self.new_subclass()
+        obj = cls.create(1, 5, data1 = 'abc')
+        cls.conn = S3ConnPool(lambda: self.s3_conn, size = 1)
+
+        stream = cls.stream_by_key(1, 5, chunk_size = 4)
+        chunks = [ next(stream) ]
+        self.assertEqual(cls.find_by_key(1, 5).data1, 'abc') # Would block on the only connection
+        chunks.extend(stream)
+
+        self.assertEqual(b''.join(chunks), obj.encode_data().encode('utf8'))
+
     def test_find_or_create(self):
         cls = self.new_subclass()
 
@@ -0,0 +1,222 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from wizzat.decorators import create_cache_obj
+from wizzat.filekvtable import *
+from wizzat.kvtable import *
+from wizzat.tieredkvtable import *
+from wizzat.testutil import *
+
+class TieredKVTableTest(TestCase):
+    def setUp(self):
+        super(TieredKVTableTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.classes = []
+
+    def tearDown(self):
+        super(TieredKVTableTest, self).tearDown()
+        for cls in self.classes:
+            cls.stop_behind()
+        FileKVTable.close_stores()
+        shutil.rmtree(self.dir)
+
+    def new_subclass(self, policy = 'through', l1_size = 100, **kwargs):
+        class C(TieredKVTable):
+            table_name   = 'tbl'
+            key_fields   = [ 'key1' ]
+            fields       = [ 'key1', 'data1' ]
+            write_policy = policy
+            indexes      = kwargs.get('indexes', ())
+            tiers        = [
+                (DictKVTable, { 'kv_store' : create_cache_obj(max_size = l1_size) }),
+                (FileKVTable, dict({ 'path' : os.path.join(self.dir, 'tbl.log') }, **kwargs.get('l2_attrs', {}))),
+            ]
+
+        self.classes.append(C)
+        return C
+
+    def test_write_through(self):
+        cls = self.new_subclass()
+        obj = cls.create(1, data1 = 'abc')
+
+        l1, l2 = cls.tier_classes
+        self.assertEqual(l1.kv_store['tbl/1'], { 'key1' : 1, 'data1' : 'abc' })
+        self.assertEqual(l2.find_by_key(1).data1, 'abc')
+        self.assertEqual([ stats['writes'] for stats in cls.tier_stats ], [ 1, 1 ])
+
+        obj.data1 = 'def'
+        obj.update()
+        self.assertEqual(l1.kv_store['tbl/1']['data1'], 'def')
+        self.assertEqual(l2.find_by_key(1).data1, 'def')
+
+        obj.delete()
+        self.assertFalse('tbl/1' in l1.kv_store)
+        self.assertEqual(l2.find_by_key(1), None)
+        self.assertEqual(cls.find_by_key(1), None)
+
+    def test_reads_promote(self):
+        cls = self.new_subclass()
+        l1, l2 = cls.tier_classes
+        l2.create(1, data1 = 'abc')
+
+        self.assertEqual(cls.find_by_key(1).data1, 'abc')
+        self.assertEqual(l1.kv_store['tbl/1'], { 'key1' : 1, 'data1' : 'abc' })
+        self.assertEqual(cls.find_by_key(1).data1, 'abc')
+
+        self.assertEqual(cls.tier_stats[0]['hits'], 1)
+        self.assertEqual(cls.tier_stats[0]['misses'], 1)
+        self.assertEqual(cls.tier_stats[0]['promotions'], 1)
+        self.assertEqual(cls.tier_stats[1]['hits'], 1)
+        self.assertTrue('Tier Stats for tbl' in cls.format_stats())
+
+    def test_cached_documents_are_copies(self):
+        cls = self.new_subclass()
+        obj = cls.create(1, data1 = 'abc')
+        obj.data1 = 'def'
+
+        self.assertEqual(cls.find_by_key(1).data1, 'abc')
+
+    def test_authoritative_cas(self):
+        cls = self.new_subclass()
+        cls.create(1, data1 = 'abc')
+        cls.tier_classes[0].kv_store.clear()
+
+        obj1 = cls.find_by_key(1)
+        cls.tier_classes[0].kv_store.clear()
+        obj2 = cls.find_by_key(1)
+        obj1.data1 = 'def'
+        obj1.update()
+
+        obj2.data1 = 'ghi'
+        with self.assertRaises(KVTableCASError):
+            obj2.update()
+
+        self.assertEqual(cls.find_by_key(1).data1, 'def')
+
+    def test_multi_get_is_batched_per_tier(self):
+        cls = self.new_subclass(l1_size = 2)
+        for key1 in range(5):
+            cls.create(key1, data1 = key1)
+        cls.clear_stats()
+
+        objs = cls.find_by_kv_keys([ 'tbl/{}'.format(key1) for key1 in range(6) ])
+        self.assertEqual([ obj.data1 for obj in objs ], list(range(5)))
+        self.assertEqual(cls.tier_stats[0]['hits'], 2)
+        self.assertEqual(cls.tier_stats[0]['misses'], 4)
+        self.assertEqual(cls.tier_stats[1]['hits'], 3)
+        self.assertEqual(cls.tier_stats[1]['misses'], 1)
+
+    def test_write_behind(self):
+        cls = self.new_subclass(policy = 'behind')
+        cls.behind_interval = 60
+        l1, l2 = cls.tier_classes
+
+        obj = cls.create(1, data1 = 'abc')
+        obj.data1 = 'def'
+        obj.update()
+        self.assertEqual(cls.find_by_key(1).data1, 'def')
+        self.assertEqual(l2.find_by_key(1), None)
+
+        cls.flush()
+        self.assertEqual(l2.find_by_key(1).data1, 'def')
+        self.assertEqual(cls.tier_stats[1]['writes'], 1)
+
+        obj.delete()
+        self.assertEqual(l2.find_by_key(1).data1, 'def')
+        cls.flush()
+        self.assertEqual(l2.find_by_key(1), None)
+
+    def test_write_behind__retries_failed_writes(self):
+        cls = self.new_subclass(policy = 'behind')
+        cls.behind_interval = 60
+        l1, l2 = cls.tier_classes
+        error = IOError('disk full')
+
+        def fail(self, force = False):
+            raise error
+
+        l2._update = fail
+        cls.create(1, data1 = 'abc')
+        cls.create(2, data1 = 'def')
+        self.assertEqual(cls.flush(), [ ('tbl/1', error), ('tbl/2', error) ])
+        self.assertEqual(cls.behind_failures, { 'tbl/1' : error, 'tbl/2' : error })
+        self.assertEqual(cls.tier_stats[1]['errors'], 2)
+
+        obj = cls.find_by_key(2)
+        obj.data1 = 'ghi'
+        obj.update()
+
+        del l2._update
+        self.assertEqual(cls.flush(), [])
+        self.assertEqual(cls.behind_failures, {})
+        self.assertEqual(l2.find_by_key(1).data1, 'abc')
+        self.assertEqual(l2.find_by_key(2).data1, 'ghi')
+
+    def test_write_behind__restarts_thread(self):
+        cls = self.new_subclass(policy = 'behind')
+        cls.behind_interval = 60
+        cls.create(1, data1 = 'abc')
+        dead_thread = cls.behind_thread = threading.Thread(target = lambda: None)
+        dead_thread.start()
+        dead_thread.join()
+
+        cls.create(2, data1 = 'abc')
+        self.assertTrue(cls.behind_thread is not dead_thread)
+        self.assertTrue(cls.behind_thread.is_alive())
+
+    def test_write_behind__stop_drains_the_queue(self):
+        cls = self.new_subclass(policy = 'behind')
+        cls.behind_interval = 60
+        l1, l2 = cls.tier_classes
+
+        cls.create(1, data1 = 'abc')
+        thread = cls.behind_thread
+        self.assertTrue(thread.is_alive())
+
+        self.assertEqual(cls.stop_behind(), [])
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(cls.behind_thread, None)
+        self.assertEqual(l2.find_by_key(1).data1, 'abc')
+
+        cls.create(2, data1 = 'abc')
+        self.assertTrue(cls.behind_thread.is_alive())
+
+    def test_write_behind__thread_exits_when_idle(self):
+        cls = self.new_subclass(policy = 'behind')
+        cls.behind_interval = 0.01
+        l1, l2 = cls.tier_classes
+
+        cls.create(1, data1 = 'abc')
+        cls.behind_thread.join(5)
+        self.assertEqual(cls.behind_thread, None)
+        self.assertEqual(l2.find_by_key(1).data1, 'abc')
+
+    def test_cas_errors_come_from_the_authoritative_tier(self):
+        cls = self.new_subclass(l2_attrs = { 'cas_errors' : (IOError,) })
+        self.assertEqual(cls.cas_errors, (IOError,))
+
+    def test_indexes(self):
+        cls = self.new_subclass(indexes = [ ('data1',) ])
+        cls.create(1, data1 = 'abc')
+        cls.create(2, data1 = 'abc')
+
+        self.assertEqual(sorted(obj.key1 for obj in cls.find_by_index('data1', 'abc')), [ 1, 2 ])
+
+    def test_ttl(self):
+        cls = self.new_subclass()
+        cls.create(1, data1 = 'abc').set_ttl(60).update(force = True)
+        l1, l2 = cls.tier_classes
+
+        self.assertTrue(l1.kv_store['tbl/1'].expires_at > time.time() + 59)
+        self.assertTrue(l2.find_by_key(1)._kv_data[1] > time.time() + 59)
+
+        l1.kv_store.clear()
+        cls.find_by_key(1)
+        self.assertAlmostEqual(l1.kv_store['tbl/1'].expires_at, l2.find_by_key(1)._kv_data[1], places = 2)
@@ -0,0 +1,273 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+# Python 3 only (asyncio)
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+from wizzat.kvtable import ContentionResults
+
+__all__ = [
+    'AsyncKVTable',
+]
+
+class AsyncKVTable(object):
+    """
+    An asyncio mirror of a KVTable class's API:
+
+        users = AsyncKVTable(Users)
+
+        user = await users.find_by_key(1)
+        objs = await users.find_by_keys([ (1,), (2,), (3,) ])
+        user.name = 'abc'
+        await users.update(user)
+        await users.update_with(1, incr_logins)
+        await users.delete(user)
+
+    Backends may implement natively async hooks, which are awaited on the event loop:
+    - classmethod _async_find_by_key(kv_key) -> (kv_data, data)
+    - classmethod _async_find_multi(kv_keys) -> { kv_key : (kv_data, data) }
+    - _async_insert(force), _async_update(force), _async_delete(force) -> kv_data
+    - _async_update_fields(fields, force) -> kv_data, for tables with delta_updates
+
+    Everything else (S3Table, DictKVTable, ...) runs the sync method in a thread pool, by default
+    one bounded pool (executor_workers threads) shared by every AsyncKVTable.
+
+    Memoized objects which need revalidating (memoize_revalidate) are checked in the pool, since
+    that reads the backend's CAS.
+
+    Concurrent lookups of the same key (on the same event loop) are coalesced into one request,
+    and the callers get the same object, as they would from a memoized table, even through
+    different AsyncKVTables wrapping the table.  find_by_keys() makes one multi-get for the keys
+    which aren't cached or already being read.
+
+    Counts of lookups, cache hits, backend requests and coalesced lookups are kept in stats.
+    """
+    executor_workers = 16
+    shared_executor  = None
+    executor_lock    = threading.Lock()
+    inflight         = {} # { (table, loop, kv_key) : future }
+
+    def __init__(self, table, executor = None):
+        self.table    = table
+        self.executor = executor or self.get_shared_executor()
+        self.stats    = {
+            'lookups'    : 0,
+            'cache_hits' : 0,
+            'requests'   : 0,
+            'coalesced'  : 0,
+        }
+
+    @classmethod
+    def get_shared_executor(cls):
+        with cls.executor_lock:
+            if not AsyncKVTable.shared_executor:
+                AsyncKVTable.shared_executor = concurrent.futures.ThreadPoolExecutor(cls.executor_workers)
+            return AsyncKVTable.shared_executor
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def _call(self, target, hook, *args):
+        native = getattr(target, '_async' + hook, None)
+        if native:
+            return await native(*args)
+
+        return await self._run(getattr(target, hook), *args)
+
+    async def find_by_key(self, *keys):
+        objs = await self.find_by_kv_keys([ self.table.key_func(keys) ])
+        return objs[0] if objs else None
+
+    async def find_by_keys(self, keys_list):
+        """
+        Returns the objects for a list of key tuples (in order, skipping missing keys)
+        """
+        return await self.find_by_kv_keys([ self.table.key_func(keys) for keys in keys_list ])
+
+    async def find_by_kv_keys(self, kv_keys):
+        loop = asyncio.get_running_loop()
+        objs = {}
+        futures = {}
+        missing = []
+        cached = await self._check_key_cache(kv_keys)
+
+        for kv_key in kv_keys:
+            if kv_key in objs or kv_key in futures:
+                continue
+
+            self.stats['lookups'] += 1
+            obj = cached.get(kv_key)
+            if obj:
+                self.stats['cache_hits'] += 1
+                objs[kv_key] = obj
+                continue
+
+            future = self.inflight.get((self.table, loop, kv_key))
+            if future:
+                self.stats['coalesced'] += 1
+                futures[kv_key] = future
+            else:
+                missing.append(kv_key)
+
+        if missing:
+            futures.update(self._start_fetch(loop, missing))
+
+        for kv_key, future in futures.items():
+            # Shielded, so one caller being cancelled doesn't cancel the lookup for the others
+            objs[kv_key] = await asyncio.shield(future)
+
+        return [ objs[kv_key] for kv_key in kv_keys if objs.get(kv_key) ]
+
+    async def _check_key_cache(self, kv_keys):
+        """
+        Returns { kv_key : cached object } for kv_keys
+        """
+        table = self.table
+        if not table.memoize:
+            return {}
+
+        def check():
+            return { kv_key : table.check_key_cache(kv_key) for kv_key in kv_keys }
+
+        if table.memoize_max_stale and table.memoize_revalidate and table.cas_versions:
+            return await self._run(check)
+        return check()
+
+    def _start_fetch(self, loop, kv_keys):
+        """
+        Starts reading kv_keys with one request, and returns { kv_key : future } for each key.
+        The futures are registered as in flight until the request finishes.
+        """
+        self.stats['requests'] += 1
+        futures = {}
+        for kv_key in kv_keys:
+            futures[kv_key] = self.inflight[(self.table, loop, kv_key)] = loop.create_future()
+
+        def finished(task):
+            for kv_key, future in futures.items():
+                self.inflight.pop((self.table, loop, kv_key), None)
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception():
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result().get(kv_key))
+
+        loop.create_task(self._fetch(kv_keys)).add_done_callback(finished)
+        return futures
+
+    async def _fetch(self, kv_keys):
+        table = self.table
+        if len(kv_keys) == 1:
+            results = { kv_keys[0] : await self._call(table, '_find_by_key', kv_keys[0]) }
+        else:
+            results = await self._call(table, '_find_multi', kv_keys)
+
+        objs = {}
+        for kv_key, (kv_data, data) in results.items():
+            if kv_data:
+                objs[kv_key] = obj = table(
+                    key     = kv_key,
+                    data    = data,
+                    kv_data = kv_data,
+                )
+                table.cache_obj(obj)
+
+        return objs
+
+    async def create(self, *keys, **kwargs):
+        return await self.update(self.table._new_obj(keys, **kwargs))
+
+    async def update(self, obj, force = False):
+        """
+        Writes obj to the data store, as obj.update(force) does
+        """
+        table = self.table
+        write = obj._pending_write(force)
+        native = getattr(obj, '_async' + write, None) if write else None
+        if write and not native:
+            return await self._run(obj.update, force)
+
+        try:
+            if write:
+                obj._before_write(write)
+                if write == '_update_fields':
+                    obj._kv_data = await native(obj.changed_fields(), force)
+                else:
+                    obj._kv_data = await native(force)
+                await self._publish_write(obj)
+                obj._after_write(write)
+        except Exception:
+            table.uncache_obj(obj)
+            raise
+
+        obj._changed_fields = None
+        table.cache_obj(obj)
+
+        return obj
+
+    async def update_with(self, keys, mutate_fn, max_retries = 10, backoff = 0.005, max_backoff = 1.0, create = True):
+        """
+        As KVTable.update_with(), sleeping between retries without blocking the event loop.
+        Contention is recorded in ContentionResults.
+        """
+        table = self.table
+        keys = tuple(keys) if isinstance(keys, (list, tuple)) else (keys,)
+        start_time = time.time()
+
+        try:
+            for retry in range(max_retries + 1):
+                if retry:
+                    await asyncio.sleep(table._contention_backoff(retry, backoff, max_backoff))
+
+                try:
+                    obj = await self.find_by_key(*keys)
+                    created = not obj
+                    if created:
+                        if not create:
+                            return None
+                        obj = table._new_obj(keys)
+
+                    try:
+                        if mutate_fn(obj) is False:
+                            if created:
+                                table.uncache_obj(obj) # Never written, so it mustn't be served from the cache
+                            return obj
+                        await self.update(obj)
+                    except Exception:
+                        if created:
+                            table.uncache_obj(obj)
+                        raise
+                    return obj
+                except table.cas_errors:
+                    ContentionResults.record_conflict(table.table_name, table.key_func(keys))
+
+            table._contention_failed(keys, max_retries)
+        finally:
+            ContentionResults.record(table.table_name, calls = 1, duration = time.time() - start_time)
+
+    async def delete(self, obj, force = False):
+        """
+        Deletes obj from the data store, as obj.delete(force) does
+        """
+        if not hasattr(obj, '_async_delete'):
+            return await self._run(obj.delete, force)
+
+        try:
+            obj._kv_data = await obj._async_delete(force)
+            await self._publish_write(obj, deleted = True)
+        finally:
+            self.table.uncache_obj(obj)
+
+    async def _publish_write(self, obj, deleted = False):
+        # Index maintenance and invalidation may do blocking I/O, so they run in the pool
+        if obj.index_classes:
+            await self._run(obj._update_indexes, deleted)
+        if obj.invalidation_bus:
+            await self._run(obj.publish_invalidation)
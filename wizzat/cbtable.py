@@ -3,13 +3,70 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import contextlib
 import couchbase
+import couchbase.exceptions
+import threading
+import time
 import wizzat.kvtable
 
 __all__ = [
     'CBTable',
+    'DurabilitySession',
 ]
 
+class DurabilitySession(object):
+    """
+    A batch of CBTable writes whose durability (persist_to/replicate_to) is checked together,
+    with one endure_multi() per connection and durability requirement, instead of one wait per write.
+
+    After the session ends:
+    - keys:     every key written in the session
+    - failures: { key : exception or result } for keys which didn't meet their durability requirement
+    """
+    def __init__(self, timeout = 5.0, interval = 0.010):
+        self.timeout  = timeout
+        self.interval = interval
+        self.pending  = collections.defaultdict(dict)
+        self.keys     = []
+        self.failures = {}
+
+    def track(self, conn, key, cas, persist_to, replicate_to, removed = False):
+        if not persist_to and not replicate_to:
+            return
+
+        self.keys.append(key)
+        self.pending[(conn, persist_to, replicate_to, removed)][key] = cas
+
+    def endure(self):
+        """
+        Waits for every pending write to meet its durability requirement.  Returns failures.
+        """
+        pending, self.pending = self.pending, collections.defaultdict(dict)
+
+        for (conn, persist_to, replicate_to, removed), keys in pending.items():
+            try:
+                conn.endure_multi(keys,
+                    persist_to    = persist_to,
+                    replicate_to  = replicate_to,
+                    timeout       = self.timeout,
+                    interval      = self.interval,
+                    check_removed = removed,
+                )
+            except couchbase.exceptions.CouchbaseError as e:
+                results = getattr(e, 'all_results', None) or {}
+                for key in keys:
+                    result = results.get(key)
+                    if result is None or not result.success:
+                        self.failures[key] = result or e
+
+        return self.failures
+
+    @property
+    def ok(self):
+        return not self.failures
+
 class CBTable(wizzat.kvtable.KVTable):
     """
     This is a micro-ORM for working with Couchbase.  It attempts to work with CAS values
@@ -19,38 +76,147 @@ class CBTable(wizzat.kvtable.KVTable):
     Relevant options (on top of KVTable options):
     - replicate_to: int, the number of nodes to replicate the change to
     - persist_to:   int, the number of nodes to persist (to disk) the change to
+
+    With a codec, documents are stored as FMT_BYTES values.  ttl is passed to Couchbase, which
+    expires documents itself.  The client doesn't report expiry times, so memoized CBTable objects
+    are only expired by memoize_ttl (set it no higher than ttl).
+
+    Inside durability_session(), writes are issued without waiting for persist_to/replicate_to, and
+    the durability of every key written is observed in bulk when the session exits:
+
+        with CBTable.durability_session() as session:
+            for row in rows:
+                Table.create(*row)
+
+        session.failures # { key : failure }
+
+    With delta_updates, changed fields are written with sub-document mutations (CAS checked)
+    when the client library supports them.  Writes with force=True skip the CAS check.
     """
+    __slots__     = ()
     memoize       = False
     table_name    = ''
     key_fields    = []
     fields        = []
     persist_to    = 0
     replicate_to  = 0
+    sessions      = threading.local()
+    storage_attrs = ('conn', 'persist_to', 'replicate_to')
+    cas_errors    = (couchbase.exceptions.KeyExistsError, couchbase.exceptions.NotFoundError)
+
+    @classmethod
+    @contextlib.contextmanager
+    def durability_session(cls, timeout = 5.0, interval = 0.010):
+        """
+        Batches durability checks for CBTable writes in this thread.  Nested sessions join the outer one.
+        Durability is only waited for if the block completes without an exception.
+        """
+        session = getattr(cls.sessions, 'current', None)
+        if session:
+            yield session
+            return
+
+        session = cls.sessions.current = DurabilitySession(timeout, interval)
+        try:
+            yield session
+        finally:
+            cls.sessions.current = None
+
+        session.endure()
+
+    def _durability_args(self):
+        if getattr(self.sessions, 'current', None):
+            return { 'persist_to' : 0, 'replicate_to' : 0 }
+
+        return { 'persist_to' : self.persist_to, 'replicate_to' : self.replicate_to }
+
+    def _track_durability(self, rv, removed = False):
+        session = getattr(self.sessions, 'current', None)
+        if session:
+            session.track(self.conn, self._key, rv.cas, self.persist_to, self.replicate_to, removed)
+
+        return rv
+
+    def _ttl_args(self):
+        ttl = self.write_ttl()
+        if not ttl:
+            return {}
+
+        # Couchbase treats expiries over 30 days as unix timestamps
+        if ttl > 30 * 24 * 3600:
+            return { 'ttl' : int(time.time() + ttl) }
+        return { 'ttl' : max(1, int(round(ttl))) }
+
+    def _cas(self, force):
+        return 0 if force or not self._kv_data else self._kv_data.cas
+
+    def _value_args(self):
+        kwargs = self._ttl_args()
+        if self._codec:
+            kwargs['format'] = couchbase.FMT_BYTES
+            return self.encode_data(), kwargs
+        return self._data, kwargs
 
     @classmethod
     def _find_by_key(cls, kv_key):
         try:
             rv = cls.conn.get(kv_key)
-            return rv, rv.value
+            return rv, cls.decode_data(rv.value) if cls._codec else rv.value
         except couchbase.exceptions.NotFoundError:
             return None, None
 
+    @classmethod
+    def _find_multi(cls, kv_keys):
+        results = {}
+        for kv_key, rv in cls.conn.get_multi(kv_keys, quiet=True).items():
+            if rv.success:
+                results[kv_key] = (rv, cls.decode_data(rv.value) if cls._codec else rv.value)
+            else:
+                results[kv_key] = (None, None)
+
+        return results
+
+    @classmethod
+    def _kv_cas(cls, kv_data):
+        return kv_data.cas if kv_data else None
+
+    @classmethod
+    def _find_cas_by_key(cls, kv_key):
+        for info in cls.conn.observe(kv_key).value:
+            if info.from_master:
+                return info.cas or None
+
     def _insert(self, force=False):
-        return self.conn.add(self._key, self._data,
-            persist_to   = self.persist_to,
-            replicate_to = self.replicate_to,
-        )
+        value, kwargs = self._value_args()
+        kwargs.update(self._durability_args())
+
+        return self._track_durability(self.conn.add(self._key, value, **kwargs))
 
     def _update(self, force=False):
-        return self.conn.set(self._key, self._data,
-            persist_to   = self.persist_to,
-            replicate_to = self.replicate_to,
-            cas          = self._kv_data.cas,
-        )
+        value, kwargs = self._value_args()
+        kwargs.update(self._durability_args())
+
+        return self._track_durability(self.conn.set(self._key, value,
+            cas = self._cas(force),
+            **kwargs
+        ))
+
+    def _update_fields(self, fields, force=False):
+        if self._codec or not hasattr(self.conn, 'mutate_in'):
+            return super(CBTable, self)._update_fields(fields, force)
+
+        import couchbase.subdocument
+        specs = [ couchbase.subdocument.upsert(field, getattr(self, field)) for field in fields ]
+        kwargs = self._ttl_args()
+        kwargs.update(self._durability_args())
+
+        return self._track_durability(self.conn.mutate_in(self._key, *specs,
+            cas = self._cas(force),
+            **kwargs
+        ))
 
     def _delete(self, force=False):
-        return self.conn.delete(self._key,
-            persist_to   = self.persist_to,
-            replicate_to = self.replicate_to,
-            cas          = self._kv_data.cas,
-        )
+        return self._track_durability(self.conn.delete(self._key,
+            cas = self._cas(force),
+            **self._durability_args()
+        ), removed = True)
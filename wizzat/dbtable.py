@@ -3,24 +3,106 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import copy
 import six
+import threading
 import types
+import weakref
 import wizzat.decorators
 from wizzat.pghelper import *
-from wizzat.util import set_defaults
+from wizzat.util import chunks, set_defaults, unique
 
 __all__ = [
     'DBTable',
     'DBTableError',
     'DBTableConfigError',
     'DBTableImmutableFieldError',
+    'DBTableSession',
+    'TransactionCache',
 ]
 
 class DBTableError(Exception): pass
 class DBTableConfigError(DBTableError): pass
 class DBTableImmutableFieldError(DBTableError): pass
 
+# db_fields.get() default for fields which weren't selected
+_unloaded = object()
+
+def construct_dbtable_definition(fields, default_fields, verbose = False):
+    """
+    Generates the source for a DBTable's __init__ and field accessors.  Default functions are
+    referenced as default_{idx}, and accessors are named get_{idx}/set_{idx}.
+
+    Assigned values are kept in self._values, and unassigned fields are read from db_fields.
+    Mutable values (mutable_types) are copied into _values when they are first read, so they
+    can be changed in place without touching db_fields.  Fields missing from db_fields (lazy
+    or not selected) are loaded with _load_field, so default functions only fill in new objects.
+    """
+    new_lines = []
+    for idx, field in enumerate(fields):
+        if field in default_fields:
+            new_lines.append('values[{0!r}] = copy_value(kwargs[{0!r}]) if {0!r} in kwargs else default_{1}(self)'.format(field, idx))
+        else:
+            new_lines.append('values[{0!r}] = copy_value(get({0!r}))'.format(field))
+
+    definition = """
+def __init__(self, _is_in_db = False, **kwargs):
+    self._values = values = {{}}
+    if _is_in_db:
+        self.db_fields = kwargs
+    else:
+        self.db_fields = {{}}
+        get = kwargs.get
+        {new_lines}
+
+    self.on_init()
+    self.cache_obj(self)
+""".format(
+        new_lines = '\n        '.join(new_lines),
+    )
+
+    for idx, field in enumerate(fields):
+        definition += """
+def get_{idx}(self):
+    values = self._values
+    if {field!r} in values:
+        return values[{field!r}]
+
+    value = self.db_fields.get({field!r}, unloaded)
+    if value is unloaded:
+        value = self._load_field({field!r})
+    if isinstance(value, mutable_types):
+        value = values[{field!r}] = copy.deepcopy(value)
+    return value
+
+def set_{idx}(self, value):
+    self._values[{field!r}] = value
+""".format(idx = idx, field = field)
+
+    if verbose:
+        print(definition)
+
+    return definition
+
+def related_property(name, field, target):
+    """
+    Returns the accessor for a reference: the target object for field's value, as prefetched
+    by DBTable.prefetch() or from target.find_by_id().
+    """
+    def get_related(self):
+        target_id = getattr(self, field)
+        if target_id is None:
+            return None
+
+        prefetched = self.__dict__.get('_prefetched', {}).get(name)
+        if prefetched and prefetched[0] == target_id:
+            return prefetched[1]
+
+        return target.find_by_id(target_id)
+
+    return property(get_related)
+
 class DBTableMeta(type):
     def __init__(cls, name, bases, dct):
         super(DBTableMeta, cls).__init__(name, bases, dct)
@@ -52,6 +134,31 @@ class DBTableMeta(type):
             if field not in dct['fields']:
                 raise DBTableConfigError('key field {} not in fields'.format(field))
 
+        for field in cls.lazy_fields:
+            if field not in dct['fields']:
+                raise DBTableConfigError('lazy field {} not in fields'.format(field))
+
+        if cls.lazy_fields and not (cls.id_field or cls.key_fields):
+            raise DBTableConfigError('lazy_fields requires an id_field or key_fields to load them by')
+
+        cls.relations = {}
+        for field, target in cls.references.items():
+            if field not in dct['fields'] or not field.endswith('_id'):
+                raise DBTableConfigError('reference {} should be a field named {{relation}}_id'.format(field))
+
+            name = field[:-len('_id')]
+            if name in dct['fields']:
+                raise DBTableConfigError('relation {} is also a field'.format(name))
+
+            if not target.id_field:
+                raise DBTableConfigError('{} is referenced by {}, and needs an id_field'.format(target.table_name, field))
+
+            cls.relations[name] = (field, target)
+            setattr(cls, name, related_property(name, field, target))
+
+        if dct.get('invalidation_bus'):
+            dct['invalidation_bus'].register(cls)
+
         if dct.get('memoize'):
             cls.id_cache = wizzat.decorators.create_cache_obj(
                 max_size  = dct.get('memoize_size', 0),
@@ -64,12 +171,34 @@ class DBTableMeta(type):
             )
 
         cls._conn = None
+        cls.sql_cache = {}
+        cls._column_types = None
         cls.default_funcs = {}
-
-        for field in dct['fields']:
+        namespace = {
+            'copy'          : copy,
+            'copy_value'    : cls.copy_value,
+            'mutable_types' : cls.mutable_types,
+            'unloaded'      : _unloaded,
+        }
+
+        for idx, field in enumerate(dct['fields']):
             func_name = 'default_{}'.format(field)
             if func_name in dct:
-                cls.default_funcs[field] = dct[func_name]
+                cls.default_funcs[field] = namespace['default_{}'.format(idx)] = dct[func_name]
+
+        six.exec_(construct_dbtable_definition(
+            fields         = dct['fields'],
+            default_fields = cls.default_funcs,
+        ), namespace)
+
+        if '__init__' not in dct:
+            cls.__init__ = namespace['__init__']
+
+        for idx, field in enumerate(dct['fields']):
+            setattr(cls, field, property(
+                namespace['get_{}'.format(idx)],
+                namespace['set_{}'.format(idx)],
+            ))
 
 
 @six.add_metaclass(DBTableMeta)
@@ -85,36 +214,50 @@ class DBTable(object):
     key_fields:         list[string], the names of the key fields (generally primary or unique key)
     fields:             list[string], the names of all fields on the object
     --
-    memoize:            bool, caches objects from the database locally
+    memoize:            bool, caches objects from the database locally.  On TransactionConnections,
+                        rows written in a transaction are only cached for that transaction until it
+                        commits (see TransactionCache).  On other connections they are cached at once.
     memoize_size:       int, maximum number of objects to cache from the database (LRU ejection)
     memoize_bytes:      int, maximum size objects to cache from the database (LRU ejection).
                         Note that there are two caches, and while references are shared the
                         cache size here is not absolute.
+    invalidation_bus:   wizzat.invalidation.InvalidationBus, publishes every write to other processes
+                        (typically a PgNotifyBus, which only delivers on commit) and evicts the rows
+                        they write from this process's caches.
     default_{field}:    func, define functions for default behaviors.  These functions are executed
                         in order of definition in the fields array.
-
+    references:         dict, { field : DBTable class } for fields holding another table's id, e.g.
+                        { 'customer_id' : Customer }.  Each adds a relation named for the field
+                        without _id (obj.customer), which find_by(prefetch = [ 'customer' ]) loads
+                        for every result with one find_by_ids() query.
+    lazy_fields:        list[string], fields left out of the default select (large text or json columns).
+                        They are loaded with one query when first read, or with load_fields().
+                        Requires id_field or key_fields.
+    prepare_threshold:  int, the SQL for find_by, insert, update, delete and rowlock is generated once
+                        per shape (operation and field names) and kept in sql_cache.  When this is set,
+                        shapes run this many times are PREPAREd on the connection and run with EXECUTE
+                        (see pghelper.PreparedStatement).  0 (default) never prepares.
+
+    __init__ and the field accessors are generated per class by DBTableMeta.  Objects loaded
+    from the database read their values from db_fields until they are assigned, and mutable
+    values (lists, dicts, ...) are copied the first time they are read.  Only assigned or copied
+    fields are compared with db_fields to decide whether an update is needed.  Subclasses
+    should override on_init rather than __init__.
     """
-    memoize       = False
-    table_name    = ''
-    id_field      = ''
-    key_fields    = []
-    fields        = []
-
-    def __init__(self, _is_in_db = False, **kwargs):
-        self.db_fields = kwargs if _is_in_db else {}
-
-        for field in self.fields:
-            if field in kwargs:
-                field_value = kwargs[field]
-            elif field in self.default_funcs:
-                field_value = self.default_funcs[field](self)
-            else:
-                field_value = None
-
-            setattr(self, field, copy.deepcopy(field_value))
+    memoize           = False
+    invalidation_bus  = None
+    table_name        = ''
+    id_field          = ''
+    key_fields        = []
+    fields            = []
+    references        = {}
+    lazy_fields       = ()
+    mutable_types     = (list, dict, set, bytearray)
+    prepare_threshold = 0
 
-        self.on_init()
-        self.cache_obj(self)
+    @classmethod
+    def copy_value(cls, value):
+        return copy.deepcopy(value) if isinstance(value, cls.mutable_types) else value
 
     def on_init(self):
         pass
@@ -122,17 +265,41 @@ class DBTable(object):
     @classmethod
     def check_key_cache(cls, key_fields):
         if cls.memoize:
+            if cls.invalidation_bus:
+                cls.invalidation_bus.maybe_poll()
+
             cache_key = tuple(key_fields)
-            return cls.key_cache.get(cache_key, None)
+            transaction = TransactionCache.current(cls.conn)
+            if transaction:
+                obj = transaction.get(cls, 'key', cache_key)
+                if obj:
+                    return cls._track(obj)
+
+            return cls._track(cls.key_cache.get(cache_key, None))
 
     @classmethod
     def check_id_cache(cls, id):
         if cls.memoize:
-            return cls.id_cache.get(id, None)
+            if cls.invalidation_bus:
+                cls.invalidation_bus.maybe_poll()
+
+            transaction = TransactionCache.current(cls.conn)
+            if transaction:
+                obj = transaction.get(cls, 'id', id)
+                if obj:
+                    return cls._track(obj)
+
+            return cls._track(cls.id_cache.get(id, None))
 
     @classmethod
     def cache_obj(cls, obj):
         if cls.memoize:
+            # Rows written in the connection's open transaction are cached for it alone until it commits
+            transaction = TransactionCache.current(cls.conn)
+            if transaction and obj and transaction.has(obj):
+                transaction.add(obj)
+                return
+
             if obj and cls.id_field:
                 cache_key = getattr(obj, cls.id_field)
                 cls.id_cache[cache_key] = obj
@@ -157,6 +324,59 @@ class DBTable(object):
             cache_key = tuple(getattr(obj, field) for field in cls.key_fields)
             cls.key_cache.pop(cache_key, None)
 
+    @classmethod
+    def evict_cached(cls, key):
+        """
+        Evicts a row from the caches (used by the invalidation bus).  key is the id, or the
+        list of key field values for tables without an id field.
+        """
+        if not cls.memoize:
+            return
+
+        if cls.id_field:
+            obj = cls.id_cache.get(key, None)
+        else:
+            obj = cls.key_cache.get(tuple(key), None)
+
+        if obj:
+            cls.uncache_obj(obj)
+
+    def _written(self, deleted = False):
+        """
+        Called after each write to this row.  Takes the row out of the shared caches and, inside a
+        TransactionConnection's transaction, caches it for the transaction until it commits.
+        Publishes the invalidation.
+        """
+        cls = type(self)
+        if cls.memoize:
+            cls.uncache_obj(self)
+            transaction = TransactionCache.current(cls.conn, create = True) if in_transaction(cls.conn) else None
+            if transaction:
+                if deleted:
+                    transaction.remove(self)
+                else:
+                    transaction.add(self)
+            elif not deleted:
+                cls.cache_obj(self)
+
+        self.publish_invalidation()
+
+    def publish_invalidation(self):
+        """
+        Tells other processes on the invalidation bus that this row has changed
+        """
+        if not self.invalidation_bus or not self.db_fields:
+            return
+
+        if self.id_field:
+            key = self.db_fields[self.id_field]
+        elif self.key_fields:
+            key = [ self.db_fields[field] for field in self.key_fields ]
+        else:
+            return
+
+        self.invalidation_bus.publish(self.table_name, key, conn = self.conn)
+
     @classmethod
     def find_by_id(cls, id):
         obj = cls.check_id_cache(id)
@@ -173,9 +393,73 @@ class DBTable(object):
 
         return cls.find_one(**{ field : value for field,value in zip(cls.key_fields, keys) })
 
+    @classmethod
+    def find_by_ids(cls, ids, chunk_size = 1000):
+        """
+        Returns the objects for ids, in order (skipping missing ids).  Cached objects are served
+        from the cache, and the rest are fetched with one "= ANY()" query per chunk_size ids.
+        """
+        if not cls.id_field:
+            raise DBTableConfigError("{} has no id_field to find by".format(cls.table_name))
+
+        ids = list(ids)
+        found = {}
+        missing = []
+        for id in unique(ids):
+            obj = cls.check_id_cache(id)
+            if obj:
+                found[id] = obj
+            else:
+                missing.append(id)
+
+        sql = "SELECT {select} FROM {table_name} WHERE {id_field} = ANY(%(ids)s)".format(
+            select     = cls._select_list(),
+            table_name = cls.table_name,
+            id_field   = cls.id_field,
+        )
+
+        for chunk in chunks(missing, chunk_size):
+            for obj in cls.find_by_sql(sql, ids = list(chunk)):
+                found[getattr(obj, cls.id_field)] = obj
+
+        return [ found[id] for id in ids if id in found ]
+
+    @classmethod
+    def find_by_keys(cls, keys_list, chunk_size = 1000):
+        """
+        Returns the objects for a list of key_fields value tuples, in order (skipping missing keys).
+        Cached objects are served from the cache, and the rest are fetched with one query per
+        chunk_size keys.
+        """
+        if not cls.key_fields:
+            raise DBTableConfigError("{} has no key_fields to find by".format(cls.table_name))
+
+        keys_list = [ tuple(keys) for keys in keys_list ]
+        found = {}
+        missing = []
+        for keys in unique(keys_list):
+            obj = cls.check_key_cache(keys)
+            if obj:
+                found[keys] = obj
+            else:
+                missing.append(keys)
+
+        # Row value IN lets the key literals take the column types, where a VALUES list would need casts
+        sql = "SELECT {select} FROM {table_name} WHERE ({key_fields}) IN %(keys)s".format(
+            select     = cls._select_list(),
+            table_name = cls.table_name,
+            key_fields = ', '.join(cls.key_fields),
+        )
+
+        for chunk in chunks(missing, chunk_size):
+            for obj in cls.find_by_sql(sql, keys = tuple(chunk)):
+                found[tuple(getattr(obj, field) for field in cls.key_fields)] = obj
+
+        return [ found[keys] for keys in keys_list if keys in found ]
+
     @classmethod
     def find_one(cls, **kwargs):
-        found = list(cls.find_by(**kwargs))
+        found = list(cls.find_by(limit = 2, **kwargs))
         if not found:
             return None
         assert len(found) == 1
@@ -188,7 +472,148 @@ class DBTable(object):
 
     @classmethod
     def find_or_create(cls, *args, **kwargs):
-        return cls.find_by_key(*args) or cls.create(*args, **kwargs)
+        """
+        Returns the object for key_fields values args, creating it from kwargs if it doesn't exist.
+        With atomic = True, this is one INSERT ... ON CONFLICT (key_fields) DO NOTHING statement
+        which also returns the existing row, so concurrent creators get the same row.  This
+        requires a unique constraint on key_fields.  Atomic creates run on_insert before the
+        statement (the only write it can make is the insert), and after_insert if it inserted.
+        """
+        if not kwargs.pop('atomic', False):
+            return cls.find_by_key(*args) or cls.create(*args, **kwargs)
+
+        obj = cls.check_key_cache(args)
+        if obj:
+            return obj
+
+        key_values = { field : value for field, value in zip(cls.key_fields, args) }
+        obj = cls(**set_defaults(kwargs, key_values))
+        obj.on_insert()
+        fields, bind_params = obj._insert_values()
+
+        sql = """
+            WITH inserted AS (
+                INSERT INTO {table_name} ({fields}) VALUES ({values})
+                ON CONFLICT ({key_fields}) DO NOTHING
+                RETURNING *
+            )
+            SELECT *, true AS wizzat_inserted FROM inserted
+            UNION ALL
+            SELECT *, false AS wizzat_inserted FROM {table_name} WHERE {where_clause}
+            LIMIT 1
+        """.format(
+            table_name   = cls.table_name,
+            fields       = ', '.join(fields),
+            values       = ', '.join([ '%({})s'.format(field) for field in fields ]),
+            key_fields   = ', '.join(cls.key_fields),
+            where_clause = sql_where_from_params(**key_values),
+        )
+
+        db_rows = fetch_results(cls.conn, sql, **bind_params)
+        if not db_rows:
+            # Inserted concurrently, after this statement's snapshot was taken
+            return cls.find_one(**key_values)
+
+        db_row, inserted = cls._split_inserted(db_rows[0])
+        if not inserted:
+            obj = cls(_is_in_db = True, **db_row)
+        else:
+            obj._set_db_fields(db_row)
+            obj._written()
+            obj.after_insert()
+
+        return obj
+
+    @classmethod
+    def upsert(cls, *keys, **kwargs):
+        """
+        Inserts the object for key_fields values keys, or updates the fields in kwargs if it exists,
+        with one INSERT ... ON CONFLICT (key_fields) DO UPDATE statement.  This requires a unique
+        constraint on key_fields.  Fields filled in by default functions are inserted, but don't
+        overwrite an existing row.  Runs after_insert or after_update (on_insert and on_update are
+        not run, as whether the row exists isn't known until it is written).
+        """
+        set_fields = set(kwargs)
+        obj = cls(**set_defaults(kwargs, { field : value for field, value in zip(cls.key_fields, keys) }))
+        fields, bind_params = obj._insert_values()
+
+        sql = """
+            INSERT INTO {table_name} ({fields}) VALUES ({values})
+            {on_conflict}
+            RETURNING *, (xmax = 0) AS wizzat_inserted
+        """.format(
+            table_name  = cls.table_name,
+            fields      = ', '.join(fields),
+            values      = ', '.join([ '%({})s'.format(field) for field in fields ]),
+            on_conflict = cls._on_conflict([ field for field in fields if field in set_fields ]),
+        )
+
+        cls._upserted([ obj ], fetch_results(cls.conn, sql, **bind_params))
+        return obj
+
+    @classmethod
+    def upsert_many(cls, rows, batch_size = 10000):
+        """
+        upsert() for many objects (or dicts of field values): rows are copied into a temporary
+        table and upserted with one INSERT ... SELECT ... ON CONFLICT statement per batch.
+        Returns the objects, in order.  Keys must be unique within rows.  As with upsert(), only
+        after_insert or after_update is run for each object.
+
+        Existing rows are updated with the fields in each dict, or every field of an object.
+        """
+        objs = []
+        set_fields = {}
+        for row in rows:
+            obj = row if isinstance(row, cls) else cls(**row)
+            objs.append(obj)
+            set_fields[id(obj)] = cls.fields if obj is row else row
+
+        for fields, shape_objs in cls._shapes(objs):
+            updates = collections.OrderedDict()
+            for obj in shape_objs:
+                update_fields = tuple(field for field in fields if field in set_fields[id(obj)])
+                updates.setdefault(update_fields, []).append(obj)
+
+            for update_fields, update_objs in updates.items():
+                for idx in range(0, len(update_objs), batch_size):
+                    batch = update_objs[idx:idx + batch_size]
+                    cls._upserted(batch, cls._insert_batch(fields, batch, cls._on_conflict(update_fields)))
+
+        return objs
+
+    @classmethod
+    def _on_conflict(cls, fields):
+        """
+        Returns the ON CONFLICT clause which sets fields (other than the key and id) on existing rows
+        """
+        if not cls.key_fields:
+            raise DBTableConfigError("{} has no key_fields to upsert on".format(cls.table_name))
+
+        # Updating a key field to itself still returns the existing row when there is nothing else to set
+        update_fields = [ field for field in fields if field not in cls.key_fields and field != cls.id_field ] or cls.key_fields[:1]
+
+        return "ON CONFLICT ({key_fields}) DO UPDATE SET {assignments}".format(
+            key_fields  = ', '.join(cls.key_fields),
+            assignments = ', '.join([ '{0} = EXCLUDED.{0}'.format(field) for field in update_fields ]),
+        )
+
+    @classmethod
+    def _upserted(cls, objs, db_rows):
+        assert len(db_rows) == len(objs)
+        for obj, db_row in zip(objs, db_rows):
+            db_row, inserted = cls._split_inserted(db_row)
+            obj._set_db_fields(db_row)
+            obj._written()
+
+            if inserted:
+                obj.after_insert()
+            else:
+                obj.after_update()
+
+    @staticmethod
+    def _split_inserted(db_row):
+        db_row = dict(db_row)
+        return db_row, db_row.pop('wizzat_inserted')
 
     @classmethod
     def find_or_create_many(cls, *rows):
@@ -196,32 +621,391 @@ class DBTable(object):
             return cls.find_or_create(*row)
 
     @classmethod
-    def find_by(cls, for_update = False, nowait = False, **kwargs):
+    def insert_many(cls, rows, batch_size = 10000):
         """
-        Returns rows which match all key/value pairs
-        Additionally, accepts for_update = True/False, nowait = True/False
+        Inserts objects (or dicts of field values) and returns the inserted objects, in order.
+
+        Rows are copied into a temporary table with COPY and inserted with one
+        INSERT ... SELECT ... RETURNING * per batch_size rows, so generated ids and defaults
+        are loaded back into the objects.  As with update(), None values are left to the
+        column defaults: rows are grouped by which fields they set.  The batch hooks
+        on_insert_many/after_insert_many run instead of on_insert/after_insert (by default
+        they call them for each object).
         """
-        for_update = 'for update' if for_update else ''
-        nowait = 'nowait' if nowait else ''
+        objs = [ row if isinstance(row, cls) else cls(**row) for row in rows ]
+        if not objs:
+            return objs
 
-        sql = """
-            SELECT *
+        cls.on_insert_many(objs)
+
+        for fields, shape_objs in cls._shapes(objs):
+            for idx in range(0, len(shape_objs), batch_size):
+                batch = shape_objs[idx:idx + batch_size]
+                cls._hydrate_inserted(batch, cls._insert_batch(fields, batch))
+
+        for obj in objs:
+            obj._written()
+
+        cls.after_insert_many(objs)
+
+        return objs
+
+    @classmethod
+    def _shapes(cls, objs):
+        """
+        Groups objs by the fields they have values for: [ (fields, objs) ]
+        """
+        shapes = collections.OrderedDict()
+        for obj in objs:
+            values = obj.to_dict()
+            fields = tuple(field for field in cls.fields if values[field] is not None)
+            shapes.setdefault(fields, []).append(obj)
+
+        return list(shapes.items())
+
+    @classmethod
+    def _insert_batch(cls, fields, objs, on_conflict = ''):
+        """
+        Inserts objs' values for fields with COPY and INSERT ... SELECT, and returns the rows, in order
+        """
+        if not fields:
+            # Rows of defaults are interchangeable, so they don't need to be matched up with objs
+            sql = "INSERT INTO {} SELECT FROM generate_series(1, %(count)s) RETURNING *, true AS wizzat_inserted".format(cls.table_name)
+            return fetch_results(cls.conn, sql, count = len(objs))
+
+        # Qualified with pg_temp, so a permanent table of the same name on the search_path is never used
+        tmp_table = 'pg_temp.wizzat_insert_many'
+
+        # Not ON COMMIT DROP: on an autocommit connection, that would drop it before the COPY
+        execute(cls.conn, "DROP TABLE IF EXISTS {}".format(tmp_table))
+        execute(cls.conn, """
+            CREATE TEMPORARY TABLE {tmp_table} AS
+            SELECT {fields}, 0 AS wizzat_ordinal
             FROM {table_name}
-            where {where_clause}
-            {for_update} {nowait}
+            LIMIT 0
         """.format(
+            tmp_table  = tmp_table,
+            fields     = ', '.join(fields),
             table_name = cls.table_name,
-            where_clause = sql_where_from_params(**kwargs),
-            for_update = for_update,
-            nowait = nowait,
+        ))
+
+        copy_from_rows(cls.conn, tmp_table, list(fields) + [ 'wizzat_ordinal' ], (
+            [ getattr(obj, field) for field in fields ] + [ ordinal ]
+            for ordinal, obj in enumerate(objs)
+        ))
+
+        # RETURNING can't see wizzat_ordinal and its order isn't guaranteed, so the returned rows are
+        # matched back to their ordinals by the inserted values (or the key, for upserts, whose
+        # other fields may be changed).  Rows with the same values are interchangeable, and are
+        # paired up by row_number().  The values are compared as text, as json has no equality.
+        match_fields = cls.key_fields if on_conflict else fields
+        match_exprs = ', '.join([ '{}::text'.format(field) for field in match_fields ])
+
+        db_rows = fetch_results(cls.conn, """
+            WITH inserted AS (
+                INSERT INTO {table_name} ({fields})
+                SELECT {fields}
+                FROM {tmp_table}
+                ORDER BY wizzat_ordinal
+                {on_conflict}
+                RETURNING *, (xmax = 0) AS wizzat_inserted
+            ), matched AS (
+                SELECT inserted.*, row_number() OVER (PARTITION BY {match_exprs}) AS wizzat_match
+                FROM inserted
+            ), source AS (
+                SELECT {match_fields}, wizzat_ordinal, row_number() OVER (PARTITION BY {match_exprs} ORDER BY wizzat_ordinal) AS wizzat_match
+                FROM {tmp_table}
+            )
+            SELECT matched.*, source.wizzat_ordinal
+            FROM matched
+                INNER JOIN source ON {join_clause} AND matched.wizzat_match = source.wizzat_match
+            ORDER BY source.wizzat_ordinal
+        """.format(
+            table_name   = cls.table_name,
+            fields       = ', '.join(fields),
+            tmp_table    = tmp_table,
+            on_conflict  = on_conflict,
+            match_fields = ', '.join(match_fields),
+            match_exprs  = match_exprs,
+            join_clause  = ' AND '.join([ 'matched.{0}::text = source.{0}::text'.format(field) for field in match_fields ]),
+        ))
+
+        execute(cls.conn, "DROP TABLE {}".format(tmp_table))
+        return [ cls._strip_match_columns(db_row) for db_row in db_rows ]
+
+    @staticmethod
+    def _strip_match_columns(db_row):
+        db_row = dict(db_row)
+        db_row.pop('wizzat_match')
+        db_row.pop('wizzat_ordinal')
+        return db_row
+
+    @classmethod
+    def _hydrate_inserted(cls, objs, db_rows):
+        assert len(db_rows) == len(objs)
+        for obj, db_row in zip(objs, db_rows):
+            obj._set_db_fields(cls._split_inserted(db_row)[0])
+
+    @classmethod
+    def on_insert_many(cls, objs):
+        for obj in objs:
+            obj.on_insert()
+
+    @classmethod
+    def after_insert_many(cls, objs):
+        for obj in objs:
+            obj.after_insert()
+
+    @classmethod
+    def _shape_sql(cls, shape, build_sql, preparable = True):
+        """
+        Returns the SQL for a statement shape (a tuple of the operation and everything the SQL
+        depends on), generating it with build_sql() the first time.  Once a preparable shape has
+        been run prepare_threshold times, returns the EXECUTE for it prepared on cls.conn.
+        """
+        entry = cls.sql_cache.get(shape)
+        if entry is None:
+            entry = cls.sql_cache[shape] = { 'sql' : build_sql(), 'uses' : 0, 'statement' : None }
+
+        if not cls.prepare_threshold or not preparable:
+            return entry['sql']
+
+        entry['uses'] += 1
+        if entry['uses'] < cls.prepare_threshold:
+            return entry['sql']
+
+        if not entry['statement']:
+            entry['statement'] = PreparedStatement(entry['sql'])
+
+        return entry['statement'].sql_for(cls.conn)
+
+    @classmethod
+    def _select_list(cls, columns = None, alias = None):
+        """
+        Returns the select list for columns (always including the id or key fields), or by default
+        every field but lazy_fields.  Columns are qualified with alias, if given.
+        """
+        if columns is None:
+            if cls.lazy_fields:
+                columns = [ field for field in cls.fields if field not in cls.lazy_fields ]
+            else:
+                columns = [ '*' ]
+        else:
+            identity = [ cls.id_field ] if cls.id_field else cls.key_fields
+            if not identity:
+                raise DBTableConfigError("{} needs an id_field or key_fields to select columns".format(cls.table_name))
+            columns = unique(list(identity) + list(columns))
+
+        return ', '.join([ '{}.{}'.format(alias, column) if alias else column for column in columns ])
+
+    @classmethod
+    def find_by(cls, for_update = False, nowait = False, columns = None, limit = None, prefetch = (), **kwargs):
+        """
+        Returns rows which match all key/value pairs
+        Additionally, accepts for_update = True/False, nowait = True/False, limit = int,
+        and columns = [ field, ... ] to select only those fields (and the id or key fields).
+        The other fields are loaded when they are first read.  prefetch = [ relation, ... ]
+        loads referenced objects for all rows at once (see find_by_sql).
+        """
+        def build_sql():
+            return """
+                SELECT {select}
+                FROM {table_name}
+                where {where_clause}
+                {limit}
+                {for_update} {nowait}
+            """.format(
+                select = cls._select_list(columns),
+                table_name = cls.table_name,
+                where_clause = sql_where_from_params(**kwargs),
+                limit = 'limit {:d}'.format(limit) if limit else '',
+                for_update = 'for update' if for_update else '',
+                nowait = 'nowait' if nowait else '',
+            )
+
+        # The where clause depends on the type of each value, and whether lists are empty
+        params = sorted(six.iteritems(kwargs))
+        shape = ('find_by', for_update, nowait, columns and tuple(columns), limit) + tuple(
+            (key, type(value), isinstance(value, (list, tuple)) and not value) for key, value in params
         )
 
-        return cls.find_by_sql(sql, **kwargs)
+        # Lists and tuples are expanded into in clauses, which can't be prepared
+        preparable = not any(isinstance(value, (list, tuple)) for key, value in params)
+
+        return cls.find_by_sql(cls._shape_sql(shape, build_sql, preparable), prefetch = prefetch, **kwargs)
 
     @classmethod
-    def find_by_sql(cls, sql, **bind_params):
+    def find_by_sql(cls, sql, prefetch = (), **bind_params):
+        """
+        Returns objects for the rows sql selects.  prefetch is a list of relations (see references)
+        to load for all of the rows at once, which reads every row before the first is returned.
+        """
+        if prefetch:
+            objs = cls.prefetch(list(cls.find_by_sql(sql, **bind_params)), *prefetch)
+            for obj in objs:
+                yield obj
+            return
+
         for row in iter_results(cls.conn, sql, **bind_params):
-            yield cls(_is_in_db = True, **row)
+            yield cls._track(cls(_is_in_db = True, **row))
+
+    @classmethod
+    def prefetch(cls, objs, *relations):
+        """
+        Loads the objects referenced by objs for each relation with one find_by_ids() (one query per
+        chunk of ids not already cached).  They are kept on objs for the relation accessors, and in
+        the referenced tables' caches when those are memoized.  Returns objs.
+        """
+        for name in relations:
+            if name not in cls.relations:
+                raise DBTableConfigError('{} has no relation {}'.format(cls.table_name, name))
+
+            field, target = cls.relations[name]
+            target_ids = unique(getattr(obj, field) for obj in objs if getattr(obj, field) is not None)
+            found = { getattr(target_obj, target.id_field) : target_obj for target_obj in target.find_by_ids(target_ids) }
+
+            for obj in objs:
+                target_id = getattr(obj, field)
+                obj.__dict__.setdefault('_prefetched', {})[name] = (target_id, found.get(target_id))
+
+        return objs
+
+    @classmethod
+    def session(cls, conn = None, batch_size = 1000):
+        """
+        Returns a DBTableSession (unit of work) for conn, by default this class's connection
+        """
+        return DBTableSession(conn or cls.conn, batch_size = batch_size)
+
+    @classmethod
+    def _track(cls, obj):
+        """
+        Adds objects read while a session is open on the connection to the session
+        """
+        if obj:
+            session = DBTableSession.current(cls.conn)
+            if session:
+                session.add(obj)
+
+        return obj
+
+    @classmethod
+    def _identity_fields(cls):
+        return [ cls.id_field ] if cls.id_field else list(cls.key_fields)
+
+    @classmethod
+    def _get_column_types(cls):
+        if cls._column_types is None:
+            cls._column_types = column_types(cls.conn, cls.table_name)
+        return cls._column_types
+
+    @classmethod
+    def update_many(cls, objs, batch_size = 1000):
+        """
+        Writes the changes to objs (which must be in the database) with one UPDATE ... FROM (VALUES ...)
+        statement per set of changed fields and batch_size objects.  on_update and after_update are
+        run for each changed object.  Objects without an id_field or key_fields, or whose id or key
+        fields changed, are updated one at a time.
+        """
+        dirty = [ obj for obj in objs if obj.should_update() ]
+        for obj in dirty:
+            obj.on_update()
+
+        identity = cls._identity_fields()
+        groups = collections.OrderedDict()
+        for obj in dirty:
+            changed = obj.changed_fields()
+            if not changed:
+                continue
+
+            if not identity or changed.intersection(identity):
+                obj._update()
+                obj._written()
+                obj.after_update()
+            else:
+                groups.setdefault(tuple(sorted(changed)), []).append(obj)
+
+        for fields, group in groups.items():
+            for chunk in chunks(group, batch_size):
+                cls._update_batch(identity, fields, list(chunk))
+
+        return objs
+
+    @classmethod
+    def _update_batch(cls, identity, fields, objs):
+        column_types = cls._get_column_types()
+        columns = identity + list(fields)
+
+        # VALUES literals don't take the target column types, so every value is cast
+        bind_params = {}
+        rows = []
+        for row_idx, obj in enumerate(objs):
+            values = []
+            for col_idx, field in enumerate(columns):
+                name = 'r{}_c{}'.format(row_idx, col_idx)
+                bind_params[name] = obj.db_fields[field] if col_idx < len(identity) else getattr(obj, field)
+                values.append('%({})s::{}'.format(name, column_types[field]))
+            rows.append('({})'.format(', '.join(values)))
+
+        sql = """
+            UPDATE {table_name} AS t
+            SET {assignments}
+            FROM (VALUES {rows}) AS v ({columns})
+            WHERE {filter_clause}
+            RETURNING {returning}
+        """.format(
+            table_name    = cls.table_name,
+            returning     = cls._select_list(alias = 't'),
+            assignments   = ', '.join([ '{0} = v.{0}'.format(field) for field in fields ]),
+            rows          = ', '.join(rows),
+            columns       = ', '.join(columns),
+            filter_clause = ' and '.join([ 't.{0} = v.{0}'.format(field) for field in identity ]),
+        )
+
+        db_rows = {}
+        for db_row in fetch_results(cls.conn, sql, **bind_params):
+            db_rows[tuple(db_row[field] for field in identity)] = db_row
+
+        for obj in objs:
+            db_row = db_rows.get(tuple(obj.db_fields[field] for field in identity))
+            if db_row is None:
+                raise DBTableError("{} row {} no longer exists".format(cls.table_name, obj.db_fields))
+
+            obj._set_returned_fields(db_row, { field : getattr(obj, field) for field in fields })
+            obj._written()
+            obj.after_update()
+
+    @classmethod
+    def delete_many(cls, objs, batch_size = 1000):
+        """
+        Deletes objs with one DELETE statement per batch_size objects, by id or key fields.
+        Objects of tables without either are deleted one at a time.  Returns the deleted rows.
+        """
+        objs = [ obj for obj in objs if obj.db_fields ]
+        if not cls.id_field and not cls.key_fields:
+            return [ db_row for obj in objs for db_row in obj.delete() ]
+
+        if cls.id_field:
+            sql = "DELETE FROM {table_name} WHERE {id_field} = ANY(%(keys)s) RETURNING *"
+            keys = [ obj.db_fields[cls.id_field] for obj in objs ]
+        else:
+            sql = "DELETE FROM {table_name} WHERE ({key_fields}) IN %(keys)s RETURNING *"
+            keys = [ tuple(obj.db_fields[field] for field in cls.key_fields) for obj in objs ]
+
+        sql = sql.format(
+            table_name = cls.table_name,
+            id_field   = cls.id_field,
+            key_fields = ', '.join(cls.key_fields),
+        )
+
+        db_rows = []
+        for chunk in chunks(keys, batch_size):
+            db_rows.extend(fetch_results(cls.conn, sql, keys = list(chunk) if cls.id_field else tuple(chunk)))
+
+        for obj in objs:
+            obj._written(deleted = True)
+
+        return db_rows
 
     def rowlock(self, nowait = False):
         """
@@ -235,28 +1019,93 @@ class DBTable(object):
         else:
             fields = self.fields
 
-        filter_clause = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in fields ])
+        def build_sql():
+            return """
+                select *
+                from {table_name}
+                where {filter_clause}
+                for update
+                {nowait}
+            """.format(
+                table_name    = self.table_name,
+                filter_clause = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in fields ]),
+                nowait        = nowait
+            )
+
         bind_params = { 'orig_{}'.format(x) : self.db_fields[x] for x in fields }
+        execute(self.conn, self._shape_sql(('rowlock', nowait), build_sql), **bind_params)
 
-        sql = """
-            select *
-            from {table_name}
-            where {filter_clause}
-            for update
-            {nowait}
-        """.format(
-            table_name    = self.table_name,
-            filter_clause = filter_clause,
-            nowait        = nowait
-        )
+        return self
+
+    def load_fields(self, *fields):
+        """
+        Reads fields which weren't selected (lazy_fields, or left out of find_by columns) with
+        one query, by default every field which isn't loaded.  Does nothing for new objects and
+        tables without an id_field or key_fields.
+        """
+        db_fields = self.db_fields
+        identity = [ self.id_field ] if self.id_field else self.key_fields
+        fields = [ field for field in (fields or self.fields) if db_fields.get(field, _unloaded) is _unloaded ]
+        if not fields or not db_fields or not identity:
+            return self
+
+        def build_sql():
+            return "SELECT {fields} FROM {table_name} WHERE {filter_clause}".format(
+                fields        = ', '.join(fields),
+                table_name    = self.table_name,
+                filter_clause = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in identity ]),
+            )
 
-        execute(self.conn, sql, **bind_params)
+        bind_params = { 'orig_{}'.format(x) : db_fields[x] for x in identity }
+        rows = fetch_results(self.conn, self._shape_sql(('load', tuple(fields)), build_sql), **bind_params)
+        if not rows:
+            raise DBTableError("{} row {} no longer exists".format(self.table_name, bind_params))
+
+        if not isinstance(db_fields, dict):
+            db_fields = self.db_fields = dict(db_fields.items())
+
+        for field in fields:
+            db_fields[field] = rows[0][field]
 
         return self
 
+    def _load_field(self, field):
+        # The first read of a lazy field loads all of them, rather than one query per field
+        return self.load_fields(field, *self.lazy_fields).db_fields.get(field)
+
+    def changed_fields(self):
+        """
+        Returns the set of fields whose values differ from db_fields
+        """
+        db_fields = self.db_fields
+        return frozenset(field for field, value in self._values.items() if value != db_fields.get(field))
+
     def should_update(self):
-        curr_values = self.to_dict()
-        return any(curr_values[field] != self.db_fields[field] for field in self.fields)
+        db_fields = self.db_fields
+        return any(value != db_fields.get(field) for field, value in self._values.items())
+
+    def _set_db_fields(self, db_fields):
+        """
+        Sets the row as written to (or read from) the database, discarding assigned values
+        """
+        self.db_fields = db_fields
+        self._values = {}
+
+    def _set_returned_fields(self, db_row, written):
+        """
+        Sets db_fields from a RETURNING row, which leaves out lazy_fields.  Lazy values which were
+        just written (written: { field : value }) or were already loaded are kept.
+        """
+        if self.lazy_fields:
+            old_fields = self.db_fields or {}
+            db_row = dict(db_row)
+            for field in self.lazy_fields:
+                if field in written:
+                    db_row[field] = copy.deepcopy(written[field])
+                elif old_fields.get(field, _unloaded) is not _unloaded:
+                    db_row[field] = old_fields[field]
+
+        self._set_db_fields(db_row)
 
     def update(self, force = False):
         """
@@ -266,10 +1115,12 @@ class DBTable(object):
             if force or self.should_update():
                 self.on_update()
                 self._update(force)
+                self._written()
                 self.after_update()
         else:
             self.on_insert()
             self._insert(force)
+            self._written()
             self.after_insert()
 
         return self
@@ -286,31 +1137,37 @@ class DBTable(object):
     def after_update(self):
         pass
 
+    def _insert_values(self):
+        """
+        Returns (fields, bind params) for inserting this object.  None values are left to the column defaults.
+        """
+        values = self.to_dict()
+        fields = [ field for field in self.fields if values[field] is not None ]
+        return fields, { field : values[field] for field in fields }
+
     def _insert(self, force = False):
         """
         Inserts a row into the database, and returns that row.
         """
-        kv = { x:y for x,y in self.to_dict().items() if y != None }
-        fields = kv.keys()
-        values = [ kv[x] for x in fields ]
-        sql = "INSERT INTO {table_name} ({fields}) VALUES ({values}) RETURNING *".format(
-            table_name = self.table_name,
-            fields = ', '.join(fields),
-            values = ', '.join([ "%({})s".format(x) for x in fields ]),
-        )
+        fields, kv = self._insert_values()
+
+        def build_sql():
+            return "INSERT INTO {table_name} ({fields}) VALUES ({values}) RETURNING {returning}".format(
+                table_name = self.table_name,
+                fields = ', '.join(fields),
+                values = ', '.join([ "%({})s".format(x) for x in fields ]),
+                returning = self._select_list(),
+            )
 
-        self.db_fields = fetch_results(self.conn, sql, **kv)[0]
+        sql = self._shape_sql(('insert', tuple(fields)), build_sql)
+        self._set_returned_fields(fetch_results(self.conn, sql, **kv)[0], kv)
         assert self.db_fields
 
-        for k, v in self.db_fields.items():
-            setattr(self, k, copy.deepcopy(v))
-
     def _update(self, force = False):
         """
         Updates a row in the database, and returns that row.
         """
-        new_values = self.to_dict()
-        bind_params = { x : new_values[x] for x in self.fields if new_values[x] != self.db_fields[x] }
+        bind_params = { x : getattr(self, x) for x in self.changed_fields() }
         if not bind_params:
             return self
 
@@ -333,33 +1190,33 @@ class DBTable(object):
                         getattr(self, key_field),
                     ))
 
-        field_equality = ', '.join([ "{0} = %({0})s".format(x) for x in bind_params.keys() ])
+        set_fields = tuple(sorted(bind_params))
 
         if self.id_field:
             fields = [ self.id_field ]
         elif self.key_fields:
             fields = self.key_fields
         else:
-            fields = self.db_fields.keys()
+            fields = list(self.db_fields.keys())
 
-        filter_clause = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in fields ])
         bind_params.update({ "orig_{}".format(x) : y for x, y in self.db_fields.items() })
 
-        sql = """
-            UPDATE {table_name}
-            SET {field_equality}
-            WHERE {filter_clause}
-            RETURNING *
-        """.format(
-            table_name     = self.table_name,
-            field_equality = field_equality,
-            filter_clause  = filter_clause,
-        )
+        def build_sql():
+            return """
+                UPDATE {table_name}
+                SET {field_equality}
+                WHERE {filter_clause}
+                RETURNING {returning}
+            """.format(
+                table_name     = self.table_name,
+                field_equality = ', '.join([ "{0} = %({0})s".format(x) for x in set_fields ]),
+                filter_clause  = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in fields ]),
+                returning      = self._select_list(),
+            )
 
-        self.db_fields = fetch_results(self.conn, sql, **bind_params)[0]
+        sql = self._shape_sql(('update', set_fields, tuple(fields)), build_sql)
+        self._set_returned_fields(fetch_results(self.conn, sql, **bind_params)[0], bind_params)
         assert self.db_fields
-        for k, v in self.db_fields.items():
-            setattr(self, k, copy.deepcopy(v))
 
     def delete(self):
         """
@@ -375,31 +1232,37 @@ class DBTable(object):
         else:
             fields = self.fields
 
-        filter_clause = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in fields ])
-        bind_params = { 'orig_{}'.format(x) : self.db_fields[x] for x in fields }
-
-        sql = """
-            DELETE FROM {table_name}
-            WHERE {filter_clause}
-            RETURNING *
-        """.format(
-            table_name    = self.table_name,
-            filter_clause = filter_clause,
-        )
+        def build_sql():
+            return """
+                DELETE FROM {table_name}
+                WHERE {filter_clause}
+                RETURNING *
+            """.format(
+                table_name    = self.table_name,
+                filter_clause = ' and '.join([ '{0} = %(orig_{0})s'.format(field) for field in fields ]),
+            )
 
-        objs = fetch_results(self.conn, sql, **bind_params)
+        bind_params = { 'orig_{}'.format(x) : self.db_fields[x] for x in fields }
+        objs = fetch_results(self.conn, self._shape_sql(('delete',), build_sql), **bind_params)
         assert objs
 
+        self._written(deleted = True)
+
         return objs
 
     def to_dict(self):
+        db_fields = self.db_fields
+        if db_fields and any(db_fields.get(field, _unloaded) is _unloaded for field in self.fields):
+            self.load_fields()
         return { field : getattr(self, field) for field in self.fields }
 
-    def commit(self):
-        self.conn.commit()
+    @classmethod
+    def commit(cls):
+        commit_conn(cls.conn)
 
-    def rollback(self):
-        self.conn.rollback()
+    @classmethod
+    def rollback(cls):
+        rollback_conn(cls.conn)
 
     @property
     def conn(cls):
@@ -409,3 +1272,162 @@ class DBTable(object):
     def get_conn(cls, new_conn):
         cls._conn = new_conn
 
+
+class TransactionCache(object):
+    """
+    The memoized DBTable rows written in a connection's open transaction, which only that
+    transaction can see.  They move into the shared caches when the transaction commits, and are
+    dropped when it rolls back.
+
+    This is opt in: only TransactionConnections (connection_factory = TransactionConnection) are
+    scoped, because they report every commit and rollback.  Rows written on other connections
+    are cached immediately, as a plain commit() couldn't promote them.  Transactions are held
+    weakly by connection, and dropped when their connection is closed.
+    """
+    by_conn = weakref.WeakKeyDictionary()
+
+    def __init__(self):
+        self.objs = {}
+
+    @classmethod
+    def current(cls, conn, create = False):
+        if not isinstance(conn, TransactionConnection) or (not create and not cls.by_conn):
+            return None
+
+        transaction = cls.by_conn.get(conn)
+        if transaction and (conn.closed or not in_transaction(conn)):
+            del cls.by_conn[conn]
+            transaction = None
+
+        if conn.closed:
+            return None
+
+        if not transaction and create:
+            transaction = cls.by_conn[conn] = cls()
+
+        return transaction
+
+    @classmethod
+    def transaction_ended(cls, conn, committed):
+        transaction = cls.by_conn.pop(conn, None)
+        if transaction and committed:
+            for obj in unique(transaction.objs.values()):
+                type(obj).cache_obj(obj)
+
+    @staticmethod
+    def cache_keys(obj):
+        cls = type(obj)
+        keys = []
+        if cls.id_field:
+            keys.append((cls, 'id', getattr(obj, cls.id_field)))
+        if cls.key_fields:
+            keys.append((cls, 'key', tuple(getattr(obj, field) for field in cls.key_fields)))
+        return keys
+
+    def get(self, cls, kind, key):
+        return self.objs.get((cls, kind, key))
+
+    def has(self, obj):
+        return any(key in self.objs for key in self.cache_keys(obj))
+
+    def add(self, obj):
+        for key in self.cache_keys(obj):
+            self.objs[key] = obj
+
+    def remove(self, obj):
+        for key in self.cache_keys(obj):
+            self.objs.pop(key, None)
+
+add_transaction_listener(TransactionCache.transaction_ended)
+
+
+class DBTableSession(object):
+    """
+    A unit of work for DBTable objects on one connection.  Objects read through any DBTable on the
+    connection while the session is open, and objects passed to add(), are tracked.  flush() (and
+    leaving the with block without an exception) writes them in batches:
+    - new objects with insert_many()
+    - changed objects with update_many(), one UPDATE per class and set of changed fields
+    - objects passed to delete() with delete_many()
+
+        with DBTable.session(conn) as session:
+            for order in Orders.find_by(status = 'new'):
+                order.status = 'processing'
+            session.add(Orders(customer_id = 1))
+            session.delete(old_order)
+
+    Flushing doesn't commit.  Sessions are per thread: reads only join the innermost session open
+    on their connection in the same thread.
+    """
+    local = threading.local()
+
+    def __init__(self, conn, batch_size = 1000):
+        self.conn       = conn
+        self.batch_size = batch_size
+        self.objs       = collections.OrderedDict()
+        self.deletes    = collections.OrderedDict()
+
+    @classmethod
+    def stack(cls):
+        try:
+            return cls.local.stack
+        except AttributeError:
+            stack = cls.local.stack = []
+            return stack
+
+    @classmethod
+    def current(cls, conn):
+        """
+        Returns the innermost session open on conn in this thread, or None
+        """
+        stack = getattr(cls.local, 'stack', None)
+        if stack:
+            for session in reversed(stack):
+                if session.conn is conn:
+                    return session
+
+    def __enter__(self):
+        self.stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        stack = self.stack()
+        for idx in reversed(range(len(stack))):
+            if stack[idx] is self:
+                del stack[idx]
+                break
+
+        if exc_type is None:
+            self.flush()
+
+    def add(self, *objs):
+        for obj in objs:
+            if obj.conn is not self.conn:
+                raise DBTableError("{} objects don't use this session's connection".format(obj.table_name))
+            self.objs[id(obj)] = obj
+
+    def delete(self, *objs):
+        for obj in objs:
+            self.objs.pop(id(obj), None)
+            self.deletes[id(obj)] = obj
+
+    @staticmethod
+    def by_class(objs):
+        classes = collections.OrderedDict()
+        for obj in objs:
+            classes.setdefault(type(obj), []).append(obj)
+        return classes.items()
+
+    def flush(self):
+        """
+        Writes new, changed and deleted objects.  Tracked objects stay tracked.
+        """
+        for cls, objs in self.by_class(self.objs.values()):
+            new_objs = [ obj for obj in objs if not obj.db_fields ]
+            cls.update_many([ obj for obj in objs if obj.db_fields ], batch_size = self.batch_size)
+            if new_objs:
+                cls.insert_many(new_objs, batch_size = self.batch_size)
+
+        deletes, self.deletes = self.deletes, collections.OrderedDict()
+        for cls, objs in self.by_class(deletes.values()):
+            cls.delete_many(objs, batch_size = self.batch_size)
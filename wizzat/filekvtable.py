@@ -0,0 +1,510 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import fcntl
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+import wizzat.kvcodec
+import wizzat.kvtable
+from wizzat.kvtable import KVTableCASError, TimingWheel
+from wizzat.util import mkdirp
+
+__all__ = [
+    'LogStore',
+    'FileKVTable',
+]
+
+class Segment(object):
+    """
+    One generation of a LogStore's data file: the file descriptor, its size, the index of live
+    records in it and a read only mmap of (at least) the part of the file the index refers to.
+    """
+    def __init__(self, fd, size, index):
+        self.fd    = fd
+        self.size  = size
+        self.index = index
+        self.mm    = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+
+class LogStore(object):
+    """
+    An append-only, log structured key/value file with an in-memory hash index.
+
+    The data file is a header (magic, format version, generation) followed by records:
+        crc32, key length, value length, version, flags, key, [expires at], value
+    Every write appends a record, and deletes append a tombstone record.  The index maps each
+    live key to its latest record.  Reads slice the value out of an mmap of the data file and
+    don't take any locks, so any number of threads may read while one writes.
+
+    Versions come from a store wide sequence, so a key's version increases with every write and
+    a deleted and re-created key never reuses a version.  put() and delete() take an optional
+    cas version and raise KVTableCASError if it doesn't match.
+
+    Compaction rewrites the live records into a new file and swaps it in.  Writes continue while
+    the live records are copied; records appended in the meantime are copied over at the end.
+    It runs in a background thread once more than compact_ratio of the file (and at least
+    compact_min_bytes) is garbage.
+
+    On a clean close (and after compaction) the index is saved to a hint file, so reopening only
+    replays records written after it.  Without a usable hint the whole log is replayed.  A torn
+    or corrupt record at the end of the log (from a crash mid-write) is truncated.
+
+    Records written with expires_at are not returned once it has passed.  Expired keys are
+    found with a timing wheel and deleted (with a tombstone) as later writes are made, or by
+    reclaim_expired(), and compaction drops them.  Format version 1 files (written before
+    expiry was supported) are upgraded in place when they are opened.
+
+    The data file is flock()ed, so only one process may open a store at a time.  With sync,
+    every write is fsync()ed.
+    """
+    magic          = b'WZKV'
+    hint_magic     = b'WZKH'
+    format_version = 2
+    header_struct  = struct.Struct(str('<4sIQ'))    # magic, format version, generation
+    record_struct  = struct.Struct(str('<IIIQB'))   # crc32, key length, value length, version, flags
+    expiry_struct  = struct.Struct(str('<d'))       # expires at (records with flag_expires)
+    hint_struct    = struct.Struct(str('<4sIQQQ'))  # magic, format version, generation, log size, max version
+    entry_struct   = struct.Struct(str('<QIIQd'))   # offset, key length, value length, version, expires at
+    flag_deleted   = 0x01
+    flag_expires   = 0x02
+
+    def __init__(self, path, sync = False, compact_ratio = 0.5, compact_min_bytes = 1024 * 1024):
+        mkdirp(os.path.dirname(os.path.abspath(path)))
+
+        self.path              = path
+        self.hint_path         = path + '.hint'
+        self.sync              = sync
+        self.compact_ratio     = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.lock              = threading.RLock()
+        self.compact_lock      = threading.Lock()
+        self.compact_thread    = None
+        self.max_version       = 0
+        self.dead_bytes        = 0
+        self.expiry_wheel      = TimingWheel()
+        self.segment           = self._open()
+
+        for key, entry in self.segment.index.items():
+            if entry[4]:
+                self.expiry_wheel.add(key, entry[4])
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        size = os.fstat(fd).st_size
+        if size < self.header_struct.size:
+            generation = random.getrandbits(63)
+            os.ftruncate(fd, 0)
+            self._write(fd, self.header_struct.pack(self.magic, self.format_version, generation))
+            os.fsync(fd)
+            size = self.header_struct.size
+
+        os.lseek(fd, 0, os.SEEK_SET)
+        magic, format_version, generation = self.header_struct.unpack(os.read(fd, self.header_struct.size))
+        if magic != self.magic:
+            raise ValueError("{} is not a LogStore".format(self.path))
+        if format_version > self.format_version:
+            raise ValueError("{} has unknown format version {}".format(self.path, format_version))
+        if format_version < self.format_version:
+            # Older records are still readable, only the header needs to change
+            self._upgrade_header(generation)
+
+        index, start = self._read_hint(generation, size)
+        segment = Segment(fd, size, index)
+        segment.generation = generation
+
+        size = self._replay(segment, start)
+        if size != segment.size:
+            os.ftruncate(fd, size)
+            segment.size = size
+
+        self.dead_bytes = segment.size - self.header_struct.size - sum(self._record_size(entry) for entry in index.values())
+
+        return segment
+
+    def _upgrade_header(self, generation):
+        with open(self.path, 'r+b') as fp:
+            fp.write(self.header_struct.pack(self.magic, self.format_version, generation))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def _read_hint(self, generation, size):
+        """
+        Returns (index, offset to replay from)
+        """
+        try:
+            with open(self.hint_path, 'rb') as fp:
+                content = fp.read()
+
+            magic, format_version, hint_generation, hint_size, max_version = self.hint_struct.unpack_from(content, 0)
+            if magic != self.hint_magic or format_version != self.format_version or hint_generation != generation or hint_size > size:
+                raise ValueError()
+
+            index = {}
+            ptr = self.hint_struct.size
+            while ptr < len(content):
+                entry = self.entry_struct.unpack_from(content, ptr)
+                ptr += self.entry_struct.size
+                index[content[ptr:ptr + entry[1]].decode('utf8')] = entry
+                ptr += entry[1]
+
+            self.max_version = max_version
+            return index, hint_size
+        except (IOError, OSError, ValueError, struct.error):
+            return {}, self.header_struct.size
+
+    def _write_hint(self, segment):
+        parts = [ self.hint_struct.pack(self.hint_magic, self.format_version, segment.generation, segment.size, self.max_version) ]
+        for key, entry in segment.index.items():
+            parts.append(self.entry_struct.pack(*entry))
+            parts.append(key.encode('utf8'))
+
+        tmp_path = self.hint_path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(b''.join(parts))
+        os.rename(tmp_path, self.hint_path)
+
+    def _replay(self, segment, offset):
+        """
+        Applies the records in segment from offset onwards to its index.
+        Returns the offset of the end of the last valid record.
+        """
+        mm = segment.mm
+        while offset + self.record_struct.size <= segment.size:
+            crc, key_len, value_len, version, flags = self.record_struct.unpack_from(mm, offset)
+            end = offset + self.record_struct.size + key_len + value_len
+            if end > segment.size or crc != self._crc(mm[offset + 4:end]):
+                break
+
+            start = offset + self.record_struct.size
+            key = mm[start:start + key_len].decode('utf8')
+            expires_at = self.expiry_struct.unpack_from(mm, start + key_len)[0] if flags & self.flag_expires else 0
+            self._apply(segment.index, key, (offset, key_len, value_len, version, expires_at), flags)
+            offset = end
+
+        return offset
+
+    def _apply(self, index, key, entry, flags):
+        self.max_version = max(self.max_version, entry[3])
+        if flags & self.flag_deleted:
+            return index.pop(key, None)
+        else:
+            previous, index[key] = index.get(key), entry
+            return previous
+
+    @staticmethod
+    def _crc(content):
+        return zlib.crc32(content) & 0xffffffff
+
+    @staticmethod
+    def _write(fd, content):
+        content = memoryview(content)
+        while content:
+            content = content[os.write(fd, content):]
+
+    def _record_size(self, entry):
+        return self.record_struct.size + entry[1] + entry[2]
+
+    def _pack_record(self, key, value, version, flags):
+        body = self.record_struct.pack(0, len(key), len(value), version, flags)[4:] + key + value
+        return struct.pack(str('<I'), self._crc(body)) + body
+
+    def _remap(self, segment):
+        with self.lock:
+            if len(segment.mm) < segment.size:
+                segment.mm = mmap.mmap(segment.fd, segment.size, access=mmap.ACCESS_READ)
+            return segment.mm
+
+    @staticmethod
+    def _live(entry, now = None):
+        return entry if entry and not (entry[4] and entry[4] <= (now or time.time())) else None
+
+    def get(self, key):
+        """
+        Returns (version, value), or (None, None) if key doesn't exist
+        """
+        return self.lookup(key)[:2]
+
+    def lookup(self, key):
+        """
+        Returns (version, value, expires at), or (None, None, None) if key doesn't exist
+        """
+        segment = self.segment
+        entry = self._live(segment.index.get(key))
+        if not entry:
+            return None, None, None
+
+        offset, key_len, value_len, version, expires_at = entry
+        start = offset + self.record_struct.size + key_len
+        if expires_at:
+            start += self.expiry_struct.size
+            value_len -= self.expiry_struct.size
+
+        mm = segment.mm
+        if start + value_len > len(mm):
+            mm = self._remap(segment)
+
+        return version, mm[start:start + value_len], expires_at
+
+    def version(self, key):
+        entry = self._live(self.segment.index.get(key))
+        return entry[3] if entry else None
+
+    def keys(self):
+        now = time.time()
+        return [ key for key, entry in list(self.segment.index.items()) if self._live(entry, now) ]
+
+    def __len__(self):
+        """
+        Returns the number of keys, including expired keys which haven't been reclaimed yet
+        """
+        return len(self.segment.index)
+
+    def put(self, key, value, cas = None, create = False, expires_at = 0):
+        """
+        Writes value for key and returns its new version.  The key expires at expires_at (0: never).
+        Raises KVTableCASError if create and the key exists, or cas doesn't match the current version.
+        """
+        version = self._append(key, value, 0, cas, create, expires_at)
+        self.reclaim_expired()
+        return version
+
+    def delete(self, key, cas = None):
+        """
+        Deletes key.  Raises KVTableCASError if cas doesn't match the current version.
+        """
+        self._append(key, b'', self.flag_deleted, cas, False)
+
+    def reclaim_expired(self):
+        """
+        Deletes the keys which have expired since the last call
+        """
+        now = time.time()
+        for key in self.expiry_wheel.expired(now):
+            with self.lock:
+                entry = self.segment.index.get(key)
+                if entry and entry[4] and entry[4] <= now:
+                    self._append(key, b'', self.flag_deleted, None, False)
+
+    def _append(self, key, value, flags, cas, create, expires_at = 0):
+        with self.lock:
+            segment = self.segment
+            current = segment.index.get(key)
+            live = self._live(current)
+
+            if create and live:
+                raise KVTableCASError("{} already exists".format(key))
+            if cas is not None and (live[3] if live else None) != cas:
+                raise KVTableCASError("{} has changed".format(key))
+            if flags & self.flag_deleted and not current:
+                return None
+
+            if expires_at:
+                flags |= self.flag_expires
+                value = self.expiry_struct.pack(expires_at) + value
+
+            version = self.max_version + 1
+            key_bytes = key.encode('utf8')
+            record = self._pack_record(key_bytes, value, version, flags)
+
+            self._write(segment.fd, record)
+            if self.sync:
+                os.fsync(segment.fd)
+
+            offset, segment.size = segment.size, segment.size + len(record)
+            self._apply(segment.index, key, (offset, len(key_bytes), len(value), version, expires_at), flags)
+            if expires_at:
+                self.expiry_wheel.add(key, expires_at)
+
+            if current:
+                self.dead_bytes += self._record_size(current)
+            if flags & self.flag_deleted:
+                self.dead_bytes += len(record)
+
+        self.maybe_compact()
+        return version
+
+    def needs_compaction(self):
+        return self.dead_bytes >= self.compact_min_bytes and self.dead_bytes >= self.compact_ratio * self.segment.size
+
+    def maybe_compact(self):
+        """
+        Starts a background compaction if there is enough garbage and one isn't already running
+        """
+        if self.compact_ratio and self.needs_compaction() and not self.compact_lock.locked():
+            self.compact_thread = threading.Thread(target=self.compact, name='LogStore.compact')
+            self.compact_thread.daemon = True
+            self.compact_thread.start()
+
+    def compact(self):
+        """
+        Rewrites the live records into a new data file
+        """
+        if not self.compact_lock.acquire(False):
+            return
+
+        try:
+            tmp_path   = self.path + '.compact'
+            generation = random.getrandbits(63)
+            fd         = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            try:
+                with self.lock:
+                    segment  = self.segment
+                    now      = time.time()
+                    snapshot = sorted((item for item in segment.index.items() if self._live(item[1], now)), key=lambda item: item[1][0])
+                    end      = segment.size
+                mm = self._remap(segment)
+
+                index = {}
+                parts = [ self.header_struct.pack(self.magic, self.format_version, generation) ]
+                size  = len(parts[0])
+                for key, entry in snapshot:
+                    record = mm[entry[0]:entry[0] + self._record_size(entry)]
+                    index[key] = (size,) + entry[1:]
+                    parts.append(record)
+                    size += len(record)
+
+                    if len(parts) >= 1024:
+                        self._write(fd, b''.join(parts))
+                        parts = []
+                self._write(fd, b''.join(parts))
+
+                with self.lock:
+                    # Copy over everything written while the snapshot was being copied
+                    mm = self._remap(segment)
+                    tail = mm[end:segment.size]
+                    self._write(fd, tail)
+                    os.fsync(fd)
+
+                    new_segment = Segment(fd, size + len(tail), index)
+                    new_segment.generation = generation
+                    self._replay(new_segment, size)
+
+                    os.rename(tmp_path, self.path)
+                    self.segment    = new_segment
+                    self.dead_bytes = new_segment.size - self.header_struct.size - sum(self._record_size(entry) for entry in index.values())
+                    self._write_hint(new_segment)
+                    os.close(segment.fd)
+            except Exception:
+                os.close(fd)
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        finally:
+            self.compact_lock.release()
+
+    def close(self):
+        """
+        Waits for compaction, saves the hint file and closes the data file
+        """
+        if self.compact_thread:
+            self.compact_thread.join()
+
+        with self.lock:
+            if self.segment:
+                self._write_hint(self.segment)
+                self.segment.mm.close()
+                os.close(self.segment.fd)
+                self.segment = None
+
+class FileKVTable(wizzat.kvtable.KVTable):
+    """
+    A KVTable backed by a local LogStore file.  Tables with the same path share one store.
+    kv_data is (record version, expires at).  The version is checked on update and delete: a
+    stale object raises KVTableCASError.  Documents are serialized with the codec, or JSON
+    without one.  Documents with a ttl expire in the store.
+
+    Params (on top of KVTable options):
+    path:               string, the LogStore data file
+    sync:               bool, fsync after every write
+    compact_ratio:      float, compact in the background when this fraction of the file is garbage (0 disables)
+    compact_min_bytes:  int, don't compact until there is at least this much garbage
+    """
+    __slots__         = ()
+    memoize           = False
+    table_name        = ''
+    key_fields        = []
+    fields            = []
+    path              = None
+    sync              = False
+    compact_ratio     = 0.5
+    compact_min_bytes = 1024 * 1024
+    stores            = {}
+    stores_lock       = threading.Lock()
+    storage_attrs     = ('path', 'sync', 'compact_ratio', 'compact_min_bytes')
+    json_codec        = wizzat.kvcodec.JSONCodec()
+
+    @classmethod
+    def store(cls):
+        path = os.path.abspath(os.path.expanduser(cls.path))
+        try:
+            return cls.stores[path]
+        except KeyError:
+            with cls.stores_lock:
+                if path not in cls.stores:
+                    cls.stores[path] = LogStore(path,
+                        sync              = cls.sync,
+                        compact_ratio     = cls.compact_ratio,
+                        compact_min_bytes = cls.compact_min_bytes,
+                    )
+                return cls.stores[path]
+
+    @classmethod
+    def close_stores(cls):
+        """
+        Closes every open store (they are reopened on demand)
+        """
+        with cls.stores_lock:
+            for store in cls.stores.values():
+                store.close()
+            cls.stores.clear()
+
+    @classmethod
+    def decode_data(cls, content):
+        return (cls._codec or cls.json_codec).decode(content)
+
+    def encode_data(self):
+        return (self._codec or self.json_codec).encode(self._data)
+
+    @classmethod
+    def _find_by_key(cls, kv_key):
+        version, content, expires_at = cls.store().lookup(kv_key)
+        if version is None:
+            return None, None
+        return (version, expires_at), cls.decode_data(content)
+
+    @classmethod
+    def _kv_cas(cls, kv_data):
+        return kv_data[0] if kv_data else None
+
+    @classmethod
+    def _kv_expires_at(cls, kv_data):
+        return kv_data[1]
+
+    @classmethod
+    def _find_cas_by_key(cls, kv_key):
+        return cls.store().version(kv_key)
+
+    def _put(self, **kwargs):
+        ttl = self.write_ttl()
+        expires_at = time.time() + ttl if ttl else 0
+        return self.store().put(self._key, self.encode_data(), expires_at = expires_at, **kwargs), expires_at
+
+    def _insert(self, force=False):
+        return self._put(create = not force)
+
+    def _update(self, force=False):
+        return self._put(cas = None if force else self._kv_cas(self._kv_data))
+
+    def _delete(self, force=False):
+        self.store().delete(self._key, cas = None if force else self._kv_cas(self._kv_data))
+        return None
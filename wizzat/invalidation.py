@@ -0,0 +1,435 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import errno
+import fcntl
+import json
+import mmap
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from wizzat.util import mkdirp
+
+__all__ = [
+    'InvalidationBus',
+    'UnixSocketBus',
+    'MmapRingBus',
+    'PgNotifyBus',
+]
+
+class InvalidationBus(object):
+    """
+    Cross-process cache invalidation for memoized KVTable and DBTable classes.
+
+    Every write through a table with an invalidation_bus publishes the (table_name, key) it
+    touched.  Other processes poll() the bus and evict those keys from their local caches.  A key
+    of None evicts the whole table.
+
+    Publishing is coalesced: messages are buffered in a set until batch_size messages are pending
+    or flush_interval seconds have passed (0 sends immediately).  A timer armed by the first
+    pending message flushes them once flush_interval has passed, even if nothing else is published.  Receiving is coalesced as well;
+    each distinct (table_name, key) is evicted once per poll, however many writes touched it.
+
+    Tables register themselves when they are created with an invalidation_bus.  Subscribers either
+    call poll() themselves, call start() to poll from a background thread, or rely on the tables
+    calling maybe_poll() (at most once per poll_interval) on every cache lookup.
+
+    Subclasses implement _send(messages, conn) and _receive(), which returns (messages, overflowed).
+    If overflowed is true, messages were lost and every registered table is cleared.
+    """
+    def __init__(self, batch_size = 100, flush_interval = 0, poll_interval = 0.1):
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval  = poll_interval
+        self.origin         = random.getrandbits(32)
+        self.tables         = collections.defaultdict(list)
+        self.pending        = set()
+        self.lock           = threading.RLock()
+        self.last_flush     = time.time()
+        self.last_poll      = time.time()
+        self.thread         = None
+        self.timer          = None
+        self.stopped        = threading.Event()
+
+    def register(self, table_cls):
+        """
+        Registers a table class for eviction.  It must provide evict_cached(key) and clear_cache().
+        """
+        self.tables[table_cls.table_name].append(table_cls)
+
+    def publish(self, table_name, key, conn = None):
+        """
+        Queues an invalidation for (table_name, key), and flushes if the batch is full or old enough.
+        """
+        with self.lock:
+            self.pending.add(json.dumps([ table_name, key ], sort_keys=True))
+
+            if len(self.pending) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+                self.flush(conn)
+            elif not self.timer:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self, conn = None):
+        """
+        Sends all pending invalidations
+        """
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+            messages, self.pending = sorted(self.pending), set()
+            self.last_flush = time.time()
+
+            if messages:
+                self._send(messages, conn)
+
+    def poll(self):
+        """
+        Drains received invalidations and evicts them from the registered tables.
+        Returns the number of distinct keys evicted.
+        """
+        with self.lock:
+            self.last_poll = time.time()
+            messages, overflowed = self._receive()
+
+        if overflowed:
+            for table_classes in self.tables.values():
+                for table_cls in table_classes:
+                    table_cls.clear_cache()
+
+        messages = set(messages)
+        for message in messages:
+            table_name, key = json.loads(message)
+            for table_cls in self.tables.get(table_name, ()):
+                if key is None:
+                    table_cls.clear_cache()
+                else:
+                    table_cls.evict_cached(key)
+
+        if self.pending and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+        return len(messages)
+
+    def maybe_poll(self):
+        """
+        Polls if poll_interval has passed since the last poll
+        """
+        if time.time() - self.last_poll >= self.poll_interval:
+            self.poll()
+
+    def start(self):
+        """
+        Polls (and flushes) from a daemon thread every poll_interval seconds
+        """
+        def run():
+            while not self.stopped.wait(self.poll_interval):
+                self.poll()
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=run, name='InvalidationBus')
+        self.thread.daemon = True
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.flush()
+
+    def encode(self, messages):
+        return json.dumps([ self.origin, messages ]).encode('utf8')
+
+    def payloads(self, messages, max_bytes):
+        """
+        Encodes messages into payloads of at most max_bytes (unless a single message is larger)
+        """
+        overhead = len(self.encode([]))
+        batch, size = [], overhead
+
+        for message in messages:
+            message_size = len(json.dumps(message).encode('utf8')) + 2
+            if batch and size + message_size > max_bytes:
+                yield self.encode(batch)
+                batch, size = [], overhead
+
+            batch.append(message)
+            size += message_size
+
+        if batch:
+            yield self.encode(batch)
+
+    def decode(self, payload):
+        """
+        Returns the messages in payload, or [] if they were sent by this bus
+        """
+        origin, messages = json.loads(payload.decode('utf8'))
+        return [] if origin == self.origin else messages
+
+    def _send(self, messages, conn):
+        raise NotImplementedError()
+
+    def _receive(self):
+        raise NotImplementedError()
+
+class UnixSocketBus(InvalidationBus):
+    """
+    Single host invalidation over Unix datagram sockets.  Every bus binds a socket in `path` and
+    sends each batch to every other socket in that directory.  Sockets left behind by dead
+    processes are removed when a send to them is refused.
+
+    Batches are split into datagrams of at most max_datagram bytes.  A peer whose receive buffer
+    stays full for send_timeout seconds misses that datagram.
+    """
+    def __init__(self, path, max_datagram = 8192, send_timeout = 0.1, peer_refresh = 1.0, **kwargs):
+        super(UnixSocketBus, self).__init__(**kwargs)
+        mkdirp(path)
+
+        self.path         = path
+        self.max_datagram = max_datagram
+        self.peer_refresh = peer_refresh
+        self.peers        = []
+        self.peers_time   = 0
+        self.sock_path    = os.path.join(path, '{}.{}.sock'.format(os.getpid(), self.origin))
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.sock_path)
+        self.sock.setblocking(False)
+
+        self.send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.send_sock.settimeout(send_timeout)
+
+    def close(self):
+        super(UnixSocketBus, self).close()
+        self.sock.close()
+        self.send_sock.close()
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+
+    def _peer_paths(self):
+        if time.time() - self.peers_time >= self.peer_refresh:
+            self.peers = [
+                os.path.join(self.path, filename)
+                for filename in os.listdir(self.path)
+                if filename.endswith('.sock') and os.path.join(self.path, filename) != self.sock_path
+            ]
+            self.peers_time = time.time()
+
+        return self.peers
+
+    def _send(self, messages, conn):
+        datagrams = list(self.payloads(messages, self.max_datagram))
+
+        for peer in list(self._peer_paths()):
+            for datagram in datagrams:
+                try:
+                    self.send_sock.sendto(datagram, peer)
+                except socket.timeout:
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        self.peers.remove(peer)
+                        if e.errno == errno.ECONNREFUSED and os.path.exists(peer):
+                            os.unlink(peer)
+                        break
+                    raise
+
+    def _receive(self):
+        messages = []
+        while True:
+            try:
+                messages.extend(self.decode(self.sock.recv(65536)))
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return messages, False
+                raise
+
+class MmapRingBus(InvalidationBus):
+    """
+    Single host invalidation through a ring buffer in a shared memory mapped file.
+
+    Writers append records under an exclusive flock, readers copy out new records under a shared
+    flock.  A reader which falls more than `slots` records behind has lost messages, and clears
+    every registered table.  A single message too large for a slot is sent as a whole-table
+    invalidation.
+    """
+    magic         = b'WZRB'
+    header_struct = struct.Struct(str('<4sIIQ'))  # magic, slots, slot size, next sequence number
+    record_struct = struct.Struct(str('<QIH'))    # sequence number, origin, payload length
+
+    def __init__(self, path, slots = 4096, slot_size = 512, **kwargs):
+        super(MmapRingBus, self).__init__(**kwargs)
+        mkdirp(os.path.dirname(os.path.abspath(path)))
+
+        self.path      = path
+        self.fd        = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, self.header_struct.size + slots * slot_size)
+                os.write(self.fd, self.header_struct.pack(self.magic, slots, slot_size, 0))
+
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            magic, self.slots, self.slot_size, self.read_seq = self.header_struct.unpack(os.read(self.fd, self.header_struct.size))
+            if magic != self.magic:
+                raise ValueError("{} is not an invalidation ring".format(path))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        self.mm = mmap.mmap(self.fd, self.header_struct.size + self.slots * self.slot_size)
+        self.max_payload = self.slot_size - self.record_struct.size
+
+    def close(self):
+        super(MmapRingBus, self).close()
+        self.mm.close()
+        os.close(self.fd)
+
+    def _slot_offset(self, seq):
+        return self.header_struct.size + (seq % self.slots) * self.slot_size
+
+    def _send(self, messages, conn):
+        messages = [
+            message if len(self.encode([ message ])) <= self.max_payload else json.dumps([ json.loads(message)[0], None ])
+            for message in messages
+        ]
+        payloads = list(self.payloads(messages, self.max_payload))
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            magic, slots, slot_size, seq = self.header_struct.unpack_from(self.mm, 0)
+            for payload in payloads:
+                offset = self._slot_offset(seq)
+                self.record_struct.pack_into(self.mm, offset, seq, self.origin, len(payload))
+                self.mm[offset + self.record_struct.size:offset + self.record_struct.size + len(payload)] = payload
+                seq += 1
+
+            self.header_struct.pack_into(self.mm, 0, magic, slots, slot_size, seq)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _receive(self):
+        messages   = []
+        overflowed = False
+
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            magic, slots, slot_size, seq = self.header_struct.unpack_from(self.mm, 0)
+
+            if seq - self.read_seq > self.slots:
+                overflowed    = True
+                self.read_seq = seq
+
+            while self.read_seq < seq:
+                offset = self._slot_offset(self.read_seq)
+                record_seq, origin, length = self.record_struct.unpack_from(self.mm, offset)
+                payload_offset = offset + self.record_struct.size
+
+                if record_seq != self.read_seq:
+                    overflowed = True
+                elif origin != self.origin:
+                    messages.extend(json.loads(self.mm[payload_offset:payload_offset + length].decode('utf8'))[1])
+
+                self.read_seq += 1
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+        return messages, overflowed
+
+class PgNotifyBus(InvalidationBus):
+    """
+    Invalidation through Postgres LISTEN/NOTIFY, for DBTable.
+
+    Notifications are issued on the writing connection, so they are only delivered if (and when)
+    the transaction commits.  On connections which report their commits (TransactionConnection,
+    or commit_conn()), the keys written in a transaction are buffered and coalesced, and sent just
+    before it commits (or when batch_size are pending) with one statement.  They are dropped if it
+    rolls back.  Other connections can't tell when they commit, so they send on every publish.
+
+    `listen_conn` must be a dedicated autocommit connection.  Payloads are limited to 8000 bytes,
+    and larger batches are split into several notifications.
+    """
+    max_payload = 8000
+
+    def __init__(self, listen_conn, channel = 'wizzat_invalidation', **kwargs):
+        super(PgNotifyBus, self).__init__(**kwargs)
+        from wizzat.pghelper import execute, add_precommit_listener, add_transaction_listener, TransactionConnection
+
+        self.execute               = execute
+        self.listen_conn           = listen_conn
+        self.channel               = channel
+        self.transaction_conn_type = TransactionConnection
+        self.transactions          = {}
+        execute(listen_conn, 'LISTEN {}'.format(channel))
+
+        add_precommit_listener(self.flush_transaction)
+        add_transaction_listener(self.end_transaction)
+
+    def publish(self, table_name, key, conn = None):
+        message = json.dumps([ table_name, key ], sort_keys=True)
+        if not conn or conn.autocommit or not isinstance(conn, self.transaction_conn_type):
+            self._send([ message ], conn)
+            return
+
+        with self.lock:
+            pending = self.transactions.setdefault(conn, set())
+            pending.add(message)
+            full = len(pending) >= self.batch_size
+
+        if full:
+            self.flush_transaction(conn)
+
+    def close(self):
+        """
+        Stops and flushes the bus, and unregisters it from the transaction listeners
+        """
+        from wizzat.pghelper import remove_precommit_listener, remove_transaction_listener
+
+        super(PgNotifyBus, self).close()
+        remove_precommit_listener(self.flush_transaction)
+        remove_transaction_listener(self.end_transaction)
+
+    def flush_transaction(self, conn):
+        """
+        Sends the invalidations buffered for conn's transaction (on conn)
+        """
+        with self.lock:
+            messages = self.transactions.pop(conn, None)
+
+        if messages:
+            self._send(sorted(messages), conn)
+
+    def end_transaction(self, conn, committed):
+        with self.lock:
+            self.transactions.pop(conn, None)
+
+    def _send(self, messages, conn):
+        self.execute(conn or self.listen_conn, "SELECT pg_notify(%(channel)s, payload) FROM unnest(%(payloads)s) AS payload",
+            channel  = self.channel,
+            payloads = [ payload.decode('utf8') for payload in self.payloads(messages, self.max_payload) ],
+        )
+
+    def _receive(self):
+        messages = []
+
+        self.listen_conn.poll()
+        while self.listen_conn.notifies:
+            notify = self.listen_conn.notifies.pop(0)
+            messages.extend(self.decode(notify.payload.encode('utf8')))
+
+        return messages, False
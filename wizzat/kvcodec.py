@@ -0,0 +1,240 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import six
+import struct
+import zlib
+from wizzat.serialization import pack_iterable, unpack_iterable, write_int_set, read_int_set
+
+__all__ = [
+    'CodecError',
+    'JSONCodec',
+    'BinaryCodec',
+]
+
+class CodecError(Exception): pass
+
+class JSONCodec(object):
+    """
+    Encodes documents as JSON text.  This is the format KVTable backends have always used.
+    """
+    def __init__(self, encoder = json.dumps, decoder = json.loads):
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def bind(self, table_cls):
+        """
+        Returns a codec specialized for table_cls.  JSON doesn't depend on the schema.
+        """
+        return self
+
+    def encode(self, data):
+        content = self.encoder(data)
+        return content.encode('utf8') if isinstance(content, six.text_type) else content
+
+    def decode(self, content):
+        if isinstance(content, six.binary_type):
+            content = content.decode('utf8')
+        return self.decoder(content)
+
+    def iterencode(self, data):
+        """
+        Encodes data in chunks, without building the whole document when the encoder is json.dumps
+        """
+        if self.encoder is not json.dumps:
+            yield self.encode(data)
+            return
+
+        for chunk in json.JSONEncoder().iterencode(data):
+            yield chunk.encode('utf8') if isinstance(chunk, six.text_type) else chunk
+
+class BinaryCodec(JSONCodec):
+    """
+    A compact, schema driven binary encoding derived from a table's fields and field_types.
+
+    Layout: a header (magic byte, format version, flags, number of fields), a null bitmap, the
+    fixed width fields packed with a single struct, then length prefixed variable width fields,
+    then a JSON blob of any document keys which aren't in fields.  The body is zlib compressed
+    when it is larger than compress_threshold bytes.
+
+    Supported field_types:
+        int, float, bool:   fixed width ('q', 'd', '?')
+        six.text_type:      utf8
+        six.binary_type:    raw bytes
+        [int]:              integer list, serialization.pack_iterable
+        {int}:              integer set (0 <= x < 2**38), serialization.write_int_set.  Decodes as a set.
+        anything else:      JSON
+
+    Fields may be appended to a table without re-encoding existing documents.  Reordering or
+    retyping fields requires a new table.  Documents which don't start with the magic byte (i.e.
+    JSON written before the codec was enabled) are decoded as JSON, and documents whose values
+    don't fit their declared types are encoded as JSON.
+    """
+    magic          = 0xb1
+    version        = 1
+    flag_zlib      = 0x01
+    header_struct  = struct.Struct(str('<BBBH'))
+    length_struct  = struct.Struct(str('<I'))
+    fixed_codes    = { int : 'q', float : 'd', bool : '?' }
+
+    def __init__(self, compress_threshold = 1024, compress_level = 6, fields = (), field_types = None):
+        super(BinaryCodec, self).__init__()
+        self.compress_threshold = compress_threshold
+        self.compress_level     = compress_level
+        self.fields             = list(fields)
+        self.field_types        = dict(field_types or {})
+        self.field_set          = set(self.fields)
+        self.fixed_structs      = {}
+
+        # (index, field) of the fixed width fields and (index, field, pack, unpack) of the rest, in field order
+        kinds = [ self.kind(field) for field in self.fields ]
+        self.fixed_plan    = [ (idx, field) for idx, (field, kind) in enumerate(zip(self.fields, kinds)) if kind in self.fixed_codes ]
+        self.variable_plan = [
+            (idx, field) + self.variable_codec(kind)
+            for idx, (field, kind) in enumerate(zip(self.fields, kinds))
+            if kind not in self.fixed_codes
+        ]
+
+    def bind(self, table_cls):
+        return type(self)(
+            compress_threshold = self.compress_threshold,
+            compress_level     = self.compress_level,
+            fields             = table_cls.fields,
+            field_types        = table_cls.field_types,
+        )
+
+    def kind(self, field):
+        field_type = self.field_types.get(field)
+
+        if field_type in six.integer_types:
+            return int
+        elif field_type in (float, bool, six.text_type, six.binary_type):
+            return field_type
+        elif field_type == [ int ]:
+            return list
+        elif field_type == { int }:
+            return set
+        else:
+            return None
+
+    def variable_codec(self, kind):
+        """
+        Returns (pack, unpack) functions for a variable width field of kind
+        """
+        if kind is six.text_type:
+            return (lambda value: value.encode('utf8')), (lambda content: content.decode('utf8'))
+        elif kind is six.binary_type:
+            return (lambda value: value), (lambda content: content)
+        elif kind is list:
+            return (lambda value: pack_iterable(value, 'q')), (lambda content: unpack_iterable(content, 'q'))
+        elif kind is set:
+            return write_int_set, read_int_set
+        else:
+            return super(BinaryCodec, self).encode, super(BinaryCodec, self).decode
+
+    def fixed_struct(self, num_fields):
+        """
+        Returns (struct, fixed fields) for the first num_fields fields
+        """
+        if num_fields not in self.fixed_structs:
+            fixed_fields = [ field for idx, field in self.fixed_plan if idx < num_fields ]
+            self.fixed_structs[num_fields] = (
+                struct.Struct(str('<' + ''.join(self.fixed_codes[self.kind(field)] for field in fixed_fields))),
+                fixed_fields,
+            )
+
+        return self.fixed_structs[num_fields]
+
+    def encode(self, data):
+        try:
+            body = self.encode_body(data)
+        except (struct.error, OverflowError, TypeError, ValueError, AttributeError):
+            return super(BinaryCodec, self).encode(data)
+
+        flags = 0
+        if self.compress_threshold and len(body) > self.compress_threshold:
+            flags |= self.flag_zlib
+            body = zlib.compress(body, self.compress_level)
+
+        return self.header_struct.pack(self.magic, self.version, flags, len(self.fields)) + body
+
+    def iterencode(self, data):
+        yield self.encode(data)
+
+    def encode_body(self, data):
+        fixed_struct, fixed_fields = self.fixed_struct(len(self.fields))
+
+        null_bitmap = bytearray((len(self.fields) + 7) // 8)
+        for idx, field in enumerate(self.fields):
+            if data.get(field) is None:
+                null_bitmap[idx // 8] |= 1 << (idx % 8)
+
+        parts = [
+            bytes(null_bitmap),
+            fixed_struct.pack(*[ data.get(field) or 0 for field in fixed_fields ]),
+        ]
+
+        for idx, field, pack, unpack in self.variable_plan:
+            value = data.get(field)
+            content = b'' if value is None else pack(value)
+
+            parts.append(self.length_struct.pack(len(content)))
+            parts.append(content)
+
+        extras = { k : v for k, v in six.iteritems(data) if k not in self.field_set }
+        content = super(BinaryCodec, self).encode(extras) if extras else b''
+        parts.append(self.length_struct.pack(len(content)))
+        parts.append(content)
+
+        return b''.join(parts)
+
+    def decode(self, content):
+        if isinstance(content, six.text_type) or not content or bytearray(content[:1])[0] != self.magic:
+            return super(BinaryCodec, self).decode(content)
+
+        magic, version, flags, num_fields = self.header_struct.unpack_from(content, 0)
+        if version != self.version:
+            raise CodecError("Unknown binary codec version {}".format(version))
+        if num_fields > len(self.fields):
+            raise CodecError("Document has {} fields, but the table only has {}".format(num_fields, len(self.fields)))
+
+        body = content[self.header_struct.size:]
+        if flags & self.flag_zlib:
+            body = zlib.decompress(body)
+
+        null_bitmap = bytearray(body[:(num_fields + 7) // 8])
+        ptr = len(null_bitmap)
+
+        fixed_struct, fixed_fields = self.fixed_struct(num_fields)
+        data = dict(zip(fixed_fields, fixed_struct.unpack_from(body, ptr)))
+        ptr += fixed_struct.size
+
+        for idx, field in self.fixed_plan:
+            if idx >= num_fields:
+                break
+            if null_bitmap[idx // 8] & (1 << (idx % 8)):
+                data[field] = None
+
+        for idx, field, pack, unpack in self.variable_plan:
+            if idx >= num_fields:
+                break
+
+            length, = self.length_struct.unpack_from(body, ptr)
+            ptr += self.length_struct.size
+            value = body[ptr:ptr + length]
+            ptr += length
+
+            data[field] = None if null_bitmap[idx // 8] & (1 << (idx % 8)) else unpack(value)
+
+        for field in self.fields[num_fields:]:
+            data[field] = None
+
+        length, = self.length_struct.unpack_from(body, ptr)
+        ptr += self.length_struct.size
+        if length:
+            data.update(super(BinaryCodec, self).decode(body[ptr:ptr + length]))
+
+        return data
@@ -3,23 +3,309 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import random
 import six
+import threading
+import time
 import wizzat.decorators
+import wizzat.textutil
 from wizzat.util import set_defaults
 
 __all__ = [
     'KVTableError',
     'KVTableConfigError',
     'KVTableImmutableFieldError',
+    'KVTableCASError',
+    'KVTableContentionError',
+    'ContentionResults',
+    'TimingWheel',
     'KVTable',
+    'ExpiringValue',
     'DictKVTable',
 ]
 
 class KVTableError(Exception): pass
 class KVTableConfigError(KVTableError): pass
 class KVTableImmutableFieldError(KVTableError): pass
+class KVTableCASError(KVTableError): pass
+class KVTableContentionError(KVTableCASError): pass
+
+class ContentionResults(object):
+    """
+    Shared state update_with() contention container, by table name:
+    - calls:        Number of update_with() calls
+    - conflicts:    CAS conflicts (each one is retried, unless retries are exhausted)
+    - failures:     Calls which ran out of retries
+    - duration:     Total seconds spent in update_with(), including backoff
+    - backoff:      Total seconds spent sleeping between retries
+    - hot_keys:     Conflicts by key (only the max_hot_keys most conflicted keys are kept)
+    """
+    stats        = {}
+    lock         = threading.Lock()
+    max_hot_keys = 1000
+
+    @classmethod
+    def stats_for(cls, table_name):
+        try:
+            return cls.stats[table_name]
+        except KeyError:
+            with cls.lock:
+                return cls.stats.setdefault(table_name, {
+                    'calls'     : 0,
+                    'conflicts' : 0,
+                    'failures'  : 0,
+                    'duration'  : 0.0,
+                    'backoff'   : 0.0,
+                    'hot_keys'  : collections.Counter(),
+                })
+
+    @classmethod
+    def record(cls, table_name, **increments):
+        """
+        Adds increments (e.g. calls = 1, duration = 0.25) to table_name's stats
+        """
+        stats = cls.stats_for(table_name)
+        with cls.lock:
+            for name, value in six.iteritems(increments):
+                stats[name] += value
+
+    @classmethod
+    def record_conflict(cls, table_name, key):
+        stats = cls.stats_for(table_name)
+        with cls.lock:
+            stats['conflicts'] += 1
+            stats['hot_keys'][key] += 1
+
+            if len(stats['hot_keys']) > cls.max_hot_keys * 2:
+                stats['hot_keys'] = collections.Counter(dict(stats['hot_keys'].most_common(cls.max_hot_keys)))
+
+    @classmethod
+    def hot_keys(cls, table_name, n = 10):
+        """
+        Returns [ (key, conflicts) ] for the n most conflicted keys in table_name
+        """
+        stats = cls.stats_for(table_name)
+        with cls.lock:
+            return stats['hot_keys'].most_common(n)
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.stats.clear()
+
+    @classmethod
+    def format_stats(cls):
+        """
+            Calculates the contention statistics for all tables.
+            Returns a text table formatted string containing:
+            - Table name
+            - Calls
+            - Conflicts
+            - Failures
+            - Duration
+            - Backoff
+            - Hottest key
+        """
+        rows = []
+        with cls.lock:
+            for table_name, stats in sorted(six.iteritems(cls.stats), key=lambda x: x[1]['conflicts']):
+                hot_keys = stats['hot_keys'].most_common(1)
+                rows.append([
+                    table_name,
+                    stats['calls'],
+                    stats['conflicts'],
+                    stats['failures'],
+                    stats['duration'],
+                    stats['backoff'],
+                    hot_keys[0][0] if hot_keys else '',
+                ])
+
+        table = wizzat.textutil.text_table([
+            'Table Name',
+            'Calls',
+            'Conflicts',
+            'Failures',
+            'Duration',
+            'Backoff',
+            'Hottest Key',
+        ], rows)
+
+        return "KVTable Contention By Table\n\n" + table
+
+class TimingWheel(object):
+    """
+    A hashed timing wheel for expiring items without scanning them all.  Items are bucketed by
+    expiry time into slots buckets of resolution seconds each.  add() is O(1), and expired()
+    only visits the buckets for the ticks which have passed since it was last called, leaving
+    items which are due in a later turn of the wheel in place.
+
+    Items are returned up to resolution seconds late, and may no longer be current (e.g. the
+    key was rewritten with a new expiry), so callers should check them before reclaiming.
+    """
+    def __init__(self, resolution = 1.0, slots = 1024):
+        self.resolution = resolution
+        self.buckets    = [ [] for _ in range(slots) ]
+        self.tick       = int(time.time() / resolution)
+        self.lock       = threading.Lock()
+        self.count      = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item, expires_at):
+        with self.lock:
+            tick = max(int(expires_at / self.resolution), self.tick)
+            self.buckets[tick % len(self.buckets)].append((item, expires_at))
+            self.count += 1
+
+    def expired(self, now = None):
+        """
+        Removes and returns the items which expired before the current tick
+        """
+        now_tick = int((now or time.time()) / self.resolution)
+        if now_tick <= self.tick:
+            return []
+
+        expired = []
+        with self.lock:
+            end = min(now_tick, self.tick + len(self.buckets))
+            for tick in range(self.tick, end):
+                idx = tick % len(self.buckets)
+                bucket, keep = self.buckets[idx], []
+                for item, expires_at in bucket:
+                    if expires_at < now_tick * self.resolution:
+                        expired.append(item)
+                    else:
+                        keep.append((item, expires_at))
+                self.buckets[idx] = keep
+
+            self.tick = max(self.tick, now_tick)
+            self.count -= len(expired)
+
+        return expired
+
+def construct_kvtable_definition(fields, key_fields, default_fields, slots, indexes = False, verbose = False):
+    """
+    Generates the source for a KVTable's __init__ and field accessors.  Default functions are
+    referenced as default_{idx}, and accessors are named get_{idx}/set_{idx}.
+    """
+    if slots:
+        value_expr = current_expr = 'self._f_{field}'
+        init_lines = [ 'get = data.get' ]
+        init_lines.extend([ 'self._f_{0} = get({0!r})'.format(field) for field in fields ])
+        init_lines.extend([
+            'if {0!r} not in data: self._f_{0} = default_{1}(self)'.format(field, idx)
+            for idx, field in enumerate(fields) if field in default_fields
+        ])
+    else:
+        value_expr   = 'self._data[{field!r}]'
+        current_expr = 'self._data.get({field!r})'
+        init_lines = [ 'self._data = data' ]
+        init_lines.extend([
+            'if {0!r} not in data: data[{0!r}] = None'.format(field)
+            for field in fields if field not in default_fields
+        ])
+        init_lines.extend([
+            'if {0!r} not in data: data[{0!r}] = default_{1}(self)'.format(field, idx)
+            for idx, field in enumerate(fields) if field in default_fields
+        ])
+
+    if indexes:
+        init_lines.append('self._index_values = self.index_values() if kv_data else None')
+
+    definition = """
+def __init__(self, key, data, kv_data = None):
+    self._key            = key
+    self._kv_data        = kv_data
+    self._changed_fields = None
+    {init_lines}
+    self.on_init()
+    self.cache_obj(self)
+""".format(
+        init_lines = '\n    '.join(init_lines),
+    )
+
+    for idx, field in enumerate(fields):
+        value = value_expr.format(field = field)
+
+        if field in key_fields:
+            setter_body = 'raise KVTableImmutableFieldError({!r})'.format(field)
+        else:
+            setter_body = """if new_value != {current}:
+        if self._changed_fields is None: self._changed_fields = set()
+        self._changed_fields.add({field!r})
+        {value} = new_value""".format(value = value, current = current_expr.format(field = field), field = field)
+
+        definition += """
+def get_{idx}(self):
+    return {value}
+
+def set_{idx}(self, new_value):
+    {setter_body}
+""".format(idx = idx, value = value, setter_body = setter_body)
+
+    if slots:
+        definition += """
+def get_data(self):
+    return {{ {items} }}
+
+def set_data(self, data):
+    {assignments}
+""".format(
+            items       = ', '.join([ '{0!r} : self._f_{0}'.format(field) for field in fields ]),
+            assignments = '\n    '.join([ 'get = data.get' ] + [ 'self._f_{0} = get({0!r})'.format(field) for field in fields ]),
+        )
+
+    if verbose:
+        print(definition)
+
+    return definition
+
+def construct_key_func_definition(table_name, key_fields, intern_size, verbose = False):
+    """
+    Generates the source for a KVTable's key_func.  Keys are '{table_name}/{key1}/{key2}...'.
+    Key values are formatted with %s, which matches text_type() for every type (%d would
+    truncate floats and reject numeric strings).
+    """
+    key_format = '/'.join([ table_name.replace('%', '%%') ] + [ '%s' for field in key_fields ])
+
+    if intern_size:
+        return_key = """try:
+        return interned[key]
+    except KeyError:
+        if len(interned) >= {intern_size}: interned.clear()
+        interned[key] = key
+        return key""".format(intern_size = intern_size)
+    else:
+        return_key = 'return key'
+
+    definition = """
+def key_func(cls, args):
+    if len(args) < {num_keys}:
+        raise ValueError("Insufficient keys for key_fields")
+
+    key = {key_format!r} % ({key_args})
+    {return_key}
+""".format(
+        num_keys   = len(key_fields),
+        key_format = key_format,
+        key_args   = ''.join([ 'args[{}], '.format(idx) for idx in range(len(key_fields)) ]),
+        return_key = return_key,
+    )
+
+    if verbose:
+        print(definition)
+
+    return definition
 
 class KVTableMeta(type):
+    def __new__(mcs, name, bases, dct):
+        if dct.get('slots') and isinstance(dct.get('fields'), (list, tuple)):
+            dct['__slots__'] = tuple(dct.get('__slots__', ())) + tuple('_f_{}'.format(field) for field in dct['fields'])
+
+        return super(KVTableMeta, mcs).__new__(mcs, name, bases, dct)
+
     def __init__(cls, name, bases, dct):
         super(KVTableMeta, cls).__init__(name, bases, dct)
         if 'table_name' not in dct or not isinstance(dct['table_name'], six.string_types):
@@ -32,58 +318,81 @@ class KVTableMeta(type):
             if not isinstance(dct['key_fields'], (list, tuple)):
                 raise KVTableConfigError('key fields is not a list or tuple')
 
-            def key_func(cls, args):
-                if len(args) < len(dct['key_fields']):
-                    raise ValueError("Insufficient keys for key_fields")
-
-                return '{table_name}/{key}'.format(
-                    table_name = cls.table_name,
-                    key = '/'.join(six.text_type(x) for x in args[:len(dct['key_fields'])])
-                )
-
-            cls.key_func = classmethod(key_func)
-
             for key in dct['key_fields']:
                 if key not in dct['fields']:
                     raise KVTableConfigError('{} (key field) is not in fields'.format(key))
 
 
+        # Generated key_funcs are regenerated for subclasses, but custom ones are inherited
+        inherited_key_func = getattr(cls, 'key_func', None)
+        if 'key_func' not in dct and (not inherited_key_func or getattr(inherited_key_func, 'generated', False)):
+            cls.interned_keys = {}
+            namespace = { 'interned' : cls.interned_keys }
+
+            six.exec_(construct_key_func_definition(
+                table_name  = cls.table_name,
+                key_fields  = cls.key_fields,
+                intern_size = cls.key_intern_size,
+            ), namespace)
+
+            namespace['key_func'].generated = True
+            cls.key_func = classmethod(namespace['key_func'])
+
+        cls._codec = cls.codec.bind(cls) if cls.codec else None
+
+        if dct.get('invalidation_bus'):
+            dct['invalidation_bus'].register(cls)
+
         if dct.get('memoize'):
-            cls.id_cache = wizzat.decorators.create_cache_obj(
-                max_size  = dct.get('memoize_size', 0),
-                max_bytes = dct.get('memoize_bytes', 0),
-            )
+            memoize_ttl = dct.get('memoize_ttl', 0)
 
             cls.key_cache = wizzat.decorators.create_cache_obj(
                 max_size  = dct.get('memoize_size', 0),
                 max_bytes = dct.get('memoize_bytes', 0),
+                until     = (lambda: time.time() + memoize_ttl) if memoize_ttl else None,
             )
 
 
         cls.default_funcs = {}
         cls._conn = None
-        for field in dct['fields']:
+        namespace = {
+            'KVTableImmutableFieldError' : KVTableImmutableFieldError,
+        }
+
+        for idx, field in enumerate(dct['fields']):
             func_name = 'default_{}'.format(field)
 
             if func_name in dct:
-                cls.default_funcs[field] = dct[func_name]
+                cls.default_funcs[field] = namespace['default_{}'.format(idx)] = dct[func_name]
 
-            def getter(self, field=field):
-                return self._data[field]
+        six.exec_(construct_kvtable_definition(
+            fields         = dct['fields'],
+            key_fields     = cls.key_fields,
+            default_fields = cls.default_funcs,
+            slots          = dct.get('slots'),
+            indexes        = bool(cls.indexes),
+        ), namespace)
 
-            def setter(self, new_value, field=field):
-                if field in dct['key_fields']:
-                    raise KVTableImmutableFieldError(field)
-
-                if new_value != self._data.get(field):
-                    self._changed = True
-                    self._data[field] = new_value
+        if '__init__' not in dct:
+            cls.__init__ = namespace['__init__']
 
+        for idx, field in enumerate(dct['fields']):
             setattr(cls, field, property(
-                getter,
-                setter,
+                namespace['get_{}'.format(idx)],
+                namespace['set_{}'.format(idx)],
             ))
 
+        if dct.get('slots'):
+            cls._data = property(namespace['get_data'], namespace['set_data'])
+
+        cls.index_classes = {}
+        for index_fields in cls.indexes:
+            for field in index_fields:
+                if field not in dct['fields']:
+                    raise KVTableConfigError('{} (index field) is not in fields'.format(field))
+
+            cls.index_classes[','.join(index_fields)] = cls._create_index_class(index_fields)
+
 
 @six.add_metaclass(KVTableMeta)
 class KVTable(object):
@@ -95,45 +404,88 @@ class KVTable(object):
     key_fields:         list[string], the names of the key fields (used in construction of the obj key)
     key_func:           Optionally provide your own key_func (usually generated from key_fields)
     fields:             list[string], the names of all fields on the object
+    field_types:        dict[string, type], optional type hints for fields (int, float, six.text_type, ...)
+    key_intern_size:    int, keep up to this many generated keys interned so repeated keys share one
+                        string object (and cache lookups compare by identity).  The table is cleared
+                        when it fills up.
+    --
+    delta_updates:      bool, only write changed fields on update.  Backends with native partial
+                        writes use them, others fall back to read-modify-write.
+    --
+    codec:              wizzat.kvcodec codec (e.g. BinaryCodec()) used to serialize documents.  The codec
+                        is bound to each class's fields and field_types.  DictKVTable stores live
+                        dicts when there is no codec.
+    --
+    slots:              bool, store field values in __slots__ instead of a per-object dict.  The
+                        document dict (obj._data) is only built when it is serialized.
     --
     memoize:            bool, caches objects from the database locally
     memoize_size:       int, maximum number of objects to cache from the database (LRU ejection)
     memoize_bytes:      int, maximum size objects to cache from the database (LRU ejection).
-                        Note that there are two caches, and while references are shared the
-                        cache size here is not absolute.
+    memoize_ttl:        float, seconds an object may live in the cache
+    memoize_max_stale:  float, seconds a cached object may be served before it must be revalidated
+                        against the data store.  Without memoize_revalidate it is simply re-read.
+    memoize_revalidate: bool, revalidate stale objects by comparing their CAS/etag with a
+                        metadata-only read (_find_cas_by_key) instead of re-reading them.
+                        Backends whose kv_data isn't a version (cas_versions = False) re-read.
+    invalidation_bus:   wizzat.invalidation.InvalidationBus, publishes every write to other processes
+                        and evicts the keys they write from this process's cache.
+    --
+    indexes:            list[tuple[string]], secondary indexes, e.g. [ ('email',), ('first', 'last') ].
+                        Each index is stored in the same backend as '{table_name}.idx.{fields}'
+                        documents listing the keys of the objects with those values, and is
+                        maintained on insert, update and delete.  Index documents are updated with
+                        update_with(), retrying CAS conflicts up to index_cas_retries times.
+                        Query with find_by_index('email', value) (or ('first,last', (first, last))).
+    ttl:                float, seconds until documents expire (0: never).  Each write resets the
+                        expiry, and obj.set_ttl() overrides it per object.  Backends with native
+                        expiry (Couchbase) are passed the ttl, DictKVTable and FileKVTable expire
+                        documents themselves, and others ignore it.  Expired objects are never
+                        served from the memoize cache.
+    --
+    storage_attrs:      list[string], (backends) the class attributes index classes copy from their table
+    cas_errors:         tuple[Exception], (backends) the exceptions raised by a CAS conflict
     default_{field}:    func, define functions for default behaviors.  These functions are executed
                         in order of definition in the fields array.
+
+    __init__ and the field accessors are generated per class by KVTableMeta.  Subclasses
+    should override on_init rather than __init__.
     """
+    __slots__     = ('_key', '_kv_data', '_changed_fields', '_validated_at', '_index_values', '_expires_at', '_ttl')
     table_name    = ''
     key_fields    = []
     fields        = []
+    field_types   = {}
+    delta_updates = False
+    slots         = False
+    codec         = None
+    ttl           = 0
+    indexes       = ()
+    storage_attrs = ()
+    cas_errors    = (KVTableCASError,)
 
-    memoize       = False
-    memoize_bytes = 0
-    memoize_size  = 0
+    index_cas_retries = 10
 
-    def __init__(self, key, data, kv_data = None):
-        self._key     = key
-        self._data    = data
-        self._kv_data = kv_data
-        self._changed = False
+    key_intern_size = 0
 
-        self.setup_fields()
-        self.on_init()
-        self.cache_obj(self)
+    memoize            = False
+    memoize_bytes      = 0
+    memoize_size       = 0
+    memoize_ttl        = 0
+    memoize_max_stale  = 0
+    memoize_revalidate = False
+    cas_versions       = True
+    invalidation_bus   = None
 
-    def setup_fields(self):
-        self.changed = False
-        for field in self.fields:
-            self.init_field(field)
+    @property
+    def _changed(self):
+        return bool(self._changed_fields)
 
-    def init_field(self, field):
-        if field in self._data:
-            pass
-        elif field in self.default_funcs:
-            self._data[field] = self.default_funcs[field](self)
-        else:
-            self._data[field] = None
+    def changed_fields(self):
+        """
+        Returns the set of fields which have changed since the object was last written
+        """
+        return frozenset(self._changed_fields or ())
 
     def on_init(self):
         pass
@@ -152,23 +504,64 @@ class KVTable(object):
 
     @classmethod
     def check_key_cache(cls, key):
-        if cls.memoize:
-            return cls.key_cache.get(key, None)
+        if not cls.memoize:
+            return None
+
+        if cls.invalidation_bus:
+            cls.invalidation_bus.maybe_poll()
+
+        try:
+            obj = cls.key_cache[key]
+        except KeyError:
+            return None
+
+        if obj._expires_at and obj._expires_at <= time.time():
+            cls.uncache_obj(obj)
+            return None
+
+        if cls.memoize_max_stale and time.time() - obj._validated_at > cls.memoize_max_stale:
+            # Without a real CAS to compare (cas_versions, or no CAS in kv_data), stale objects are re-read
+            cas = cls._kv_cas(obj._kv_data) if cls.memoize_revalidate and cls.cas_versions else None
+            if cas is None or cls._find_cas_by_key(key) != cas:
+                cls.uncache_obj(obj)
+                return None
+
+            obj._validated_at = time.time()
+
+        return obj
 
     @classmethod
     def cache_obj(cls, obj):
         if cls.memoize and obj:
+            obj._validated_at = time.time()
+            obj._expires_at = cls._kv_expires_at(obj._kv_data) if obj._kv_data else 0
             cls.key_cache[obj._key] = obj
 
     @classmethod
     def clear_cache(cls):
-        cls.key_cache.clear()
+        if cls.memoize:
+            cls.key_cache.clear()
 
     @classmethod
     def uncache_obj(cls, obj):
         if cls.memoize and obj:
             cls.key_cache.pop(obj._key, None)
 
+    @classmethod
+    def evict_cached(cls, key):
+        """
+        Evicts key from the cache (used by the invalidation bus)
+        """
+        if cls.memoize:
+            cls.key_cache.pop(key, None)
+
+    def publish_invalidation(self):
+        """
+        Tells other processes on the invalidation bus that this object has changed
+        """
+        if self.invalidation_bus:
+            self.invalidation_bus.publish(self.table_name, self._key)
+
     @classmethod
     def find_by_key(cls, *keys):
         key = cls.key_func(keys)
@@ -187,12 +580,126 @@ class KVTable(object):
         return obj
 
     @classmethod
-    def create(cls, *keys, **kwargs):
+    def find_by_kv_keys(cls, kv_keys):
+        """
+        Returns the objects for kv_keys (in order, skipping missing keys), with one multi-get for
+        the keys which aren't cached
+        """
+        objs = {}
+        missing = []
+        for kv_key in kv_keys:
+            obj = cls.check_key_cache(kv_key)
+            if obj:
+                objs[kv_key] = obj
+            else:
+                missing.append(kv_key)
+
+        if missing:
+            for kv_key, (kv_data, data) in six.iteritems(cls._find_multi(missing)):
+                if kv_data:
+                    objs[kv_key] = cls(
+                        key     = kv_key,
+                        data    = data,
+                        kv_data = kv_data,
+                    )
+
+        return [ objs[kv_key] for kv_key in kv_keys if kv_key in objs ]
+
+    @classmethod
+    def find_by_index(cls, name, value):
+        """
+        Returns the objects whose index fields equal value (a tuple for multi-field indexes)
+        """
+        try:
+            index_cls = cls.index_classes[name]
+        except KeyError:
+            raise KVTableError("{} has no index {}".format(cls.table_name, name))
+
+        values = tuple(value) if len(index_cls.key_fields) > 1 else (value,)
+        index_doc = index_cls.find_by_key(*values)
+        if not index_doc:
+            return []
+
+        # Index documents may briefly list stale keys, so the objects are checked as well
+        return [
+            obj for obj in cls.find_by_kv_keys(index_doc.keys)
+            if tuple(getattr(obj, field) for field in index_cls.key_fields) == values
+        ]
+
+    @classmethod
+    def update_with(cls, keys, mutate_fn, max_retries = 10, backoff = 0.005, max_backoff = 1.0, create = True):
+        """
+        Optimistic concurrency: reads the object for keys, applies mutate_fn(obj) and writes it.
+        On a CAS conflict (cas_errors), the object is re-read and mutate_fn is reapplied, after
+        sleeping a random (full jitter) fraction of min(max_backoff, backoff * 2**retry) seconds.
+
+        If the object doesn't exist and create is true, mutate_fn is applied to a new object which
+        is then inserted.  mutate_fn may return False to skip the write.  Returns the object (None
+        if it doesn't exist and create is false).  Raises KVTableContentionError after max_retries
+        retries.  Conflicts, retries and time spent are recorded in ContentionResults.
+        """
+        keys = tuple(keys) if isinstance(keys, (list, tuple)) else (keys,)
+        start_time = time.time()
+
+        try:
+            for retry in range(max_retries + 1):
+                if retry:
+                    time.sleep(cls._contention_backoff(retry, backoff, max_backoff))
+
+                try:
+                    obj = cls.find_by_key(*keys)
+                    created = not obj
+                    if created:
+                        if not create:
+                            return None
+                        obj = cls._new_obj(keys)
+
+                    try:
+                        if mutate_fn(obj) is False:
+                            if created:
+                                cls.uncache_obj(obj) # Never written, so it mustn't be served from the cache
+                            return obj
+                        obj.update()
+                    except Exception:
+                        if created:
+                            cls.uncache_obj(obj)
+                        raise
+                    return obj
+                except cls.cas_errors:
+                    ContentionResults.record_conflict(cls.table_name, cls.key_func(keys))
+
+            cls._contention_failed(keys, max_retries)
+        finally:
+            ContentionResults.record(cls.table_name, calls = 1, duration = time.time() - start_time)
+
+    @classmethod
+    def _contention_backoff(cls, retry, backoff, max_backoff):
+        """
+        Returns (and records) the seconds to sleep before update_with() retry number retry
+        """
+        delay = random.uniform(0, min(max_backoff, backoff * 2 ** (retry - 1)))
+        ContentionResults.record(cls.table_name, backoff = delay)
+        return delay
+
+    @classmethod
+    def _contention_failed(cls, keys, max_retries):
+        ContentionResults.record(cls.table_name, failures = 1)
+        raise KVTableContentionError("{} conflicts updating {}".format(max_retries + 1, cls.key_func(keys)))
+
+    @classmethod
+    def _new_obj(cls, keys, **kwargs):
+        """
+        Returns a new (unsaved) object for keys
+        """
         return cls(
             key     = cls.key_func(keys),
             data    = set_defaults(kwargs, { field : value for field, value in zip(cls.key_fields, keys) }),
-            kv_data = None
-        ).update()
+            kv_data = None,
+        )
+
+    @classmethod
+    def create(cls, *keys, **kwargs):
+        return cls._new_obj(keys, **kwargs).update()
 
     @classmethod
     def find_or_create(cls, *args, **kwargs):
@@ -203,52 +710,315 @@ class KVTable(object):
         for row in rows:
             return cls.find_or_create(*row, **kwargs)
 
+    def set_ttl(self, ttl):
+        """
+        Sets the seconds until this object expires, from each of its following writes (0: never).
+        Overrides the class's ttl.
+        """
+        self._ttl = ttl
+        return self
+
+    def write_ttl(self):
+        """
+        Returns the ttl for the next write of this object
+        """
+        ttl = getattr(self, '_ttl', None)
+        return self.ttl if ttl is None else ttl
+
     def update(self, force = False):
         """
         Ensures the row exists and is serialized to the data store
         """
-        if self._kv_data:
-            if force or self._changed:
-                self.on_update()
-                self._kv_data = self._update(force)
-                self.after_update()
-        else:
-            self.on_insert()
-            self._kv_data = self._insert(force)
-            self.after_insert()
+        try:
+            write = self._pending_write(force)
+            if write:
+                self._before_write(write)
+                if write == '_update_fields':
+                    self._kv_data = self._update_fields(self.changed_fields(), force)
+                else:
+                    self._kv_data = getattr(self, write)(force)
+                self._update_indexes()
+                self.publish_invalidation()
+                self._after_write(write)
+        except Exception:
+            self.uncache_obj(self)
+            raise
 
-        self._changed = False
+        self._changed_fields = None
+        self.cache_obj(self)
 
         return self
 
+    def _pending_write(self, force):
+        """
+        Returns the method update() writes this object with ('_insert', '_update' or
+        '_update_fields'), or None if it is unchanged
+        """
+        if not self._kv_data:
+            return '_insert'
+        elif not force and not self._changed_fields:
+            return None
+        elif self.delta_updates and not force:
+            return '_update_fields'
+        else:
+            return '_update'
+
+    def _before_write(self, write):
+        if write == '_insert':
+            self.on_insert()
+        else:
+            self.on_update()
+
+    def _after_write(self, write):
+        if write == '_insert':
+            self.after_insert()
+        else:
+            self.after_update()
+
     def delete(self, force = False):
         """
         Deletes the object from the data store
         """
-        self._kv_data = self._delete(force)
+        try:
+            self._kv_data = self._delete(force)
+            self._update_indexes(deleted = True)
+            self.publish_invalidation()
+        finally:
+            self.uncache_obj(self)
+
+    @classmethod
+    def _create_index_class(cls, index_fields):
+        """
+        Creates the table storing the index on index_fields: a subclass of this table's backend
+        with the same storage attributes (connection, bucket, kv_store, etc).
+        """
+        for klass in cls.__mro__:
+            if '_find_by_key' in klass.__dict__:
+                backend = klass
+                break
+        else:
+            raise KVTableConfigError("{} has no backend to store indexes in".format(cls.table_name))
+
+        attrs = { name : getattr(cls, name, None) for name in backend.storage_attrs }
+        attrs.update(
+            table_name = '{}.idx.{}'.format(cls.table_name, '.'.join(index_fields)),
+            key_fields = list(index_fields),
+            fields     = list(index_fields) + [ 'keys' ],
+        )
+
+        return type(cls)(str('{}_{}_index'.format(cls.__name__, '_'.join(index_fields))), (backend,), attrs)
+
+    def index_values(self):
+        """
+        Returns { index name : tuple of field values }, omitting indexes whose values are all None
+        """
+        index_values = {}
+        for name, index_cls in six.iteritems(self.index_classes):
+            values = tuple(getattr(self, field) for field in index_cls.key_fields)
+            if any(value is not None for value in values):
+                index_values[name] = values
+
+        return index_values
+
+    def _update_indexes(self, deleted = False):
+        """
+        Moves this object's key between index documents for every index whose values changed.
+        The key is added to the new document before it is removed from the old one.
+        """
+        if not self.index_classes:
+            return
+
+        old_values = self._index_values or {}
+        new_values = {} if deleted else self.index_values()
+
+        for name, index_cls in six.iteritems(self.index_classes):
+            old, new = old_values.get(name), new_values.get(name)
+            if old == new:
+                continue
+
+            if new is not None:
+                self._modify_index(index_cls, new, self._key, add = True)
+            if old is not None:
+                self._modify_index(index_cls, old, self._key, add = False)
+
+        self._index_values = new_values
+
+    @classmethod
+    def _modify_index(cls, index_cls, values, kv_key, add):
+        """
+        Adds kv_key to (or removes it from) the index document for values.  Empty index documents
+        are deleted.
+        """
+        def mutate(index_doc):
+            keys = set(index_doc.keys or ())
+            if (kv_key in keys) == add:
+                return False
+
+            if add:
+                keys.add(kv_key)
+            else:
+                keys.discard(kv_key)
+
+            if not keys:
+                index_doc.delete()
+                return False
+
+            index_doc.keys = sorted(keys)
+
+        index_cls.update_with(values, mutate, max_retries = cls.index_cas_retries, create = add)
+
+    def encode_data(self):
+        """
+        Serializes the document with the class's codec
+        """
+        return self._codec.encode(self._data)
+
+    @classmethod
+    def decode_data(cls, content):
+        """
+        Deserializes a document with the class's codec
+        """
+        return cls._codec.decode(content)
+
+    @classmethod
+    def _find_multi(cls, kv_keys):
+        """
+        Returns { kv_key : (kv_data, data) }.  Backends with a native multi-get should override this.
+        """
+        return { kv_key : cls._find_by_key(kv_key) for kv_key in kv_keys }
+
+    @classmethod
+    def _kv_cas(cls, kv_data):
+        """
+        Returns the CAS value (or etag, version, etc) stored in kv_data
+        """
+        return kv_data
+
+    @classmethod
+    def _kv_expires_at(cls, kv_data):
+        """
+        Returns the expiry time stored in kv_data (0: never, or unknown)
+        """
+        return 0
+
+    @classmethod
+    def _find_cas_by_key(cls, kv_key):
+        """
+        Returns the current CAS value for kv_key, or None if it does not exist.  Backends
+        should override this with a metadata-only read where possible.
+        """
+        kv_data, data = cls._find_by_key(kv_key)
+        return cls._kv_cas(kv_data) if kv_data else None
+
+    def _update_fields(self, fields, force = False):
+        """
+        Writes only `fields` to the data store.  This is a generic read-modify-write:
+        the stored document is re-read, the changed fields are applied to it, and the
+        merged document is written back with _update.  Backends which support partial
+        writes should override this.
+        """
+        kv_data, data = self._find_by_key(self._key)
+        if not kv_data:
+            return self._insert(force)
+
+        for field in fields:
+            data[field] = getattr(self, field)
+
+        self._data    = data
+        self._kv_data = kv_data
+
+        return self._update(force)
+
+class ExpiringValue(object):
+    """
+    A DictKVTable document with an expiry time
+    """
+    __slots__ = ('value', 'expires_at')
+
+    def __init__(self, value, expires_at):
+        self.value      = value
+        self.expires_at = expires_at
 
 class DictKVTable(KVTable):
-    table_name = ''
-    memoize    = False
-    key_fields = []
-    fields     = []
-    kv_store   = {}
+    """
+    A KVTable stored in kv_store, a dict (or wizzat.decorators cache object).
+
+    Documents with a ttl are stored as ExpiringValue(document, expires_at).  Expired documents
+    are removed when they are read, and the others are reclaimed from expiry_wheel, a timing
+    wheel shared by every DictKVTable, as later writes pass their expiry (or reclaim_expired()
+    is called).  kv_data is the expiry time, or True.
+    """
+    __slots__     = ()
+    table_name    = ''
+    memoize       = False
+    key_fields    = []
+    fields        = []
+    kv_store      = {}
+    storage_attrs = ('kv_store',)
+    expiry_wheel  = TimingWheel()
+    cas_versions  = False # kv_data is only the expiry time
 
     @classmethod
     def _find_by_key(cls, key):
         data = cls.kv_store.get(key, None)
+        expires_at = 0
+
+        if isinstance(data, ExpiringValue):
+            if data.expires_at <= time.time():
+                if cls.kv_store.get(key, None) is data:
+                    cls.kv_store.pop(key, None)
+                return False, None
+            data, expires_at = data.value, data.expires_at
 
         if data:
-            return True, data
+            if not isinstance(data, dict):
+                data = cls.decode_data(data)
+            return expires_at or True, data
         else:
             return False, None
 
+    @classmethod
+    def _kv_expires_at(cls, kv_data):
+        return 0 if kv_data is True else kv_data
+
+    @classmethod
+    def reclaim_expired(cls):
+        """
+        Removes documents from every DictKVTable's kv_store which have expired since the last call
+        """
+        now = time.time()
+        for kv_store, key in cls.expiry_wheel.expired(now):
+            data = kv_store.get(key, None)
+            if isinstance(data, ExpiringValue) and data.expires_at <= now:
+                kv_store.pop(key, None)
+
+    def _store(self):
+        data = self.encode_data() if self._codec else self._data
+        ttl = self.write_ttl()
+        self.reclaim_expired()
+
+        if not ttl:
+            self.kv_store[self._key] = data
+            return True
+
+        expires_at = time.time() + ttl
+        self.kv_store[self._key] = ExpiringValue(data, expires_at)
+        self.expiry_wheel.add((self.kv_store, self._key), expires_at)
+        return expires_at
+
     def _insert(self, force=False):
-        self.kv_store[self._key] = self._data
-        return True
+        return self._store()
 
     def _update(self, force=False):
-        self.kv_store[self._key] = self._data
+        return self._store()
+
+    def _update_fields(self, fields, force=False):
+        if self._codec or self.write_ttl() or isinstance(self.kv_store.get(self._key), ExpiringValue):
+            return super(DictKVTable, self)._update_fields(fields, force)
+
+        stored = self.kv_store.setdefault(self._key, {})
+        for field in fields:
+            stored[field] = getattr(self, field)
         return True
 
     def _delete(self, force=False):
@@ -10,8 +10,8 @@ except ImportError:
     pass
 
 import six
-import copy, tempfile, types
-import psycopg2, psycopg2.extras, psycopg2.pool
+import binascii, copy, itertools, json, re, tempfile, types, weakref
+import psycopg2, psycopg2.extensions, psycopg2.extras, psycopg2.pool
 from types import *
 from wizzat.sqlhelper import *
 from wizzat.util import set_defaults
@@ -20,16 +20,28 @@ __all__ = [
     #'vacuum',
     'ConnMgr',
     'analyze',
+    'add_precommit_listener',
+    'add_transaction_listener',
+    'remove_precommit_listener',
+    'remove_transaction_listener',
+    'column_types',
+    'commit_conn',
     'copy_from',
     'copy_from_rows',
+    'copy_value',
     'currval',
     'drop_table',
     'execute',
     'fetch_results',
     'fetch_one',
+    'forget_prepared',
+    'in_transaction',
     'iter_results',
     'nextval',
+    'prepared_statements',
     'relation_info',
+    'reset_conn',
+    'rollback_conn',
     'set_sql_log_func',
     'sql_where_from_params',
     'table_columns',
@@ -38,6 +50,8 @@ __all__ = [
     'PgIntegrityError',
     'PgOperationalError',
     'PgProgrammingError',
+    'PreparedStatement',
+    'TransactionConnection',
 ]
 
 PgIntegrityError   = psycopg2.IntegrityError
@@ -47,27 +61,151 @@ PgPoolError        = psycopg2.pool.PoolError
 
 def copy_from(conn, fp, table_name, columns = None):
     """
-    Resets the file pointer and initiates a pg_copy.
+    Resets the file pointer and initiates a pg_copy.  table_name may be schema qualified.
 
     This method requires postgresql
     """
     fp.seek(0)
-    conn.cursor().copy_from(fp, table_name, columns = columns)
+    sql = "COPY {} ({}) FROM STDIN".format(table_name, ', '.join(columns)) if columns else "COPY {} FROM STDIN".format(table_name)
+    conn.cursor().copy_expert(sql, fp)
+
+def copy_value(value):
+    """
+    Formats a value for COPY's text format: None is \\N, booleans are t/f, bytes are bytea hex,
+    lists are arrays, dicts are JSON, strings are their text, and everything else is formatted by
+    psycopg2's adapter for its type.  Backslash, tab and newlines are escaped.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, six.integer_types):
+        return six.text_type(value)
+    if isinstance(value, (bytearray, memoryview)) or (six.PY3 and isinstance(value, bytes)):
+        value = '\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+    elif isinstance(value, (list, tuple)):
+        value = _array_literal(value)
+    elif isinstance(value, dict):
+        value = json.dumps(value)
+    elif not isinstance(value, six.string_types):
+        value = _adapted_text(value)
+
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+_quoted_literal_re = re.compile(r"^'((?:[^']|'')*)'(?:::[\w ]+)?$", re.DOTALL)
+def _adapted_text(value):
+    """
+    Returns the text of value's SQL literal, as psycopg2 would send it (e.g. '1 days 5.000000 seconds'
+    for a timedelta).  Types psycopg2 can't adapt are formatted with text_type().
+    """
+    try:
+        literal = psycopg2.extensions.adapt(value).getquoted()
+    except psycopg2.ProgrammingError:
+        return six.text_type(value)
+
+    literal = literal.decode('utf8').strip() if isinstance(literal, bytes) else literal.strip()
+    match = _quoted_literal_re.match(literal)
+    return match.group(1).replace("''", "'") if match else literal
+
+def _array_literal(values):
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append('NULL')
+        elif isinstance(value, (list, tuple)):
+            elements.append(_array_literal(value))
+        else:
+            value = six.text_type(value).replace('\\', '\\\\').replace('"', '\\"')
+            elements.append('"{}"'.format(value))
+
+    return '{' + ','.join(elements) + '}'
 
 def copy_from_rows(conn, table_name, columns, rows):
     """
-    Creates a file object containing the tab separated rows.
+    Copies rows (sequences of values, in the order of columns) into table_name.
+    Values are formatted with copy_value.
 
     This method requires postgresql
     """
-    fp = six.StringIO.StringIO()
+    fp = six.StringIO()
     for row in rows:
-        fp.write('\t'.join(row))
+        fp.write('\t'.join([ copy_value(value) for value in row ]))
         fp.write('\n')
 
     copy_from(conn, fp, table_name, columns = columns)
     del fp
 
+_transaction_listeners = []
+def add_transaction_listener(func):
+    """
+    Registers func(conn, committed), which is called after commit_conn() and rollback_conn(),
+    and after commits and rollbacks of TransactionConnections
+    """
+    _transaction_listeners.append(func)
+
+def remove_transaction_listener(func):
+    if func in _transaction_listeners:
+        _transaction_listeners.remove(func)
+
+_precommit_listeners = []
+def add_precommit_listener(func):
+    """
+    Registers func(conn), which is called just before commit_conn() and TransactionConnections
+    commit, inside the transaction.  Exceptions abort the commit.
+    """
+    _precommit_listeners.append(func)
+
+def remove_precommit_listener(func):
+    if func in _precommit_listeners:
+        _precommit_listeners.remove(func)
+
+def _transaction_committing(conn):
+    for func in _precommit_listeners:
+        func(conn)
+
+def _transaction_ended(conn, committed):
+    for func in _transaction_listeners:
+        func(conn, committed)
+
+class TransactionConnection(psycopg2.extensions.connection):
+    """
+    A connection which tells the transaction listeners when it commits or rolls back.  Opt in
+    by passing connection_factory = TransactionConnection to psycopg2.connect() or ConnMgr.
+    """
+    def commit(self):
+        _transaction_committing(self)
+        super(TransactionConnection, self).commit()
+        _transaction_ended(self, True)
+
+    def rollback(self):
+        super(TransactionConnection, self).rollback()
+        _transaction_ended(self, False)
+
+def commit_conn(conn):
+    """
+    Commits conn, and tells the transaction listeners
+    """
+    if isinstance(conn, TransactionConnection):
+        conn.commit()
+    else:
+        _transaction_committing(conn)
+        conn.commit()
+        _transaction_ended(conn, True)
+
+def rollback_conn(conn):
+    """
+    Rolls back conn, and tells the transaction listeners
+    """
+    conn.rollback()
+    if not isinstance(conn, TransactionConnection):
+        _transaction_ended(conn, False)
+
+def in_transaction(conn):
+    """
+    Returns whether conn has a transaction open (statements run since the last commit or rollback)
+    """
+    return conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
 def relation_info(conn, relname, relkind = 'r'):
     """
     Fetch object information from the pg catalog
@@ -108,6 +246,23 @@ def table_columns(conn, table_name):
         ORDER BY column_name, data_type
     """, table = table_name)
 
+def column_types(conn, table_name):
+    """
+    Returns { column name : type } for the table, with types formatted as they would be in
+    a cast (e.g. 'character varying(20)', 'integer[]').
+
+    This method requires postgresql
+    """
+    return { name : column_type for name, column_type in fetch_results(conn, """
+        SELECT
+            attname,
+            format_type(atttypid, atttypmod) AS column_type
+        FROM pg_attribute
+        WHERE attrelid = %(table)s::regclass
+            AND attnum > 0
+            AND NOT attisdropped
+    """, table = table_name) }
+
 def drop_table(conn, table_name):
     """
     Drops a table
@@ -182,6 +337,68 @@ def sql_where_from_params(**kwargs):
 
     return ' and '.join(clauses)
 
+_prepared = weakref.WeakKeyDictionary()
+def prepared_statements(conn):
+    """
+    Returns the set of PreparedStatement names PREPAREd on conn.  The set is reset when the
+    connection's backend changes (reconnects), as the statements went with it.  conn.reset()
+    and DISCARD ALL keep the backend, so use reset_conn() or forget_prepared() with them.
+    """
+    backend_pid = conn.get_backend_pid()
+    state = _prepared.get(conn)
+    if not state or state[0] != backend_pid:
+        state = _prepared[conn] = (backend_pid, set())
+
+    return state[1]
+
+def forget_prepared(conn):
+    """
+    Forgets the statements prepared on conn, after they were deallocated (DISCARD ALL, DEALLOCATE ALL)
+    """
+    _prepared.pop(conn, None)
+
+def reset_conn(conn):
+    """
+    Resets conn to its session defaults (conn.reset()), which also deallocates its prepared statements
+    """
+    conn.reset()
+    forget_prepared(conn)
+
+class PreparedStatement(object):
+    """
+    A statement with %(name)s bind params, which is PREPAREd on each connection the first time
+    it is executed there.  sql_for(conn) returns the EXECUTE statement to run with the same
+    bind params.  Statements are named wizzat_stmt_{n}, and last as long as the session (they
+    survive rollbacks), so this doesn't work behind transaction pooling or with DISCARD ALL.
+
+    This method requires postgresql
+    """
+    counter = itertools.count()
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.name = 'wizzat_stmt_{}'.format(next(self.counter))
+        self.param_names = []
+
+        def positional(match):
+            if match.group(1) not in self.param_names:
+                self.param_names.append(match.group(1))
+            return '${}'.format(self.param_names.index(match.group(1)) + 1)
+
+        self.prepare_sql = 'PREPARE {} AS {}'.format(self.name, re.sub(r'%\((\w+)\)s', positional, sql))
+        if self.param_names:
+            self.execute_sql = 'EXECUTE {} ({})'.format(self.name, ', '.join([ '%({})s'.format(x) for x in self.param_names ]))
+        else:
+            self.execute_sql = 'EXECUTE {}'.format(self.name)
+
+    def sql_for(self, conn):
+        statements = prepared_statements(conn)
+        if self.name not in statements:
+            execute(conn, self.prepare_sql)
+            statements.add(self.name)
+
+        return self.execute_sql
+
 ##############################################################################################################
 
 
@@ -256,19 +473,19 @@ class ConnMgr(object):
         delattr(self, name)
 
         if commit:
-            conn.commit()
+            commit_conn(conn)
         else:
-            conn.rollback()
+            rollback_conn(conn)
 
         self.pool.putconn(conn)
 
     def commit(self):
         for key, conn in six.iteritems(self.connections):
-            conn.commit()
+            commit_conn(conn)
 
     def rollback(self):
         for key, conn in six.iteritems(self.connections):
-            conn.rollback()
+            rollback_conn(conn)
 
     def putall(self):
         for k in self.connections.keys():
@@ -4,16 +4,140 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 try:
+    import base64
     import boto.exception
-    import cStringIO
+    import contextlib
+    import collections
+    import hashlib
+    import io
+    import itertools
     import json
+    import multiprocessing.pool
+    import threading
+    import time
+    import six
+    import weakref
     import wizzat.kvtable
-    from boto.s3.key import Key, compute_md5
+    import wizzat.textutil
+    from boto.s3.key import Key
+    from wizzat.mathutil import Percentile
 
     __all__ = [
+        'S3ConnPool',
         'S3Table',
     ]
 
+    class S3ConnPool(object):
+        """
+        A thread safe pool of S3 connections.  Each boto connection keeps its HTTP connections alive
+        between requests, so checking connections out of a pool shared by all threads reuses them
+        instead of opening new ones per thread.  Assign a pool to S3Table.conn in place of a connection.
+
+        Example:
+            pool = S3ConnPool(lambda: boto.connect_s3(access_key, secret_key), size = 20)
+
+            with pool.checkout('get') as conn:
+                conn.get_bucket('bucket')
+
+            print(pool.format_stats())
+
+        Connections are created on demand, up to size.  Once size connections are checked out,
+        checkout() blocks until one is returned.  Stats are kept per operation name:
+        - calls, latency:   Number of requests, and a Percentile of their duration in milliseconds
+        - wait:             Percentile of the milliseconds spent waiting for a connection
+        """
+        def __init__(self, factory, size = 10):
+            self.factory = factory
+            self.size    = size
+            self.idle    = six.moves.queue.LifoQueue()
+            self.lock    = threading.Lock()
+            self.created = 0
+            self.stats   = collections.defaultdict(lambda: {
+                'calls'   : 0,
+                'latency' : Percentile(),
+                'wait'    : Percentile(),
+            })
+
+        def getconn(self):
+            """
+            Returns (conn, milliseconds spent waiting)
+            """
+            start_time = time.time()
+
+            try:
+                return self.idle.get_nowait(), 0
+            except six.moves.queue.Empty:
+                pass
+
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+
+            if create:
+                try:
+                    return self.factory(), 0
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+
+            conn = self.idle.get()
+            return conn, (time.time() - start_time) * 1000
+
+        def putconn(self, conn):
+            self.idle.put(conn)
+
+        @contextlib.contextmanager
+        def checkout(self, op = 'request'):
+            """
+            Checks out a connection for the duration of the block, recording stats under op
+            """
+            conn, wait = self.getconn()
+            start_time = time.time()
+
+            try:
+                yield conn
+            finally:
+                self.putconn(conn)
+
+                with self.lock:
+                    stats = self.stats[op]
+                    stats['calls'] += 1
+                    stats['wait'].add_value(wait)
+                    stats['latency'].add_value((time.time() - start_time) * 1000)
+
+        def clear_stats(self):
+            with self.lock:
+                self.stats.clear()
+
+        def format_stats(self):
+            """
+            Returns a text table of request and wait times (ms) by operation
+            """
+            rows = []
+            with self.lock:
+                for op, stats in sorted(six.iteritems(self.stats)):
+                    rows.append([
+                        op,
+                        stats['calls'],
+                        stats['latency'].percentile(0.5),
+                        stats['latency'].percentile(0.98),
+                        stats['latency'].percentile(1.0),
+                        stats['wait'].percentile(0.98),
+                    ])
+
+            table = wizzat.textutil.text_table([
+                'Operation',
+                'Calls',
+                'Median',
+                '98th',
+                'Max',
+                'Wait 98th',
+            ], rows)
+
+            return "S3 Connection Pool ({} of {} connections)\n\n".format(self.created, self.size) + table
+
     class S3Table(wizzat.kvtable.KVTable):
         """
         This is a micro-ORM for working with S3.
@@ -21,11 +145,28 @@ try:
         Relevant options (on top of KVTable options):
         - bucket:               The S3 bucket name to store this table in
         - json_encoder:         func, the json encoder (typically, staticmethod(json.dumps))
-        - json_encoder:         func, the json decoder (typically, staticmethod(json.loads))
+        - json_decoder:         func, the json decoder (typically, staticmethod(json.loads))
+                                These are used when there is no codec.
         - reduced_redundancy:   bool, Whether or not to store the key with S3 reduced redundancy
         - encrypt_key:          bool, Use S3 encryption
         - policy:               CannedACLStrings, The S3 policy to apply to new objects in S3
+        - conn:                 An S3 connection, or an S3ConnPool
+        - part_size:            int, Documents are encoded and uploaded in parts of this many bytes.
+                                Documents larger than one part use a multipart upload.
+        - upload_workers:       int, The number of parts to upload (or objects to multi-get) in parallel
+
+        Buckets are validated once per connection, and are remembered only as long as the connection.
+
+        Documents are encoded incrementally (codec.iterencode, or json.JSONEncoder.iterencode for
+        the default json_encoder) and hashed as they are uploaded, so at most upload_workers + 1
+        parts are held in memory.  stream_by_key() and read_range() read raw content without
+        loading the whole object.
+
+        scan() iterates over a table (or any key prefix) and bulk_delete() removes many keys at once.
+
+        S3 has no conditional writes, so index documents are updated last-writer-wins.
         """
+        __slots__          = ()
         memoize            = False
         table_name         = ''
         key_fields         = []
@@ -36,40 +177,323 @@ try:
         reduced_redundancy = False
         json_encoder       = staticmethod(json.dumps)
         json_decoder       = staticmethod(json.loads)
+        part_size          = 8 * 1024 * 1024
+        upload_workers     = 4
+        bucket_handles     = weakref.WeakKeyDictionary()
+        upload_pools       = {}
+        handles_lock       = threading.Lock()
+        storage_attrs      = ('conn', 'bucket', 'policy', 'encrypt_key', 'reduced_redundancy')
 
         @classmethod
-        def _remote_bucket(cls):
-            return cls.conn.get_bucket(cls.bucket)
+        def _remote_bucket(cls, conn = None):
+            conn = conn or cls.conn
+
+            # Buckets reference their connection, so only the names validated on each connection
+            # are kept; an unvalidated handle is built without a request.
+            if cls.bucket in cls.bucket_handles.get(conn, ()):
+                return conn.get_bucket(cls.bucket, validate = False)
+
+            bucket = conn.get_bucket(cls.bucket)
+            with cls.handles_lock:
+                cls.bucket_handles.setdefault(conn, set()).add(cls.bucket)
+            return bucket
+
+        @classmethod
+        @contextlib.contextmanager
+        def _request(cls, op):
+            """
+            Yields the bucket handle for a connection, checked out of the pool if conn is an S3ConnPool
+            """
+            if isinstance(cls.conn, S3ConnPool):
+                with cls.conn.checkout(op) as conn:
+                    yield cls._remote_bucket(conn)
+            else:
+                yield cls._remote_bucket()
 
         @classmethod
         def delete_key(cls, kv_key):
-            cls._remote_bucket().delete_key(kv_key)
+            with cls._request('delete') as bucket:
+                bucket.delete_key(kv_key)
 
         @classmethod
-        def _remote_key(cls, kv_key):
-            return Key(cls._remote_bucket(), kv_key)
+        def _remote_key(cls, kv_key, bucket = None):
+            return Key(bucket if bucket is not None else cls._remote_bucket(), kv_key)
 
         @classmethod
         def _find_by_key(cls, kv_key):
             try:
-                content_str = cls._remote_key(kv_key).get_contents_as_string()
-                return True, cls.json_decoder(content_str)
+                with cls._request('get') as bucket:
+                    remote_key = cls._remote_key(kv_key, bucket)
+                    content = bytearray()
+                    for chunk in cls._iter_remote_key(remote_key):
+                        content.extend(chunk)
+                return remote_key.etag or True, cls.decode_data(bytes(content))
             except boto.exception.S3ResponseError:
                 return None, None
 
+        @classmethod
+        def _find_multi(cls, kv_keys):
+            return dict(zip(kv_keys, cls._upload_pool().map(cls._find_by_key, kv_keys)))
+
+        @classmethod
+        def _iter_remote_key(cls, remote_key, chunk_size = None):
+            try:
+                while True:
+                    chunk = remote_key.read(chunk_size or cls.part_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                remote_key.close()
+
+        @classmethod
+        def stream_by_key(cls, *keys, **kwargs):
+            """
+            Yields the raw (encoded) content of an object in chunks of chunk_size bytes (default: part_size)
+
+            Each chunk is a ranged read with its own connection checkout, so a slow (or abandoned)
+            consumer never holds a pooled connection.  Chunks after the first must match the first
+            chunk's ETag, so an object overwritten mid-stream raises S3ResponseError (412) rather than
+            yielding a mix of versions.
+            """
+            kv_key = cls.key_func(keys)
+            chunk_size = kwargs.get('chunk_size') or cls.part_size
+            headers = {}
+            offset = 0
+
+            while True:
+                headers['Range'] = 'bytes={}-{}'.format(offset, offset + chunk_size - 1)
+                with cls._request('stream') as bucket:
+                    remote_key = cls._remote_key(kv_key, bucket)
+                    try:
+                        chunk = remote_key.get_contents_as_string(headers = headers)
+                    except boto.exception.S3ResponseError as e:
+                        if e.status == 416: # Empty object, or it ended on a chunk boundary
+                            break
+                        raise
+
+                if not chunk:
+                    break
+                yield chunk
+
+                offset += len(chunk)
+                if remote_key.size is not None and offset >= remote_key.size:
+                    break
+                headers['If-Match'] = remote_key.etag
+
+        @classmethod
+        def read_range(cls, start, end, *keys):
+            """
+            Returns the raw (encoded) bytes [start, end] (inclusive, as in an HTTP Range) of an object
+            """
+            kv_key = cls.key_func(keys)
+            with cls._request('range') as bucket:
+                return cls._remote_key(kv_key, bucket).get_contents_as_string(headers = {
+                    'Range' : 'bytes={}-{}'.format(start, end),
+                })
+
+        @classmethod
+        def scan(cls, prefix = None, workers = None):
+            """
+            Lazily yields every object whose key starts with prefix (default: 'table_name/'), in
+            listing order.  Listings are fetched a page (1000 keys) at a time, each with its own
+            connection checkout, and objects are fetched and decoded by
+            `workers` threads (default: upload_workers), with at most `workers` fetches in flight.
+            Objects deleted between listing and fetching are skipped.
+            """
+            if prefix is None:
+                prefix = cls.table_name + '/'
+            workers = workers or cls.upload_workers
+
+            def fetch(kv_key):
+                kv_data, data = cls._find_by_key(kv_key)
+                return kv_key, kv_data, data
+
+            pool = multiprocessing.pool.ThreadPool(workers)
+            in_flight = collections.deque()
+
+            def next_result():
+                kv_key, kv_data, data = in_flight.popleft().get()
+                if kv_data:
+                    obj = cls(
+                        key     = kv_key,
+                        data    = data,
+                        kv_data = kv_data,
+                    )
+                    cls.cache_obj(obj)
+                    return obj
+
+            try:
+                marker = ''
+                while True:
+                    with cls._request('list') as bucket:
+                        page = bucket.get_all_keys(prefix = prefix, marker = marker)
+
+                    for remote_key in page:
+                        if len(in_flight) >= workers:
+                            obj = next_result()
+                            if obj:
+                                yield obj
+                        in_flight.append(pool.apply_async(fetch, (remote_key.name,)))
+
+                    if not page.is_truncated or not len(page):
+                        break
+                    marker = page[-1].name
+
+                while in_flight:
+                    obj = next_result()
+                    if obj:
+                        yield obj
+            finally:
+                pool.terminate()
+
+        @classmethod
+        def bulk_delete(cls, kv_keys):
+            """
+            Deletes kv_keys with multi-object deletes (1000 keys per request), evicting them from
+            the cache and publishing the deleted keys to the invalidation bus.  Tables with indexes
+            fetch the objects first (one multi-get) so their keys can be removed from the indexes.
+            Returns a list of (kv_key, error code, error message) for keys which couldn't be deleted.
+            """
+            kv_keys = list(kv_keys)
+            objs = cls.find_by_kv_keys(kv_keys) if cls.index_classes else []
+
+            with cls._request('bulk_delete') as bucket:
+                result = bucket.delete_keys(kv_keys, quiet = True)
+
+            errors = [ (error.key, error.code, error.message) for error in result.errors ]
+            failed = set(error[0] for error in errors)
+
+            for obj in objs:
+                if obj._key not in failed:
+                    obj._update_indexes(deleted = True)
+
+            for kv_key in kv_keys:
+                cls.evict_cached(kv_key)
+                if cls.invalidation_bus and kv_key not in failed:
+                    cls.invalidation_bus.publish(cls.table_name, kv_key)
+
+            return errors
+
+        @classmethod
+        def _find_cas_by_key(cls, kv_key):
+            with cls._request('head') as bucket:
+                remote_key = bucket.get_key(kv_key)
+            return remote_key.etag if remote_key else None
+
+
+        @classmethod
+        def decode_data(cls, content):
+            if cls._codec:
+                return cls._codec.decode(content)
+            return cls.json_decoder(content)
+
+        def encode_data(self):
+            if self._codec:
+                return self._codec.encode(self._data)
+            return self.json_encoder(self._data)
+
+        def iterencode_data(self):
+            """
+            Yields the encoded document in chunks
+            """
+            if self._codec:
+                chunks = self._codec.iterencode(self._data)
+            elif self.json_encoder is json.dumps:
+                chunks = json.JSONEncoder().iterencode(self._data)
+            else:
+                chunks = [ self.json_encoder(self._data) ]
+
+            for chunk in chunks:
+                yield chunk.encode('utf8') if isinstance(chunk, six.text_type) else chunk
+
+        def iterparts(self):
+            """
+            Yields the encoded document in parts of part_size bytes.  The last part may be smaller.
+            """
+            buf = bytearray()
+            for chunk in self.iterencode_data():
+                buf.extend(chunk)
+                while len(buf) >= self.part_size:
+                    yield bytes(buf[:self.part_size])
+                    del buf[:self.part_size]
+
+            if buf:
+                yield bytes(buf)
+
+        @classmethod
+        def _upload_pool(cls):
+            try:
+                return cls.upload_pools[cls.upload_workers]
+            except KeyError:
+                with cls.handles_lock:
+                    if cls.upload_workers not in cls.upload_pools:
+                        cls.upload_pools[cls.upload_workers] = multiprocessing.pool.ThreadPool(cls.upload_workers)
+                    return cls.upload_pools[cls.upload_workers]
+
+        @staticmethod
+        def _md5(content):
+            digest = hashlib.md5(content)
+            return digest.hexdigest(), base64.b64encode(digest.digest()).decode('ascii'), len(content)
 
         def _insert(self, force=False):
-            content_str = self.json_encoder(self._data)
-            md5, b64, file_size = compute_md5(cStringIO.StringIO(content_str))
+            parts = self.iterparts()
+            head = list(itertools.islice(parts, 2))
 
-            self._remote_key(self._key).set_contents_from_string(content_str,
-                md5                = (md5, b64, file_size),
+            if len(head) < 2:
+                content = head[0] if head else b''
+                md5, b64, file_size = self._md5(content)
+
+                with self._request('put') as bucket:
+                    self._remote_key(self._key, bucket).set_contents_from_string(content,
+                        md5                = (md5, b64, file_size),
+                        policy             = self.policy,
+                        encrypt_key        = self.encrypt_key,
+                        reduced_redundancy = self.reduced_redundancy,
+                    )
+
+                return '"{}"'.format(md5)
+
+            def remaining_parts():
+                # Pop the buffered parts rather than chaining them, so they can be freed once uploaded
+                while head:
+                    yield head.pop(0)
+                for part in parts:
+                    yield part
+
+            with self._request('multipart') as bucket:
+                return self._multipart_upload(bucket, remaining_parts())
+
+        def _multipart_upload(self, bucket, parts):
+            """
+            Uploads parts in parallel on the upload pool, with at most upload_workers parts in flight
+            """
+            upload = bucket.initiate_multipart_upload(self._key,
                 policy             = self.policy,
                 encrypt_key        = self.encrypt_key,
                 reduced_redundancy = self.reduced_redundancy,
             )
 
-            return True
+            def upload_part(part_num, content):
+                md5, b64, file_size = self._md5(content)
+                upload.upload_part_from_file(io.BytesIO(content), part_num, md5 = (md5, b64), size = file_size)
+
+            pool = self._upload_pool()
+            in_flight = collections.deque()
+
+            try:
+                for part_num, content in enumerate(parts, 1):
+                    if len(in_flight) >= self.upload_workers:
+                        in_flight.popleft().get()
+                    in_flight.append(pool.apply_async(upload_part, (part_num, content)))
+
+                while in_flight:
+                    in_flight.popleft().get()
+
+                return upload.complete_upload().etag
+            except Exception:
+                upload.cancel_upload()
+                raise
 
         _update = _insert
 
@@ -95,15 +95,17 @@ def read_int_set(s, compressed = False):
     for _ in six.moves.xrange(num_elements):
         bitmask, num_indexes = bmstruct.unpack_from(s, ptr)
         ptr += bmstruct.size
-        bitmask_offsets = [ x for x in range(64) if bitmask & (1<<x) ]
+        bitmask_offsets = []
+        while bitmask:
+            low_bit = bitmask & -bitmask
+            bitmask_offsets.append(low_bit.bit_length() - 1)
+            bitmask ^= low_bit
 
         i = 0
         while i < num_indexes:
             n = min(num_indexes - i, 250)
             bases = istructs[n].unpack_from(s, ptr)
-            for base in bases:
-                base *= 64
-                output_set.update(base+offset for offset in bitmask_offsets)
+            output_set.update(base * 64 + offset for base in bases for offset in bitmask_offsets)
             ptr += istructs[n].size
             i += n
 
@@ -0,0 +1,404 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import logging
+import six
+import threading
+import time
+import wizzat.kvtable
+import wizzat.textutil
+from wizzat.kvtable import KVTableConfigError
+from wizzat.mathutil import Percentile
+
+__all__ = [
+    'TieredKVTableMeta',
+    'TieredKVTable',
+]
+
+class TieredKVTableMeta(wizzat.kvtable.KVTableMeta):
+    def __init__(cls, name, bases, dct):
+        super(TieredKVTableMeta, cls).__init__(name, bases, dct)
+
+        if cls.write_policy not in ('through', 'behind'):
+            raise KVTableConfigError("write_policy must be 'through' or 'behind'")
+
+        cls.tier_classes = []
+        for idx, tier in enumerate(cls.tiers):
+            backend, attrs = tier if isinstance(tier, (list, tuple)) else (tier, {})
+
+            tier_attrs = {
+                'table_name'  : cls.table_name,
+                'key_fields'  : cls.key_fields,
+                'fields'      : cls.fields,
+                'field_types' : cls.field_types,
+                'codec'       : cls.codec,
+                'ttl'         : cls.ttl,
+            }
+            tier_attrs.update(attrs)
+
+            cls.tier_classes.append(type(backend)(str('{}_tier{}'.format(name, idx)), (backend,), tier_attrs))
+
+        cls.tier_stats = [ cls.new_tier_stats() for _ in cls.tier_classes ]
+        cls.stats_lock = threading.Lock()
+        if cls.tier_classes:
+            cls.cas_versions = cls.tier_classes[-1].cas_versions
+            cls.cas_errors = tuple(cls.tier_classes[-1].cas_errors)
+        else:
+            cls.cas_versions = False
+        cls.behind_queue = collections.OrderedDict()
+        cls.behind_lock = threading.Lock()
+        cls.behind_thread = None
+        cls.behind_stop = threading.Event()
+        cls.behind_failures = {}
+
+@six.add_metaclass(TieredKVTableMeta)
+class TieredKVTable(wizzat.kvtable.KVTable):
+    """
+    A KVTable composed of an ordered list of backends, fastest first.  The last tier is the
+    authoritative store, and the tiers in front of it are caches.
+
+    Params (on top of KVTable options):
+    tiers:              list of backend classes, or (backend class, { attribute : value }) for backends
+                        which need storage attributes (kv_store, path, conn, bucket, ...).  A tier
+                        class is generated for each with this table's name, fields and codec.  e.g.:
+                        [
+                            (DictKVTable, { 'kv_store' : create_cache_obj(max_size = 10000) }),
+                            (FileKVTable, { 'path' : '/var/cache/users.log' }),
+                            (CBTable,     { 'conn' : cb_conn }),
+                        ]
+    write_policy:       'through' writes every tier (authoritative first, then the caches) before
+                        update() returns.  'behind' writes the first tier, and queues the others
+                        to be written by a background thread every behind_interval seconds.  The
+                        thread exits once the queue is empty, and is started again by the next write.
+                        Queued writes to the same key are coalesced; call flush() to drain them, or
+                        stop_behind() to stop the thread and drain them at shutdown.
+                        Writes which the authoritative tier rejects are retried by later flushes
+                        (unless the key has been written again since), and kept in behind_failures.
+    behind_interval:    float, seconds between background writes with write_policy = 'behind'
+
+    Reads try each tier in order and promote hits into the faster tiers.  Multi-key reads
+    (find_by_kv_keys, find_by_index) make one multi-get per tier for the keys still missing.
+    Deletes remove the key from every tier.  kv_data is the list of each tier's kv_data, and
+    CAS is checked against the authoritative tier when the object was read from it.  Every tier
+    is written with the object's ttl, and promoted copies expire with the document they copy.
+
+    Per-tier hits, misses, promotions, writes, errors and latency (ms) are kept in tier_stats,
+    see format_stats().  update_with() retries on the authoritative tier's cas_errors.
+    """
+    __slots__       = ()
+    memoize         = False
+    table_name      = ''
+    key_fields      = []
+    fields          = []
+    tiers           = []
+    write_policy    = 'through'
+    behind_interval = 0.1
+    storage_attrs   = ('tiers', 'write_policy', 'behind_interval')
+
+    @staticmethod
+    def new_tier_stats():
+        return {
+            'hits'       : 0,
+            'misses'     : 0,
+            'promotions' : 0,
+            'writes'     : 0,
+            'errors'     : 0,
+            'latency'    : Percentile(),
+        }
+
+    @classmethod
+    def clear_stats(cls):
+        with cls.stats_lock:
+            cls.tier_stats = [ cls.new_tier_stats() for _ in cls.tier_classes ]
+
+    @classmethod
+    def format_stats(cls):
+        """
+        Returns a text table of hits, misses, promotions, writes, errors and latency by tier
+        """
+        rows = []
+        with cls.stats_lock:
+            for tier_cls, stats in zip(cls.tier_classes, cls.tier_stats):
+                rows.append([
+                    tier_cls.__name__,
+                    stats['hits'],
+                    stats['misses'],
+                    stats['promotions'],
+                    stats['writes'],
+                    stats['errors'],
+                    stats['latency'].percentile(0.5),
+                    stats['latency'].percentile(0.98),
+                ])
+
+        table = wizzat.textutil.text_table([
+            'Tier',
+            'Hits',
+            'Misses',
+            'Promotions',
+            'Writes',
+            'Errors',
+            'Median',
+            '98th',
+        ], rows)
+
+        return "Tier Stats for {}\n\n".format(cls.table_name) + table
+
+    @classmethod
+    def _record(cls, idx, start_time, **counts):
+        latency = (time.time() - start_time) * 1000
+        with cls.stats_lock:
+            stats = cls.tier_stats[idx]
+            stats['latency'].add_value(latency)
+            for stat, count in six.iteritems(counts):
+                stats[stat] += count
+
+    @staticmethod
+    def _copy(data):
+        # Dict backends store and return live dicts, which mustn't be shared between tiers and objects
+        return dict(data) if isinstance(data, dict) else data
+
+    @classmethod
+    def _write_tier(cls, idx, kv_key, data, kv_data, force, exists = True, ttl = None):
+        """
+        Writes data to tier idx.  Forced writes are upserts; otherwise new documents are inserted
+        and existing ones updated, CAS checked against kv_data if it is known.
+        """
+        tier_obj = cls.tier_classes[idx](key = kv_key, data = cls._copy(data), kv_data = kv_data)
+        if ttl is not None:
+            tier_obj.set_ttl(ttl)
+        return tier_obj._update(force) if exists or force else tier_obj._insert(force)
+
+    @classmethod
+    def _delete_tier(cls, idx, kv_key, kv_data, force):
+        tier_cls = cls.tier_classes[idx]
+        tier_obj = tier_cls(key = kv_key, data = {}, kv_data = kv_data)
+        try:
+            tier_obj._delete(force or not kv_data)
+        except (KeyError,) + tuple(tier_cls.cas_errors):
+            if idx == len(cls.tier_classes) - 1 and kv_data:
+                raise
+
+    @classmethod
+    def _promote(cls, idx, kv_key, data, kv_datas):
+        """
+        Copies a document found in tier idx into the faster tiers
+        """
+        expires_at = cls.tier_classes[idx]._kv_expires_at(kv_datas[idx])
+        ttl = expires_at - time.time() if expires_at else 0
+        if expires_at and ttl <= 0:
+            return
+
+        for faster_idx in range(idx):
+            start_time = time.time()
+            try:
+                kv_datas[faster_idx] = cls._write_tier(faster_idx, kv_key, data, None, force = True, ttl = ttl)
+                cls._record(faster_idx, start_time, promotions = 1)
+            except tuple(cls.tier_classes[faster_idx].cas_errors):
+                cls._record(faster_idx, start_time, errors = 1)
+
+    @classmethod
+    def _find_by_key(cls, kv_key):
+        kv_datas = [ None ] * len(cls.tier_classes)
+
+        for idx, tier_cls in enumerate(cls.tier_classes):
+            start_time = time.time()
+            kv_data, data = tier_cls._find_by_key(kv_key)
+
+            if kv_data:
+                cls._record(idx, start_time, hits = 1)
+                kv_datas[idx] = kv_data
+                data = cls._copy(data)
+                cls._promote(idx, kv_key, data, kv_datas)
+                return kv_datas, data
+
+            cls._record(idx, start_time, misses = 1)
+
+        return None, None
+
+    @classmethod
+    def _find_multi(cls, kv_keys):
+        results = {}
+        remaining = list(kv_keys)
+
+        for idx, tier_cls in enumerate(cls.tier_classes):
+            if not remaining:
+                break
+
+            start_time = time.time()
+            found = tier_cls._find_multi(remaining)
+            hits = [ kv_key for kv_key in remaining if found.get(kv_key, (None, None))[0] ]
+            cls._record(idx, start_time, hits = len(hits), misses = len(remaining) - len(hits))
+
+            for kv_key in hits:
+                kv_datas = [ None ] * len(cls.tier_classes)
+                kv_datas[idx], data = found[kv_key][0], cls._copy(found[kv_key][1])
+                cls._promote(idx, kv_key, data, kv_datas)
+                results[kv_key] = (kv_datas, data)
+
+            hits = set(hits)
+            remaining = [ kv_key for kv_key in remaining if kv_key not in hits ]
+
+        for kv_key in remaining:
+            results[kv_key] = (None, None)
+
+        return results
+
+    @classmethod
+    def _kv_cas(cls, kv_data):
+        return cls.tier_classes[-1]._kv_cas(kv_data[-1]) if kv_data else None
+
+    @classmethod
+    def _kv_expires_at(cls, kv_data):
+        for tier_cls, tier_kv_data in zip(cls.tier_classes, kv_data):
+            if tier_kv_data:
+                return tier_cls._kv_expires_at(tier_kv_data)
+        return 0
+
+    @classmethod
+    def _find_cas_by_key(cls, kv_key):
+        return cls.tier_classes[-1]._find_cas_by_key(kv_key)
+
+    def _write(self, force):
+        kv_datas = list(self._kv_data or [ None ] * len(self.tier_classes))
+        data = self._data
+        ttl = self.write_ttl()
+
+        if self.write_policy == 'behind':
+            tiers = [ 0 ]
+            self._queue_behind(self._key, data, time.time() + ttl if ttl else 0)
+        else:
+            tiers = reversed(range(len(self.tier_classes)))
+
+        for idx in tiers:
+            start_time = time.time()
+            is_cache = idx < len(self.tier_classes) - 1
+
+            try:
+                kv_datas[idx] = self._write_tier(idx, self._key, data, kv_datas[idx], force or is_cache, exists = bool(self._kv_data), ttl = ttl)
+                self._record(idx, start_time, writes = 1)
+            except Exception:
+                self._record(idx, start_time, errors = 1)
+                if not is_cache or self.write_policy == 'behind':
+                    raise
+
+                # A cache tier which can't be written mustn't keep serving the old document
+                kv_datas[idx] = None
+                self._delete_tier(idx, self._key, None, True)
+
+        return kv_datas
+
+    def _insert(self, force=False):
+        return self._write(force)
+
+    def _update(self, force=False):
+        return self._write(force)
+
+    def _delete(self, force=False):
+        kv_datas = self._kv_data or [ None ] * len(self.tier_classes)
+
+        if self.write_policy == 'behind':
+            self._queue_behind(self._key, None, 0)
+            tiers = [ 0 ]
+        else:
+            tiers = range(len(self.tier_classes))
+
+        for idx in tiers:
+            start_time = time.time()
+            self._delete_tier(idx, self._key, kv_datas[idx], force)
+            self._record(idx, start_time, writes = 1)
+
+        return None
+
+    @classmethod
+    def _queue_behind(cls, kv_key, data, expires_at):
+        with cls.behind_lock:
+            cls.behind_queue.pop(kv_key, None)
+            cls.behind_queue[kv_key] = (cls._copy(data), expires_at)
+
+            if not cls.behind_thread or not cls.behind_thread.is_alive():
+                cls.behind_thread = threading.Thread(target=cls._run_behind, name='{}.behind'.format(cls.__name__))
+                cls.behind_thread.daemon = True
+                cls.behind_thread.start()
+
+    @classmethod
+    def _run_behind(cls):
+        thread = threading.current_thread()
+
+        while not cls.behind_stop.wait(cls.behind_interval):
+            try:
+                cls.flush()
+            except Exception:
+                logging.getLogger(__name__).exception("Write-behind flush failed for %s", cls.__name__)
+
+            with cls.behind_lock:
+                # Exiting under the lock, so a write queued after this starts a new thread
+                if not cls.behind_queue:
+                    if cls.behind_thread is thread:
+                        cls.behind_thread = None
+                    return
+
+        with cls.behind_lock:
+            if cls.behind_thread is thread:
+                cls.behind_thread = None
+
+    @classmethod
+    def stop_behind(cls):
+        """
+        Stops the write-behind thread, waits for it to exit, and writes whatever is still queued.
+        Returns flush()'s failures.  A later write starts the thread again.
+        """
+        with cls.behind_lock:
+            thread = cls.behind_thread
+
+        if thread:
+            cls.behind_stop.set()
+            thread.join()
+            cls.behind_stop.clear()
+
+        return cls.flush()
+
+    @classmethod
+    def flush(cls):
+        """
+        Writes queued write-behind documents (None: deletes) to tiers after the first.
+
+        Failed writes are counted in tier_stats errors.  A key whose authoritative tier write
+        fails is queued again, unless a newer write for it has been queued in the meantime, and
+        its exception is kept in behind_failures { kv_key : exception } until a write succeeds.
+        Returns the (kv_key, exception) pairs which failed during this flush.
+        """
+        with cls.behind_lock:
+            queue, cls.behind_queue = cls.behind_queue, collections.OrderedDict()
+
+        authoritative_idx = len(cls.tier_classes) - 1
+        failures = []
+        for kv_key, (data, expires_at) in six.iteritems(queue):
+            ttl = expires_at - time.time() if expires_at else 0
+            if expires_at and ttl <= 0:
+                continue
+
+            for idx in range(1, len(cls.tier_classes)):
+                start_time = time.time()
+                try:
+                    if data is None:
+                        cls._delete_tier(idx, kv_key, None, True)
+                    else:
+                        cls._write_tier(idx, kv_key, data, None, force = True, ttl = ttl)
+                    cls._record(idx, start_time, writes = 1)
+                except Exception as e:
+                    cls._record(idx, start_time, errors = 1)
+                    if idx == authoritative_idx:
+                        failures.append((kv_key, e))
+
+            with cls.behind_lock:
+                if failures and failures[-1][0] == kv_key:
+                    cls.behind_failures[kv_key] = failures[-1][1]
+                    if kv_key not in cls.behind_queue:
+                        cls.behind_queue[kv_key] = (data, expires_at)
+                else:
+                    cls.behind_failures.pop(kv_key, None)
+
+        return failures